@@ -33,6 +33,14 @@ class Beam(dict):
     def __repr__(self):
         return self.ReturnBeamString()
 
+    def __getstate__(self):
+        # the setters are bound methods, which can't be pickled
+        return {'isPTCDistribution' : self.isPTCDistribution}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.SetDistributionType(self['distrType'])
+
     def GetItemStr(self, key):
         return str(self[key])
         
@@ -18,6 +18,11 @@ Machine - a sequence of elements and associated options and beam etc.
 from . import _General
 from ._General import IsFloat as _IsFloat
 from   decimal import Decimal as _Decimal
+import gzip as _gzip
+import multiprocessing as _multiprocessing
+import multiprocessing.pool as _multiprocessingpool
+import numbers as _numbers
+import os as _os
 import time
 
 from .Beam import Beam as _Beam
@@ -38,6 +43,33 @@ madxcategories = [
     'marker'
     ]
 
+_NUMBERTYPES     = (float, int)
+_STRINGTYPES     = (str, type(u''))
+_WRITEBATCH      = 2000    # elements formatted per write
+_WRITEBUFFERSIZE = 1 << 20 # bytes
+
+def _Number(value):
+    """
+    Return a number suitable for storing in an Element. Python and numpy
+    numbers are kept as they are and only formatted when written; anything
+    else (e.g. a numeric string) is converted to a Decimal.
+    """
+    if isinstance(value, _numbers.Real):
+        return value
+    return _Decimal(str(value))
+
+def _FormatNumber(value):
+    """
+    Format a number stored in an Element. This is identical to
+    str(Decimal(str(value))) but only builds the Decimal when the
+    string has an exponent or is not finite, as Decimal formats
+    those differently.
+    """
+    s = str(value)
+    if 'e' in s or 'n' in s:
+        return str(_Decimal(s))
+    return s
+
 class Element(dict) :
     """
     Element - a beam element class - inherits dict
@@ -48,10 +80,13 @@ class Element(dict) :
     The keyword arguments are specific to the type and are up to
     the user to specify.
 
-    Numbers are converted to a python Decimal type to provide
-    higher accuracy in the representation of numbers - 15
-    decimal places are used.
+    Numbers are stored as given and formatted when the element is
+    written with the same representation as a python Decimal of the
+    number would have, so written lattices round trip exactly. Numbers
+    given as strings are converted to a Decimal.
     """
+    __slots__ = ('name', 'category', 'length', '_keysextra')
+
     def __init__(self, name, category, **kwargs):
         if category not in madxcategories:
             raise ValueError("Not a valid MADX element type")
@@ -61,15 +96,17 @@ class Element(dict) :
         self['name']     = self.name
         self['category'] = self.category
         self._keysextra = []
-        for key,value in kwargs.iteritems():
+        for key,value in kwargs.items():
             if type(value) == tuple and category != 'multipole':
                 #use a tuple for (value,units)
-                self[key] = (_Decimal(str(value[0])),value[1])
+                self[key] = (_Number(value[0]),value[1])
             elif type(value) == tuple and category == 'multipole' :
                 self[key] = value
+            elif type(value) in _NUMBERTYPES:
+                self[key] = value
             elif _IsFloat(value):
                 #just a number
-                self[key] = _Decimal(str(value))
+                self[key] = _Number(value)
             else:
                 #must be a string
                 self[key] = '"'+value+'"'
@@ -81,24 +118,30 @@ class Element(dict) :
                 ll = self['l']
             self.length += float(ll)
 
+    def __getstate__(self):
+        return (self.name, self.category, self.length, self._keysextra)
+
+    def __setstate__(self, state):
+        self.name, self.category, self.length, self._keysextra = state
+
     def keysextra(self):
         #so behaviour is similar to dict.keys()
         return self._keysextra
 
     def __repr__(self):
-        s = ''
-        s += self.name + ': '
-        s += self.category
-        if len(self._keysextra) > 0:
-            for key in self._keysextra:
-                if type(self[key]) == tuple and self.category != 'multipole':
-                    s += ', ' + key + '=' + str(self[key][0]) + '*' + str(self[key][1])
-                elif type(self[key]) == tuple and self.category == 'multipole' :
-                    s += ', ' + key + '=' + '{'+(','.join([str(s) for s in self[key]]))+'}'
-                else:
-                    s += ', ' + key + '=' + str(self[key])
-        s += ';\n'
-        return s
+        s = [self.name, ': ', self.category]
+        for key in self._keysextra:
+            value = self[key]
+            if type(value) == tuple and self.category != 'multipole':
+                s.extend((', ', key, '=', _FormatNumber(value[0]), '*', str(value[1])))
+            elif type(value) == tuple and self.category == 'multipole' :
+                s.extend((', ', key, '=', '{', ','.join([str(v) for v in value]), '}'))
+            elif isinstance(value, _STRINGTYPES):
+                s.extend((', ', key, '=', value))
+            else:
+                s.extend((', ', key, '=', _FormatNumber(value)))
+        s.append(';\n')
+        return ''.join(s)
 
 class Line(list):
     def __init__(self,name,*args):
@@ -139,6 +182,7 @@ class Machine(object):
     def __init__(self,verbose=False):
         self.verbose   = verbose
         self.sequence  = []
+        self.sequenced = set() # names in the sequence for fast lookup
         self.elements  = []
         self.elementsd = {}
         self.samplers  = []
@@ -163,6 +207,8 @@ class Machine(object):
             raise StopIteration
         self._iterindex += 1
         return self.elementsd[self.sequence[self._iterindex]]
+
+    __next__ = next
         
     def __getitem__(self,name):
         if _IsFloat(name):
@@ -171,12 +217,12 @@ class Machine(object):
             return self.elementsd[name]
 
     def __len__(self):
-        return len(self.elementsd.keys())
+        return len(self.elementsd)
 
     def Append(self,object):
         if type(object) not in (Element,Line):
             raise TypeError("Only Elements or Lines can be added to the machine")
-        elif object.name not in self.sequence:
+        elif object.name not in self.sequenced:
             #hasn't been used before - define it
             if type(object) is Line:
                 for element in object:
@@ -189,6 +235,7 @@ class Machine(object):
                 self.elementsd[object.name] = object
         #finally add it to the sequence
         self.sequence.append(object.name)
+        self.sequenced.add(object.name)
         self.length += object.length
 
     def Write(self,filename,verbose=False):
@@ -198,6 +245,13 @@ class Machine(object):
         verboseresult = verbose or self.verbose
         WriteMachine(self,filename,verboseresult)
 
+    def WriteVariants(self,filename,variants,verbose=False):
+        """
+        Write the machine once and a main file per variant. See WriteVariants.
+        """
+        verboseresult = verbose or self.verbose
+        return WriteVariants(self,filename,variants,verboseresult)
+
     def AddDrift(self, name='dr', length=0.1, **kwargs):
         if self.verbose:
             print('AddDrift>  ',name,' ',length,' ',kwargs)
@@ -244,6 +298,15 @@ class Machine(object):
         self.Append(Element(name,'multipole', knl=knl, ksl=ksl, **kwargs))
 
     def AddSampler(self,*elementnames):
+        """
+        AddSampler('all'), AddSampler('first'), AddSampler('last') or
+        AddSampler(name1, name2, ...) or AddSampler([name1, name2, ...])
+
+        Named elements must be in the sequence. All names are checked
+        before any sampler is added.
+        """
+        if len(elementnames) == 1 and type(elementnames[0]) in (list, tuple):
+            elementnames = elementnames[0]
         if elementnames[0] == 'all':
             for element in self.elements:
                 #remember we can only have samplers on uniquely
@@ -254,11 +317,10 @@ class Machine(object):
         elif elementnames[0] == 'last':
             self.samplers.append(Sampler(self.elements[-1].name))
         else:
-            for element in elementnames:
-                if element not in self.sequence:
-                    raise ValueError(element+" is not a valid element in this machine")
-                else:
-                    self.samplers.append(Sampler(element))
+            invalid = [name for name in elementnames if name not in self.sequenced]
+            if len(invalid) > 0:
+                raise ValueError(", ".join(invalid)+" not valid element(s) in this machine")
+            self.samplers.extend([Sampler(name) for name in elementnames])
         
     def AddBeam(self, beam=None) : 
         self.beam = beam
@@ -284,22 +346,72 @@ class Machine(object):
 
 # General scripts below this point
 
-def WriteMachine(machine, filename, verbose=False):
+def _OpenMachineFile(fileName):
+    """Open a plain or, if the name ends with .gz, gzipped file in binary mode."""
+    if fileName.endswith('.gz'):
+        return _gzip.open(fileName, 'wb', 6)
+    return open(fileName, 'wb', _WRITEBUFFERSIZE)
+
+def _WriteLines(f, lines, batch=_WRITEBATCH):
     """
-    WriteMachine(machine(machine),filename(string),verbose(bool))
-    
-    Write a lattice to disk. This writes several files to make the
-    machine, namely:
-    
-     * filename_components.madx - component files (max 10k per file)
-     * filename_sequence.madx   - lattice definition
-     * filename_samplers.madx   - sampler definitions (max 10k per file)
-     * filename.gmad            - suitable main file with all sub 
-                                  files in correct order
-    
-    These are prefixed with the specified filename / path.
+    Write the strings (e.g. elements) of an iterable to a binary file in
+    batches. Returns the number of bytes written.
+    """
+    nbytes = 0
+    lines  = list(lines)
+    for start in range(0, len(lines), batch):
+        data = ''.join([str(line) for line in lines[start:start+batch]]).encode('ascii')
+        f.write(data)
+        nbytes += len(data)
+    return nbytes
+
+def _WriteMain(fn_main, machine, calls, basefilename, timestring):
+    """
+    Write a main file that calls the files of a machine. calls is a list of
+    lines (calls and any other statements) written in order.
+    """
+    f = open(fn_main,'w')
+    f.write(timestring)
+    f.write('! pymadx.Builder Machine \n')
+    f.write('! number of elements = ' + str(len(machine.elements)) + '\n')
+    f.write('! total length       = ' + str(machine.length) + ' m\n\n')
+    f.write('set, format="22.16e";\n')
+    f.write(''.join(calls))
+
+    # line in main file for outputting twiss params to .tfs file
+    if machine.beam['distrType'] == 'ptctwiss':
+        f.write('\n')
+        f.write(machine.beam.ReturnPtcTwissString(basefilename))
+        f.write('ptc_end;\n')
+    elif not machine.beam['distrType'] == 'ptc':
+        f.write('\n')
+        f.write(machine.beam.ReturnTwissString(basefilename))
+
+    f.close()
+
+def _Calls(files):
+    """
+    Return the call statements of a list of files relative to the main file.
+    MADX can't read gzipped files, so these are called by their uncompressed
+    name with a note to decompress them first.
+    """
+    calls = []
+    for fn in files:
+        fn = fn.split('/')[-1]
+        if fn.endswith('.gz'):
+            calls.append("! decompress " + fn + " first (e.g. gunzip " + fn + ")\n"
+                         "call, file='" + fn[:-3] + "';\n")
+        else:
+            calls.append("call, file='"+fn+"';\n")
+    return calls
+
+def _WriteMachineFiles(machine, filename, verbose=False, compress=False, checkexists=True):
+    """
+    Write all the files of a machine except the main file. Returns the
+    base file name (which may differ from filename if it exists already
+    and checkexists is True), the list of files written in the order they
+    should be called and the time stamp.
     """
-    
     if not isinstance(machine,Machine):
         raise TypeError("Not machine instance")
     
@@ -309,16 +421,18 @@ def WriteMachine(machine, filename, verbose=False):
     if filename[-5:] != '.madx':
         filename += '.madx'
     #check if file already exists
-    ofilename = filename
-    filename = _General.CheckFileExists(filename)
-    if filename != ofilename:
-        print('Warning, chosen filename already exists - using filename: ',filename.split('.')[0])
+    if checkexists:
+        ofilename = filename
+        filename = _General.CheckFileExists(filename)
+        if filename != ofilename:
+            print('Warning, chosen filename already exists - using filename: ',filename.split('.')[0])
     basefilename = filename[:-5]#.split('/')[-1]
 
     #prepare names
     files         = []
-    fn_main       = basefilename + '.madx'
     fn_components = basefilename + '_components.madx'
+    if compress:
+        fn_components += '.gz'
     fn_sequence   = basefilename + '_sequence.madx'
     fn_beam       = basefilename + '_beam.madx'
     fn_options    = basefilename + '_options.madx'
@@ -335,32 +449,34 @@ def WriteMachine(machine, filename, verbose=False):
     f.close()
     
     #write component files
-    f = open(fn_components,'w')
+    t0 = time.time()
+    f = _OpenMachineFile(fn_components)
     files.append(fn_components)
-    f.write(timestring)
-    f.write('! pymadx.Builder Machine \n')
-    f.write('! COMPONENT DEFINITION\n\n')
-    for element in machine.elements:
-        f.write(str(element))
+    nbytes = _WriteLines(f, [timestring,
+                             '! pymadx.Builder Machine \n',
+                             '! COMPONENT DEFINITION\n\n'])
+    nbytes += _WriteLines(f, machine.elements)
     f.close()
 
     #write lattice sequence
-    f = open(fn_sequence,'w')
+    f = _OpenMachineFile(fn_sequence)
     files.append(fn_sequence)
-    f.write(timestring)
-    f.write('! pymadx.Builder Machine \n')
-    f.write('! LATTICE SEQUENCE DEFINITION\n\n')
-    sequencechunks = _General.Chunks(machine.sequence,elementsperline)
-    linelist = []
-    ti = 0
-    for line in _General.Chunks(machine.sequence,elementsperline):
-        f.write('l'+str(ti)+': line = ('+', '.join(line)+');\n')
-        linelist.append('l'+str(ti))
-        ti += 1
+    nbytes += _WriteLines(f, [timestring,
+                              '! pymadx.Builder Machine \n',
+                              '! LATTICE SEQUENCE DEFINITION\n\n'])
+    nlines   = (len(machine.sequence) + elementsperline - 1) // elementsperline
+    linelist = ['l'+str(ti) for ti in range(nlines)]
+    nbytes += _WriteLines(f, ['l'+str(ti)+': line = ('+', '.join(line)+');\n'
+                              for ti,line in enumerate(_General.Chunks(machine.sequence,elementsperline))],
+                          _WRITEBATCH//elementsperline)
     # need to define the period before making sampler planes
-    f.write('lattice: line = ('+', '.join(linelist)+');\n')
-    f.write('use, period=lattice;\n')
+    nbytes += _WriteLines(f, ['lattice: line = ('+', '.join(linelist)+');\n',
+                              'use, period=lattice;\n'])
     f.close()
+    dt = time.time() - t0
+    if verbose:
+        print('Components and sequence: ' + str(nbytes) + ' bytes in ' + '%.3f' % dt + ' s ('
+              + '%.1f' % (nbytes / max(dt, 1e-9) / 1e6) + ' MB/s)')
 
     # optionally write start of ptc job / inialise the universe
     if machine.beam['distrType'] == 'ptc':
@@ -389,38 +505,209 @@ def WriteMachine(machine, filename, verbose=False):
         #write samplers - only for PTC jobs
         if len(machine.samplers) > 0:
             f.write('\n! SAMPLER DEFINITION\n\n')
-            for sampler in machine.samplers:
-                f.write(str(sampler))
+            f.write(''.join([str(sampler) for sampler in machine.samplers]))
             f.write('ptc_track, element_by_element, dump, turns=1, icase=5, onetable' + ptcTrackstr + ';\n')
             f.write('PTC_TRACK_END;\n')
             f.write('ptc_end;\n')
         f.close()
 
-    # write main file
-    f = open(fn_main,'w')
-    f.write(timestring)
-    f.write('! pymadx.Builder Machine \n')
-    f.write('! number of elements = ' + str(len(machine.elements)) + '\n')
-    f.write('! total length       = ' + str(machine.length) + ' m\n\n')
-    f.write('set, format="22.16e";\n')
+    return basefilename, files, timestring
+
+def WriteMachine(machine, filename, verbose=False, compress=False):
+    """
+    WriteMachine(machine(machine),filename(string),verbose(bool),compress(bool))
+    
+    Write a lattice to disk. This writes several files to make the
+    machine, namely:
     
+     * filename_components.madx - component files (max 10k per file)
+     * filename_sequence.madx   - lattice definition
+     * filename_samplers.madx   - sampler definitions (max 10k per file)
+     * filename.gmad            - suitable main file with all sub 
+                                  files in correct order
+    
+    These are prefixed with the specified filename / path.
+
+    The components and sequence are formatted in batches and written
+    through large buffers. compress=True writes the component file
+    gzipped (filename_components.madx.gz). MADX can't read gzipped files, so
+    the main file calls filename_components.madx and says to decompress the
+    component file before running MADX.
+    """
+    
+    basefilename, files, timestring = _WriteMachineFiles(machine, filename, verbose, compress)
+    fn_main = basefilename + '.madx'
+    _WriteMain(fn_main, machine, _Calls(files), basefilename, timestring)
+
+    #user feedback
+    print('Machine written to:')
     for fn in files:
-        fn = fn.split('/')[-1]
-        f.write("call, file='"+fn+"';\n")
+        print(fn)
+    print('All included in main file: \n',fn_main)
 
-    # line in main file for outputting twiss params to .tfs file
-    if machine.beam['distrType'] == 'ptctwiss':
-        f.write('\n')
-        f.write(machine.beam.ReturnPtcTwissString(basefilename))
-        f.write('ptc_end;\n')
-    elif not machine.beam['distrType'] == 'ptc':
-        f.write('\n')
-        f.write(machine.beam.ReturnTwissString(basefilename))
+def _VariantChange(name, key, value):
+    """
+    Return the MADX statement setting the attribute key of element name.
+    Strings are deferred expressions, (value,units) tuples are multiplied out.
+    """
+    if type(value) == tuple:
+        return name + '->' + key + ' = ' + _FormatNumber(_Number(value[0])) + '*' + str(value[1]) + ';\n'
+    elif isinstance(value, _STRINGTYPES):
+        return name + '->' + key + ' := ' + value + ';\n'
+    else:
+        return name + '->' + key + ' = ' + _FormatNumber(_Number(value)) + ';\n'
+
+def _VariantChanges(machine, changes):
+    """
+    Return the MADX statements for the changes of one variant - a dictionary
+    of element name : {attribute : value} or variable name : value.
+    """
+    lines = []
+    for name in sorted(changes):
+        value = changes[name]
+        if isinstance(value, dict):
+            if name not in machine.elementsd:
+                raise ValueError(str(name)+" is not a valid element in this machine")
+            for key in sorted(value):
+                lines.append(_VariantChange(name, str(key), value[key]))
+        elif isinstance(value, _STRINGTYPES):
+            lines.append(str(name) + ' := ' + value + ';\n')
+        else:
+            lines.append(str(name) + ' = ' + _FormatNumber(_Number(value)) + ';\n')
+    return lines
 
-    f.close()
+# suffixes of the files written by _WriteMachineFiles and shared by variants
+_SHAREDFILES = ('components', 'sequence', 'beam', 'options', 'ptcjob')
+
+def WriteVariants(machine, filename, variants, verbose=False, compress=False):
+    """
+    WriteVariants(machine(machine),filename(string),variants(dict or list),
+                  verbose(bool),compress(bool))
+
+    Write a machine once and a small main file for each of a number of
+    variants of it (e.g. a knob scan). The components, sequence, beam and
+    ptc job files are written as by WriteMachine and shared by all variants.
+
+    variants - dictionary of variant name : changes or a list of changes,
+               in which case the variants are named by their index.
+
+    The changes of a variant are a dictionary of element name :
+    {attribute : value} and / or of variable name : value, e.g.
+
+    {'qf1' : {'k1' : 0.21}, 'qd1' : {'k1' : 'kqd*1.01'}, 'kqd' : -0.2}
+
+    Numbers override the value, strings are written as deferred expressions.
+    The changes are written in the main file of the variant after the
+    components are defined, so only the changes are written per variant.
+
+    Each variant main file is filename_<variant name>.madx and the twiss
+    output of a variant is named after it. Returns the list of variant
+    main files. Variant names that would overwrite a shared file
+    (components, sequence, beam, options or ptcjob) are rejected.
+    """
+    if isinstance(variants, dict):
+        names = sorted(variants)
+    else:
+        names    = list(range(len(variants)))
+        variants = dict(enumerate(variants))
+    reserved = [str(name) for name in names if str(name) in _SHAREDFILES]
+    if reserved:
+        raise ValueError("Variant name(s) " + ", ".join(reserved) + " would overwrite the shared "
+                         "machine files - variants can't be called " + ", ".join(_SHAREDFILES))
+    # check all the changes before writing anything
+    changes = [_VariantChanges(machine, variants[name]) for name in names]
+
+    basefilename, files, timestring = _WriteMachineFiles(machine, filename, verbose, compress)
+    calls = _Calls(files)
+    _WriteMain(basefilename + '.madx', machine, calls, basefilename, timestring)
+
+    # changes are made once the components are defined (calls[1])
+    t0 = time.time()
+    variantfiles = []
+    for name,lines in zip(names, changes):
+        variantname = basefilename + '_' + str(name)
+        fn_variant  = variantname + '.madx'
+        vcalls = calls[:2] + ['\n! VARIANT ' + str(name) + '\n'] + lines + ['\n'] + calls[2:]
+        _WriteMain(fn_variant, machine, vcalls, variantname, timestring)
+        variantfiles.append(fn_variant)
+    dt = time.time() - t0
 
     #user feedback
     print('Machine written to:')
     for fn in files:
         print(fn)
-    print('All included in main file: \n',fn_main)
+    print('All included in main file: \n',basefilename + '.madx')
+    print(str(len(variantfiles)) + ' variants written to: ' + basefilename + '_<variant>.madx')
+    if verbose:
+        print('Variants written in ' + '%.3f' % dt + ' s')
+    return variantfiles
+
+def _WriteMachineTask(task):
+    """Write one machine of WriteMachines without checking the file name."""
+    machine, filename, compress = task
+    basefilename, files, timestring = _WriteMachineFiles(machine, filename, False, compress, False)
+    _WriteMain(basefilename + '.madx', machine, _Calls(files), basefilename, timestring)
+    return basefilename + '.madx'
+
+def WriteMachines(machines, directory, workers=1, names=None, verbose=False,
+                  compress=False, threads=False):
+    """
+    WriteMachines(machines(list),directory(string),workers(int),names(list),
+                  verbose(bool),compress(bool),threads(bool))
+
+    Write many machines into a directory, optionally in parallel. Each
+    machine is written as by WriteMachine.
+
+    machines  - list of Machine instances
+    directory - output directory, created if it doesn't exist
+    workers   - number of processes (or threads) writing machines
+    names     - list of unique file names (without .madx) - by default
+                machine_<index> with the index zero padded
+    compress  - gzip the component files (see WriteMachine)
+    threads   - use a pool of threads instead of processes, e.g. if the
+                machines can't be pickled
+
+    The file names are decided up front from the names, so existing files
+    with the same names are overwritten rather than renamed. Returns the
+    list of main files in the order of machines.
+    """
+    machines = list(machines)
+    for machine in machines:
+        if not isinstance(machine,Machine):
+            raise TypeError("Not machine instance")
+    if names is None:
+        width = len(str(max(len(machines)-1, 0)))
+        names = ['machine_' + str(i).zfill(width) for i in range(len(machines))]
+    names = [str(name) for name in names]
+    if len(names) != len(machines):
+        raise ValueError("Number of names and machines differ")
+    if len(set(names)) != len(names):
+        raise ValueError("Machine names are not unique")
+
+    if not _os.path.isdir(directory):
+        _os.makedirs(directory)
+    tasks = [(machine, _os.path.join(directory, name), compress) for machine,name in zip(machines, names)]
+
+    t0 = time.time()
+    workers = max(workers, 1)
+    if workers > 1 and len(tasks) > 1:
+        if threads:
+            pool = _multiprocessingpool.ThreadPool(workers)
+        else:
+            pool = _multiprocessing.Pool(workers)
+        try:
+            chunksize = max(1, len(tasks) // (4*workers))
+            result = pool.map(_WriteMachineTask, tasks, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        result = [_WriteMachineTask(task) for task in tasks]
+    dt = time.time() - t0
+
+    #user feedback
+    print(str(len(result)) + ' machines written to: ' + directory)
+    if verbose:
+        print('Machines written in ' + '%.3f' % dt + ' s (' + '%.1f' % (len(result) / max(dt, 1e-9)) + ' per s)')
+    return result
+
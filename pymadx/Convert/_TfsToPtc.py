@@ -1,11 +1,19 @@
 import pymadx.Beam as _Beam
 import pymadx.Builder as _Builder
+import itertools as _itertools
 import numpy as _np
+import multiprocessing as _multiprocessing
+import operator as _operator
 import re as _re
-import csv
+import time as _time
 
 import pymadx.Data as _Data
 
+try:
+    from itertools import izip as _zip
+except ImportError:
+    _zip = zip
+
 def TfsToPtc(inputfile,outputfilename, ptcfile, startname=None,
              stopname=None,ignorezerolengthitems=True,samplers='all',
              beampiperadius=0.2,beam=True,ptctrackaperture=[]):
@@ -18,31 +26,150 @@ def TfsToPtcTwiss(inputfile,outputfilename, startname=None,
     _TfsToPtc('ptctwiss',inputfile,outputfilename,'', startname,
              stopname,ignorezerolengthitems,'',beampiperadius)
 
+def _TfsToPtcFile(task):
+    """
+    Convert all the jobs of one input file of TfsToPtcBatch, loading the Tfs
+    once. Returns a list of (job index, load time, conversion time, error).
+    """
+    inputfile, jobs, options = task
+    t0 = _time.time()
+    try:
+        madx = _Data.CheckItsTfs(inputfile)
+        _CheckColumns(madx)
+    except Exception as e:
+        return [(index, _time.time() - t0, 0.0, repr(e)) for index,_,_,_ in jobs]
+    tload = _time.time() - t0
+
+    result = []
+    for index,outputfilename,startname,stopname in jobs:
+        t0 = _time.time()
+        try:
+            _TfsToPtc('ptctrack', madx, outputfilename, options['ptcfile'], startname, stopname,
+                      options['ignorezerolengthitems'], options['samplers'],
+                      options['beampiperadius'], options['beam'], options['ptctrackaperture'],
+                      checkcolumns=False)
+            error = None
+        except Exception as e:
+            error = repr(e)
+        result.append((index, tload, _time.time() - t0, error))
+    return result
+
+def TfsToPtcBatch(jobs, ptcfile, workers=1, ignorezerolengthitems=True, samplers='all',
+                  beampiperadius=0.2, beam=True, ptctrackaperture=[]):
+    """
+    Run TfsToPtc for many jobs, optionally with a pool of processes.
+
+    jobs    - list of (inputfile, outputfilename) or (inputfile, outputfilename,
+              startname, stopname) tuples. The inputfile is a file name or a
+              Tfs instance.
+    ptcfile - inrays file used by all jobs
+    workers - number of processes
+
+    The other arguments are passed to TfsToPtc for every job. Each input file
+    is loaded once and converted for all the ranges of it by the same process.
+    A job that fails doesn't stop the others. A summary with the time taken
+    per job and any failures is printed.
+
+    Returns a list of dictionaries (in the order of jobs) with the keys
+    'input', 'output', 'start', 'stop', 'load' (time to load the input file,
+    shared by its jobs), 'time' (conversion time) and 'error' (None or the
+    exception as a string).
+    """
+    jobs = [tuple(job) + (None,)*(4-len(job)) for job in jobs]
+    options = {'ptcfile'               : ptcfile,
+               'ignorezerolengthitems' : ignorezerolengthitems,
+               'samplers'              : samplers,
+               'beampiperadius'        : beampiperadius,
+               'beam'                  : beam,
+               'ptctrackaperture'      : ptctrackaperture}
+
+    # group jobs by input file, keeping the order they first appear in
+    files = []
+    tasks = {}
+    for index,(inputfile,outputfilename,startname,stopname) in enumerate(jobs):
+        key = inputfile if isinstance(inputfile, str) else id(inputfile)
+        if key not in tasks:
+            files.append(key)
+            tasks[key] = (inputfile, [], options)
+        tasks[key][1].append((index, outputfilename, startname, stopname))
+    tasks = [tasks[key] for key in files]
+
+    workers = max(workers, 1)
+    if workers > 1 and len(tasks) > 1:
+        pool = _multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            results = list(pool.imap_unordered(_TfsToPtcFile, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_TfsToPtcFile(task) for task in tasks]
+
+    summary = [None]*len(jobs)
+    for result in results:
+        for index,tload,tconvert,error in result:
+            inputfile,outputfilename,startname,stopname = jobs[index]
+            summary[index] = {'input'  : inputfile if isinstance(inputfile, str) else 'Tfs instance',
+                              'output' : outputfilename,
+                              'start'  : startname,
+                              'stop'   : stopname,
+                              'load'   : tload,
+                              'time'   : tconvert,
+                              'error'  : error}
+
+    print('TfsToPtcBatch> ' + str(len(jobs)) + ' jobs from ' + str(len(tasks)) + ' files')
+    for job in summary:
+        line = 'TfsToPtcBatch> ' + job['input'] + ' -> ' + str(job['output']) + ' : '
+        if job['error'] is None:
+            line += '%.3f s (load %.3f s)' % (job['time'], job['load'])
+        else:
+            line += 'FAILED ' + job['error']
+        print(line)
+    nfailed = len([job for job in summary if job['error'] is not None])
+    if nfailed > 0:
+        print('TfsToPtcBatch> ' + str(nfailed) + ' jobs failed')
+    return summary
+
+_REQUIREDCOLUMNS = ['L', 'ANGLE', 'KSI', 'K0L', 'K0SL', 'K1L', 'K2L', 'K3L','K4L','K5L','K6L',
+                    'K1SL', 'K2SL','K3SL','K4SL','K5SL','K6SL', 'TILT', 'KEYWORD',
+                    'ALFX', 'ALFY', 'BETX', 'BETY', 'VKICK', 'HKICK', 'E1', 'E2', 'FINT', 'FINTX', 'HGAP']
+
+_KNL = ['K0L', 'K1L', 'K2L', 'K3L', 'K4L', 'K5L', 'K6L']
+_KSL = ['K0SL', 'K1SL', 'K2SL', 'K3SL', 'K4SL', 'K5SL', 'K6SL']
+
 def _TfsToPtc(ptctype,inputfile,outputfilename,ptcfile,startname=None,
              stopname=None,ignorezerolengthitems=True,samplers='all',
-             beampiperadius=0.2,beam=True,ptctrackaperture=[]):
+             beampiperadius=0.2,beam=True,ptctrackaperture=[],checkcolumns=True):
     """
     Prepare a madx model for PTC from a Tfs file containing the full
     twiss output from MADX.
 
+    checkcolumns - False if the caller has already checked the columns
     """
 
     madx = _Data.CheckItsTfs(inputfile)
     ptcfilename = ptcfile
-        
-    nitems = madx.nitems
-    opencollimatorsetting = beampiperadius
 
-    # data structures for checks
-    angtot = 0.0
-    lentot = 0.0
-    lldiff = []
-    dldiff = {}
-    itemsomitted = []
+    if checkcolumns:
+        _CheckColumns(madx)
+    a = _TfsToMachine(madx, startname, stopname, ignorezerolengthitems)
 
-    a = _Builder.Machine()
-    
-    #prepare index for iteration:
+    if ptctype == 'ptctrack':
+        a.AddSampler(samplers)
+        a.AddPTCTrackAperture(ptctrackaperture)
+    # Make beam file 
+    if beam:
+        if ptctype == 'ptctrack':
+            b = MadxTfsToPtcBeam(madx, ptcfilename, startname)
+            a.AddBeam(b)
+        if ptctype == 'ptctwiss':
+            b = MadxTfsToPtcTwissBeam(madx, startname)
+            a.AddBeam(b)
+    a.Write(outputfilename)
+
+    return a
+
+def _StartStopIndices(madx, startname=None, stopname=None):
     if startname == None:
         startindex = 0
     elif type(startname) == int:
@@ -50,231 +177,221 @@ def _TfsToPtc(ptctype,inputfile,outputfilename,ptcfile,startname=None,
     else:
         startindex = madx.IndexFromName(startname)
     if stopname   == None:
-        stopindex = nitems #this is 1 larger, but ok as range will stop at n-step -> step=1, range function issue
+        stopindex = madx.nitems #this is 1 larger, but ok as range will stop at n-step -> step=1, range function issue
     elif type(stopname) == int:
         stopindex = stopname
     else:
         stopindex  = madx.IndexFromName(stopname)
     if stopindex <= startindex:
-        print('stopindex <= startindex'
+        print('stopindex <= startindex')
         stopindex = startindex + 1
+    return startindex, stopindex
 
-    requiredColumns = ['L', 'ANGLE', 'KSI', 'K0L', 'K0SL', 'K1L', 'K2L', 'K3L','K4L','K5L','K6L',
-                       'K1SL', 'K2SL','K3SL','K4SL','K5SL','K6SL', 'TILT', 'KEYWORD',
-                       'ALFX', 'ALFY', 'BETX', 'BETY', 'VKICK', 'HKICK', 'E1', 'E2', 'FINT', 'FINTX', 'HGAP']
-
-    missing = [column for column in requiredColumns if column not in madx.columns]
+def _CheckColumns(madx):
+    missing = [column for column in _REQUIREDCOLUMNS if column not in madx.columns]
 
     # raise a value error if a column is missing, otherwise the conversion will continue
     if len(missing) > 0:
         error = "Missing columns from tfs file - insufficient information to convert file\r\n"
-        error += "Columns missing: "
-        for column in missing:
-            error += column + " "
-        error += "\r\n"
-        error += "Given columns  : "
-        for index,column in enumerate(madx.columns):
-            error += column
-            if index != len(madx.columns)-1:
-                error += ", "
+        error += "Columns missing: " + " ".join(missing) + " \r\n"
+        error += "Given columns  : " + ", ".join(madx.columns)
         raise ValueError(error)
 
-    # now assume all are columns present
-
-    lindex          = madx.ColumnIndex('L')
-    angleindex      = madx.ColumnIndex('ANGLE')
-    ksIindex        = madx.ColumnIndex('KSI')
-    k0lindex        = madx.ColumnIndex('K0L')
-    k0slindex       = madx.ColumnIndex('K0SL')
-    k1lindex        = madx.ColumnIndex('K1L')
-    k2lindex        = madx.ColumnIndex('K2L')
-    k3lindex        = madx.ColumnIndex('K3L')
-    k4lindex        = madx.ColumnIndex('K4L')
-    k5lindex        = madx.ColumnIndex('K5L')
-    k6lindex        = madx.ColumnIndex('K6L')
-    k1slindex       = madx.ColumnIndex('K1SL')
-    k2slindex       = madx.ColumnIndex('K2SL')
-    k3slindex       = madx.ColumnIndex('K3SL')
-    k4slindex       = madx.ColumnIndex('K4SL')
-    k5slindex       = madx.ColumnIndex('K5SL')
-    k6slindex       = madx.ColumnIndex('K6SL')
-    tiltindex       = madx.ColumnIndex('TILT')
-    tindex          = madx.ColumnIndex('KEYWORD')
-    alphaxindex     = madx.ColumnIndex('ALFX')
-    alphayindex     = madx.ColumnIndex('ALFY')
-    betaxindex      = madx.ColumnIndex('BETX')
-    betayindex      = madx.ColumnIndex('BETY')
-    vkickangleindex = madx.ColumnIndex('VKICK')
-    hkickangleindex = madx.ColumnIndex('HKICK')
-    e1index         = madx.ColumnIndex('E1')
-    e2index         = madx.ColumnIndex('E2')
-    fintindex       = madx.ColumnIndex('FINT')
-    fintxindex      = madx.ColumnIndex('FINTX')
-    hgapindex       = madx.ColumnIndex('HGAP')
-    h1index         = madx.ColumnIndex('H1')
-    h2index         = madx.ColumnIndex('H2')
-
-    # iterate through input file and construct machine
-    for i in range(startindex,stopindex):
-        name = madx.sequence[i]
-        #remove special characters like $, % etc 'reduced' name - rname
-        rname = _re.sub('[^a-zA-Z0-9_]+','',name) #only allow alphanumeric characters and '_'
-        t     = madx.data[name][tindex]
-        l     = madx.data[name][lindex]
-        ang   = madx.data[name][angleindex]
-        if l <1e-9:
-            zerolength = True
-        else:
-            zerolength = False
-
-        if zerolength and ignorezerolengthitems:
-            itemsomitted.append(name)
-            continue #this skips the rest of the loop as we're ignoring this item
-
-        kws = {} # element-specific keywords
-        tilt = madx.data[name][tiltindex]
-        if tilt != 0:
-            kws['tilt'] = tilt
-        
-        e1    = madx.data[name][e1index]
-        e2    = madx.data[name][e2index]
-        fint  = madx.data[name][fintindex]
-        fintx = madx.data[name][fintxindex]
-        hgap  = madx.data[name][hgapindex]
-        k1l   = madx.data[name][k1lindex]
-        h1    = madx.data[name][h1index]
-        h2    = madx.data[name][h2index]
-
-        if k1l:
-            kws['k1'] = k1l / l
-
-        
-
-        if t == 'DRIFT':
-            a.AddDrift(rname,l,**kws)
-
-        elif t == 'QUADRUPOLE':
-            k1 = madx.data[name][k1lindex] / l
-            a.AddQuadrupole(rname,l,**kws)
-
-        elif t == 'SEXTUPOLE':
-            k2 = madx.data[name][k2lindex] / l
-            a.AddSextupole(rname,l,k2=k2,**kws)
-
-        elif t == 'OCTUPOLE':
-            k3 = madx.data[name][k3lindex] / l
-            a.AddOctupole(rname,l,k3=k3,**kws)
-
-        elif t == 'SOLENOID':
-            ks = madx.data[name][ksIindex] / l
-            a.AddSolenoid(rname,l,ks=ks,**kws)
-
-        elif t == 'SBEND':
-            kws['e1'] = e1
-            kws['fint'] = fint
-            kws['e2'] = e2
-
-            # in madx, -1 means fintx was allowed to default to fint and we should do the same
-            # so if set to 0, this means we want it to be 0
-            if fintx != -1:
-                kws['fintx'] = fintx
-
-            if h1 != 0:
-                kws['h1'] = h1
-            if h2 != 0:
-                kws['h2'] = h2
-            if hgap != 0:
-                kws['hgap'] = hgap
-
-            angle = madx.data[name][angleindex]
-            a.AddDipole(rname,category='sbend',length=l,angle=angle,**kws)
-
-        elif t == 'RBEND':
-            angle = madx.data[name][angleindex]
-            # set element length to be the chord length - tfs output rbend
-            # length is arc length
-            chordLength = l
-            if angle != 0:
-                chordLength = 2 * (l / angle) * _np.sin(angle / 2.)  # protect against 0 angle rbends
-            # subtract dipole angle/2 added on to poleface angles internally by
-            # madx
-            poleInAngle = e1 - 0.5 * angle
-            poleOutAngle = e2 - 0.5 * angle
-            if poleInAngle != 0:
-                kws['e1'] = poleInAngle
-            if poleOutAngle != 0:
-                kws['e2'] = poleOutAngle
+def _ReducedNames(names):
+    """
+    Remove special characters like $, % etc from all names at once - only
+    alphanumeric characters and '_' are allowed.
+    """
+    return _re.sub('[^a-zA-Z0-9_\n]+', '', '\n'.join(names)).split('\n')
+
+def _Divide(kl, l):
+    """Integrated strength / length, None where the length is 0."""
+    k = _np.divide(kl, l, out=_np.zeros_like(kl), where=(l != 0)).tolist()
+    return [ki if li != 0 else None for ki,li in _zip(k, l.tolist())]
+
+def _GroupColumns(madx, rows, columns):
+    """
+    Return a dictionary of column name : array of the values of the columns
+    (at least 2) for the rows. Missing columns are 0.
+    """
+    present = [column for column in columns if column in madx.columns]
+    getter  = _operator.itemgetter(*[madx.ColumnIndex(column) for column in present])
+    values  = _np.fromiter(_itertools.chain.from_iterable(getter(row) for row in rows),
+                           float, len(rows)*len(present)).reshape(len(rows), len(present))
+    result  = dict(_zip(present, values.T))
+    for column in columns:
+        if column not in result:
+            result[column] = _np.zeros(len(rows))
+    return result
+
+# columns needed by all and by each type of element
+_COMMONCOLUMNS  = ['L', 'TILT', 'K1L']
+_DIPOLECOLUMNS  = ['ANGLE', 'E1', 'E2', 'FINT', 'FINTX', 'HGAP', 'H1', 'H2']
+_GROUPCOLUMNS   = {'SEXTUPOLE' : ['K2L'],
+                   'OCTUPOLE'  : ['K3L'],
+                   'SOLENOID'  : ['KSI'],
+                   'SBEND'     : _DIPOLECOLUMNS,
+                   'RBEND'     : _DIPOLECOLUMNS,
+                   'MULTIPOLE' : _KNL + _KSL,
+                   'HKICKER'   : ['HKICK'],
+                   'VKICKER'   : ['VKICK'],
+                   'TKICKER'   : ['VKICK', 'HKICK']}
+
+def TfsToMachine(inputfile, startname=None, stopname=None, ignorezerolengthitems=True):
+    """
+    Convert the rows startname to stopname (names or indices, stop excluded) of
+    a Tfs instance or file containing the full twiss output from MADX to a
+    pymadx.Builder.Machine for PTC. Returns the Machine.
+
+    The elements are grouped by KEYWORD and only the columns each type needs
+    are converted to arrays, so the strengths and other parameters of all the
+    elements of a type are calculated at once. Element types that aren't
+    known are replaced by drifts. The strengths of zero length elements (only
+    kept if ignorezerolengthitems is False) are not set as they are undefined.
+    """
+    madx = _Data.CheckItsTfs(inputfile)
+    _CheckColumns(madx)
+    return _TfsToMachine(madx, startname, stopname, ignorezerolengthitems)
+
+def _TfsToMachine(madx, startname, stopname, ignorezerolengthitems):
+    """
+    TfsToMachine for a Tfs instance whose columns have already been checked.
+    """
+    startindex, stopindex = _StartStopIndices(madx, startname, stopname)
+
+    names  = madx.sequence[startindex:stopindex]
+    rows   = [madx.data[name] for name in names]
+    lindex = madx.ColumnIndex('L')
+    if ignorezerolengthitems:
+        #skip zero length items before anything else is converted
+        keep  = [i for i,row in enumerate(rows) if row[lindex] >= 1e-9]
+        names = [names[i] for i in keep]
+        rows  = [rows[i] for i in keep]
+
+    rnames = _ReducedNames(names)
+    tindex = madx.ColumnIndex('KEYWORD')
+    groups = {}
+    for i,row in enumerate(rows):
+        groups.setdefault(row[tindex], []).append(i)
+
+    a = _Builder.Machine()
+
+    def Thick(method):
+        def Convert(idx, d, kws):
+            return [(method, (rnames[i], l), kw) for i,l,kw in _zip(idx, d['L'].tolist(), kws)]
+        return Convert
+
+    def Strength(key, column, method):
+        def Convert(idx, d, kws):
+            for kw,k in _zip(kws, _Divide(d[column], d['L'])):
+                if k is not None:
+                    kw[key] = k
+            return Thick(method)(idx, d, kws)
+        return Convert
+
+    def Dipole(kw, fintx, h1, h2, hgap):
+        # in madx, -1 means fintx was allowed to default to fint and we should do the same
+        # so if set to 0, this means we want it to be 0
+        if fintx != -1:
+            kw['fintx'] = fintx
+        if h1 != 0:
+            kw['h1'] = h1
+        if h2 != 0:
+            kw['h2'] = h2
+        if hgap != 0:
+            kw['hgap'] = hgap
+
+    def SBend(idx, d, kws):
+        result = []
+        for i,kw,l,angle,e1,e2,fint,fintx,h1,h2,hgap in _zip(idx, kws, *[d[c].tolist() for c in
+                ['L', 'ANGLE', 'E1', 'E2', 'FINT', 'FINTX', 'H1', 'H2', 'HGAP']]):
+            kw['e1']   = e1
+            kw['fint'] = fint
+            kw['e2']   = e2
+            Dipole(kw, fintx, h1, h2, hgap)
+            result.append((a.AddDipole, (rnames[i], 'sbend', l, angle), kw))
+        return result
+
+    def RBend(idx, d, kws):
+        # set element length to be the chord length - tfs output rbend
+        # length is arc length - protect against 0 angle rbends
+        l, angle = d['L'], d['ANGLE']
+        chord    = list(_np.where(angle != 0, 2 * (l / _np.where(angle != 0, angle, 1)) * _np.sin(angle / 2.), l))
+        # subtract dipole angle/2 added on to poleface angles internally by madx
+        polein   = (d['E1'] - 0.5 * angle).tolist()
+        poleout  = (d['E2'] - 0.5 * angle).tolist()
+        result = []
+        for i,kw,l,length,angle,e1,e2,fint,fintx,h1,h2,hgap in _zip(idx, kws, l.tolist(), chord, angle.tolist(),
+                polein, poleout, *[d[c].tolist() for c in ['FINT', 'FINTX', 'H1', 'H2', 'HGAP']]):
+            if e1 != 0:
+                kw['e1'] = e1
+            if e2 != 0:
+                kw['e2'] = e2
             if fint != 0:
-                kws['fint'] = fint
-            # in madx, -1 means fintx was allowed to default to fint and we should do the same
-            # so if set to 0, this means we want it to be 0
-            if fintx != -1:
-                kws['fintx'] = fintx
-
-            if h1 != 0:
-                kws['h1'] = h1
-            if h2 != 0:
-                kws['h2'] = h2
-            if hgap != 0:
-                kws['hgap'] = hgap
-
-            a.AddDipole(rname,category='rbend',length=chordLength,angle=angle,**kws)
-
-        elif t == 'MARKER':
-            angle = madx.data[name][angleindex]
-            a.AddMarker(rname, **kws)
-
-        elif t == 'MULTIPOLE':
-            kn0l  = madx.data[name][k0lindex]
-            kn1l  = madx.data[name][k1lindex]
-            kn2l  = madx.data[name][k2lindex]
-            kn3l  = madx.data[name][k3lindex]
-            kn4l  = madx.data[name][k4lindex]
-            kn5l  = madx.data[name][k5lindex]
-            kn6l  = madx.data[name][k6lindex]
-            kn0sl = madx.data[name][k0slindex]
-            kn1sl = madx.data[name][k1slindex]
-            kn2sl = madx.data[name][k2slindex]
-            kn3sl = madx.data[name][k3slindex]
-            kn4sl = madx.data[name][k4slindex]
-            kn5sl = madx.data[name][k5slindex]
-            kn6sl = madx.data[name][k6slindex]
-
-            a.AddMultipole(
-                rname,
-                knl=(kn0l, kn1l, kn2l, kn3l, kn4l, kn5l, kn6l),
-                ksl=(kn0sl, kn1sl, kn2sl, kn3sl, kn4sl, kn5sl, kn6sl),
-                **kws)
-        elif t == 'HKICKER':
-            hkick = madx.data[name][hkickangleindex]
-            a.AddHKicker(rname, hkick=hkick, length=l)
-        elif t == 'VKICKER':
-            vkick = madx.data[name][vkickangleindex]
-            a.AddVKicker(rname, vkick=vkick, length=l)
-        elif t == 'TKICKER':
-            vkick = madx.data[name][vkickangleindex]
-            hkick = madx.data[name][hkickangleindex]
-            a.AddTKicker(rname, vkick=vkick, hkick=hkick, length=l)
+                kw['fint'] = fint
+            Dipole(kw, fintx, h1, h2, hgap)
+            result.append((a.AddDipole, (rnames[i], 'rbend', length if angle != 0 else l, angle), kw))
+        return result
+
+    def Marker(idx, d, kws):
+        return [(a.AddMarker, (rnames[i],), kw) for i,kw in _zip(idx, kws)]
+
+    def Multipole(idx, d, kws):
+        knl = _zip(*[d[c].tolist() for c in _KNL])
+        ksl = _zip(*[d[c].tolist() for c in _KSL])
+        return [(a.AddMultipole, (rnames[i], kn, ks), kw) for i,kn,ks,kw in _zip(idx, knl, ksl, kws)]
+
+    def Kicker(method, columns):
+        # kickers don't take tilt or k1
+        def Convert(idx, d, kws):
+            values = _zip(*[d[c].tolist() for c in columns])
+            return [(method, (rnames[i],) + v, {}) for i,v in _zip(idx, values)]
+        return Convert
+
+    converters = {
+        'DRIFT'      : Thick(a.AddDrift),
+        'QUADRUPOLE' : Thick(a.AddQuadrupole),
+        'SEXTUPOLE'  : Strength('k2', 'K2L', a.AddSextupole),
+        'OCTUPOLE'   : Strength('k3', 'K3L', a.AddOctupole),
+        'SOLENOID'   : Strength('ks', 'KSI', a.AddSolenoid),
+        'SBEND'      : SBend,
+        'RBEND'      : RBend,
+        'MARKER'     : Marker,
+        'MULTIPOLE'  : Multipole,
+        'HKICKER'    : Kicker(a.AddHKicker, ['HKICK', 'L']),
+        'VKICKER'    : Kicker(a.AddVKicker, ['VKICK', 'L']),
+        'TKICKER'    : Kicker(a.AddTKicker, ['VKICK', 'HKICK', 'L']),
+        }
+
+    # prepare all the elements of each type then construct the machine in order
+    elements = [None]*len(rows)
+    for t,idx in groups.items():
+        d   = _GroupColumns(madx, [rows[i] for i in idx], _COMMONCOLUMNS + _GROUPCOLUMNS.get(t, []))
+        kws = [{} for i in idx] # element-specific keywords
+        for kw,tilt in _zip(kws, d['TILT'].tolist()):
+            if tilt != 0:
+                kw['tilt'] = tilt
+        for kw,k1l,k1 in _zip(kws, d['K1L'].tolist(), _Divide(d['K1L'], d['L'])):
+            if k1l and k1 is not None:
+                kw['k1'] = k1
+        if t in converters:
+            converted = converters[t](idx, d, kws)
         else:
-            print('MadxTfs2Ptc> unknown element type: ',t,' for element named: ',name
-            if not zerolength:
-                print('MadxTfs2Ptc> replacing with drift')
-                a.AddDrift(rname,l)
-            else:
-                pass
-    if ptctype == 'ptctrack':
-        a.AddSampler(samplers)
-        a.AddPTCTrackAperture(ptctrackaperture)
-    # Make beam file 
-    if beam:
-        if ptctype == 'ptctrack':
-            b = MadxTfsToPtcBeam(madx, ptcfilename, startname)
-            a.AddBeam(b)
-        if ptctype == 'ptctwiss':
-            b = MadxTfsToPtcTwissBeam(madx, startname)
-            a.AddBeam(b)
-    a.Write(outputfilename)
-
+            converted = []
+            for i,l in _zip(idx, d['L'].tolist()):
+                print('MadxTfs2Ptc> unknown element type: ',t,' for element named: ',names[i])
+                if l >= 1e-9:
+                    print('MadxTfs2Ptc> replacing with drift')
+                    converted.append((a.AddDrift, (rnames[i], l), {}))
+                else:
+                    converted.append(None)
+        for i,element in _zip(idx, converted):
+            elements[i] = element
+
+    for element in elements:
+        if element is not None:
+            method, args, kws = element
+            method(*args, **kws)
     return a
 
 def MadxTfsToPtcBeam(tfs, ptcfilename,  startname=None):
@@ -5,10 +5,12 @@ See individual methods for documentation
 
 """
 
-from _Mad8ToMadx import Mad8ToMadx
-from _TfsToPtc import TfsToPtc
-from _TfsToPtc import TfsToPtcTwiss
+from ._Mad8ToMadx import Mad8ToMadx
+from ._TfsToPtc import TfsToMachine
+from ._TfsToPtc import TfsToPtc
+from ._TfsToPtc import TfsToPtcBatch
+from ._TfsToPtc import TfsToPtcTwiss
 try:
-    from _Transport2Madx import Transport2Madx
+    from ._Transport2Madx import Transport2Madx
 except ImportError:
-    print "No pytransport functionality"
+    print("No pytransport functionality")
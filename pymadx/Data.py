@@ -10,6 +10,7 @@ import re as _re
 import string as _string
 import tarfile as _tarfile
 import os.path as _path
+import weakref as _weakref
 
 from ._General import Cast as _Cast
 
@@ -73,12 +74,35 @@ class Tfs(object):
         self.smin        = 0
         self.ptctwiss    = False # whether data was generated via ptctwiss
         self._verbose    = False
+        self._listeners  = _weakref.WeakSet() # notified of EditComponent, e.g. Optics.LinearOptics
 
         if isinstance(filename, str):
             self.Load(filename, verbose=verbose)
         elif isinstance(filename, Tfs):
             self._DeepCopy(filename)
 
+    def __getstate__(self):
+        # listeners (e.g. Optics.LinearOptics) aren't part of the data
+        state = self.__dict__.copy()
+        state.pop('_listeners', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._listeners = _weakref.WeakSet()
+
+    def _AddListener(self, listener):
+        """
+        Notify listener.ComponentEdited(index, variable) of EditComponent. Only
+        a weak reference to the listener is kept.
+        """
+        if not hasattr(self, '_listeners'):
+            self._listeners = _weakref.WeakSet()
+        self._listeners.add(listener)
+
+    def _RemoveListener(self, listener):
+        getattr(self, '_listeners', set()).discard(listener)
+
     def Clear(self):
         """
         Empties all data structures in this instance.
@@ -661,10 +685,15 @@ class Tfs(object):
         only take indices as every single element in the sequence has
         a unique definition, and components which may appear
         degenerate/reused are in fact not in this data model.
+
+        Any pymadx.Optics.LinearOptics instance attached to this instance
+        is updated incrementally.
         """
         variableIndex = self.columns.index(variable)
         componentName = self.sequence[index]
         self.data[componentName][variableIndex] = value
+        for listener in list(getattr(self, '_listeners', ())):
+            listener.ComponentEdited(index, variable)
 
     def InterrogateItem(self,itemname):
         """
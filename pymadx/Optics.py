@@ -0,0 +1,869 @@
+"""
+Linear optics calculated directly from the element data in a Tfs instance.
+
+Transfer matrices are built for every element from the element columns
+(L, K1L, ANGLE, E1, E2, FINT, FINTX, HGAP, TILT and KSI) and are used to
+reconstruct the optical functions at arbitrary S positions, including inside
+elements, or to recompute the optics along the whole line after the element
+strengths have been changed (for example with Tfs.EditComponent) without
+running MADX again. The LinearOptics class keeps the accumulated matrices
+cached so that only the edited part of the line is recalculated.
+
+Coordinates follow the MADX convention (x, px, y, py, t, pt) and all
+matrices are 6x6.
+
+"""
+
+import numpy as _np
+
+from . import Data as _Data
+
+def _RelativisticFactors(tfs):
+    """
+    Return the relativistic beta and 1/(beta*gamma)^2 for the beam in the
+    header of a Tfs instance. An ultra-relativistic beam is assumed if there
+    is no GAMMA in the header.
+    """
+    try:
+        gamma = float(tfs.header['GAMMA'])
+    except (KeyError, TypeError, ValueError):
+        return 1.0, 0.0
+    beta = _np.sqrt(1.0 - 1.0/gamma**2)
+    return beta, 1.0/(beta*gamma)**2
+
+def _ColumnOrZeros(tfs, columnname):
+    """
+    Return a column as a float array or zeros if the column isn't present.
+    """
+    if columnname in tfs.columns:
+        return tfs.GetColumn(columnname).astype(float)
+    return _np.zeros(len(tfs))
+
+def _Trig(k, l):
+    """
+    Principal trajectory functions for a focusing strength k over length l.
+
+    returns C, S, D, F where D = (1-C)/k and F = (l-S)/k
+
+    A Taylor expansion is used for very weak focusing to avoid cancellation.
+    """
+    k   = _np.asarray(k, dtype=float)
+    l   = _np.asarray(l, dtype=float)
+    kl2 = k*l*l
+    small = _np.abs(kl2) < 1e-8
+    sqk   = _np.sqrt(_np.abs(k))
+    sqk   = _np.where(sqk == 0, 1.0, sqk)
+    phi   = sqk*l
+    with _np.errstate(over='ignore', invalid='ignore'):
+        c = _np.where(k > 0, _np.cos(phi), _np.cosh(phi))
+        s = _np.where(k > 0, _np.sin(phi), _np.sinh(phi)) / sqk
+        ksafe = _np.where(small, 1.0, k)
+        d = (1.0 - c) / ksafe
+        f = (l - s) / ksafe
+    c = _np.where(small, 1.0 - 0.5*kl2, c)
+    s = _np.where(small, l - k*l**3/6.0, s)
+    d = _np.where(small, 0.5*l**2 - k*l**4/24.0, d)
+    f = _np.where(small, l**3/6.0 - k*l**5/120.0, f)
+    return c, s, d, f
+
+def BodyMatrices(l, k1l, angle, beta=1.0, igamma2=0.0, length=None):
+    """
+    Return an (N,6,6) array of transfer matrices for the body of drifts,
+    quadrupoles and sector dipoles (including combined function dipoles).
+
+    l       - element lengths (array)
+    k1l     - integrated quadrupole strengths (array)
+    angle   - bending angles (array)
+    beta    - relativistic beta of the beam
+    igamma2 - 1/(beta*gamma)^2 of the beam (0 for ultra-relativistic)
+    length  - optional partial lengths to evaluate the matrix over instead of
+              the full element length (for positions inside the element)
+
+    Zero length elements are treated as thin lenses.
+    """
+    l     = _np.atleast_1d(_np.asarray(l, dtype=float))
+    k1l   = _np.atleast_1d(_np.asarray(k1l, dtype=float))
+    angle = _np.atleast_1d(_np.asarray(angle, dtype=float))
+    if length is None:
+        length = l
+    length = _np.atleast_1d(_np.asarray(length, dtype=float))
+
+    thin  = l <= 0
+    lsafe = _np.where(thin, 1.0, l)
+    k1    = _np.where(thin, 0.0, k1l / lsafe)
+    h     = _np.where(thin, 0.0, angle / lsafe)
+    ll    = _np.where(thin, 0.0, length)
+
+    kx = k1 + h**2
+    ky = -k1
+    cx, sx, dx, fx = _Trig(kx, ll)
+    cy, sy, _,  _  = _Trig(ky, ll)
+
+    m = _np.zeros((len(l), 6, 6))
+    m[:,0,0] = cx
+    m[:,0,1] = sx
+    m[:,1,0] = -kx*sx
+    m[:,1,1] = cx
+    m[:,0,5] = h*dx / beta
+    m[:,1,5] = h*sx / beta
+    m[:,2,2] = cy
+    m[:,2,3] = sy
+    m[:,3,2] = -ky*sy
+    m[:,3,3] = cy
+    m[:,4,0] = -h*sx / beta
+    m[:,4,1] = -h*dx / beta
+    m[:,4,4] = 1.0
+    m[:,4,5] = ll*igamma2 - h**2*fx / beta**2
+    m[:,5,5] = 1.0
+
+    # thin lenses - a thin dipole kick also generates dispersion
+    m[thin,1,0] = -k1l[thin]
+    m[thin,3,2] =  k1l[thin]
+    m[thin,1,5] =  angle[thin] / beta
+    m[thin,4,0] = -angle[thin] / beta
+    return m
+
+def _SolenoidBlocks(ksi, l, length):
+    """
+    Return an (N,4,4) array of the transverse coupling matrices for solenoids
+    with integrated strength ksi and length l over the (partial) length.
+    """
+    k = 0.5 * ksi / l
+    c = _np.cos(k*length)
+    s = _np.sin(k*length)
+    sk = length * _np.sinc(k*length/_np.pi) # sin(kl)/k without division by 0
+    m = _np.zeros((len(l), 4, 4))
+    m[:,0,0] = m[:,1,1] = m[:,2,2] = m[:,3,3] = c*c
+    m[:,0,1] = m[:,2,3] = c*sk
+    m[:,0,2] = m[:,1,3] = s*c
+    m[:,2,0] = m[:,3,1] = -s*c
+    m[:,0,3] = s*sk
+    m[:,2,1] = -s*sk
+    m[:,1,0] = m[:,3,2] = -k*s*c
+    m[:,1,2] = -k*s*s
+    m[:,3,0] = k*s*s
+    return m
+
+def _EdgeMatrices(h, e, fint, hgap):
+    """
+    Return an (N,6,6) array of dipole pole face matrices including the
+    vertical fringe field correction.
+    """
+    psi = 2.0*fint*hgap*h*(1.0 + _np.sin(e)**2) / _np.cos(e)
+    m = _np.zeros((len(h), 6, 6))
+    m[:] = _np.identity(6)
+    m[:,1,0] =  h*_np.tan(e)
+    m[:,3,2] = -h*_np.tan(e - psi)
+    return m
+
+def _TiltMatrices(tilt):
+    """
+    Return an (N,6,6) array of rotations into the frame of tilted elements.
+    """
+    c = _np.cos(tilt)
+    s = _np.sin(tilt)
+    m = _np.zeros((len(tilt), 6, 6))
+    for i in (0, 1):
+        m[:,i,i]     = c
+        m[:,i,i+2]   = s
+        m[:,i+2,i]   = -s
+        m[:,i+2,i+2] = c
+    m[:,4,4] = 1.0
+    m[:,5,5] = 1.0
+    return m
+
+_ELEMENTCOLUMNS = ['L', 'K1L', 'ANGLE', 'E1', 'E2', 'FINT', 'FINTX', 'HGAP', 'TILT', 'KSI']
+
+def ElementData(tfsfile):
+    """
+    Return a dictionary of float arrays of the columns required to build
+    the element transfer matrices. Missing columns are filled with zeros.
+    """
+    tfs = _Data.CheckItsTfs(tfsfile)
+    data = dict((key, _ColumnOrZeros(tfs, key)) for key in _ELEMENTCOLUMNS)
+    if 'FINTX' not in tfs.columns:
+        data['FINTX'][:] = -1 # as in MADX, -1 means the same as FINT
+    return data
+
+def Matrices(data, beta=1.0, igamma2=0.0, length=None):
+    """
+    Return an (N,6,6) array of transfer matrices for the elements described
+    by a dictionary of arrays as returned by ElementData.
+
+    beta    - relativistic beta of the beam
+    igamma2 - 1/(beta*gamma)^2 of the beam (0 for ultra-relativistic)
+    length  - optional partial lengths to evaluate the matrices over instead
+              of the full element lengths. In this case only the entrance pole
+              face is included for dipoles.
+    """
+    return _Matrices(data, beta, igamma2, length, True, length is None)
+
+def _Matrices(data, beta, igamma2, length, entrance, exit):
+    """
+    Matrices with the choice of including the entrance and exit pole faces
+    of dipoles.
+    """
+    l = data['L']
+    m = BodyMatrices(l, data['K1L'], data['ANGLE'], beta, igamma2, length)
+    if length is None:
+        length = l
+
+    sol = (data['KSI'] != 0) & (l > 0)
+    if sol.any():
+        m[sol,:4,:4] = _SolenoidBlocks(data['KSI'][sol], l[sol], length[sol])
+
+    bend = (data['ANGLE'] != 0) & (l > 0)
+    entr = bend & (length > 0) & ((data['E1'] != 0) | (data['FINT'] != 0))
+    if entr.any() and entrance:
+        h = data['ANGLE'][entr] / l[entr]
+        e = _EdgeMatrices(h, data['E1'][entr], data['FINT'][entr], data['HGAP'][entr])
+        m[entr] = _np.matmul(m[entr], e)
+    fintx = _np.where(data['FINTX'] < 0, data['FINT'], data['FINTX'])
+    exitface = bend & ((data['E2'] != 0) | (fintx != 0))
+    if exitface.any() and exit:
+        h = data['ANGLE'][exitface] / l[exitface]
+        e = _EdgeMatrices(h, data['E2'][exitface], fintx[exitface], data['HGAP'][exitface])
+        m[exitface] = _np.matmul(e, m[exitface])
+
+    tilted = data['TILT'] != 0
+    if tilted.any():
+        r = _TiltMatrices(data['TILT'][tilted])
+        m[tilted] = _np.matmul(_np.transpose(r, (0,2,1)), _np.matmul(m[tilted], r))
+    return m
+
+def ElementMatrices(tfsfile):
+    """
+    Return an (N,6,6) array with the transfer matrix of every element in
+    the sequence of a Tfs instance (or file name).
+    """
+    tfs = _Data.CheckItsTfs(tfsfile)
+    beta, igamma2 = _RelativisticFactors(tfs)
+    return Matrices(ElementData(tfs), beta, igamma2)
+
+def CumulativeMatrices(m):
+    """
+    Return the (N,6,6) array of accumulated transfer matrices from the start
+    of the line to the end of each element, i.e. M[i] x ... x M[0].
+
+    This is a parallel prefix product so there are only log2(N) batched
+    matrix multiplications rather than N individual ones.
+    """
+    p = _np.array(m, dtype=float)
+    step = 1
+    while step < len(p):
+        p[step:] = _np.matmul(p[step:], p[:-step])
+        step *= 2
+    return p
+
+def PropagateTwiss(m, betx, alfx, bety, alfy, dx=0.0, dpx=0.0, dy=0.0, dpy=0.0):
+    """
+    Propagate Twiss parameters and dispersion through an (N,6,6) array of
+    matrices. The Twiss parameters may be scalars or arrays of length N.
+
+    returns a dictionary of arrays with the keys BETX, ALFX, BETY, ALFY,
+    DX, DPX, DY and DPY.
+    """
+    m    = _np.asarray(m)
+    gamx = (1.0 + alfx**2) / betx
+    gamy = (1.0 + alfy**2) / bety
+
+    def Plane(i, b, a, g):
+        c, s   = m[:,i,i],   m[:,i,i+1]
+        cp, sp = m[:,i+1,i], m[:,i+1,i+1]
+        beta  = c*c*b - 2.0*c*s*a + s*s*g
+        alpha = -c*cp*b + (c*sp + s*cp)*a - s*sp*g
+        return beta, alpha
+
+    d = {}
+    d['BETX'], d['ALFX'] = Plane(0, betx, alfx, gamx)
+    d['BETY'], d['ALFY'] = Plane(2, bety, alfy, gamy)
+
+    n   = m.shape[0]
+    eta = _np.zeros((n, 6))
+    eta[:,0] = dx
+    eta[:,1] = dpx
+    eta[:,2] = dy
+    eta[:,3] = dpy
+    eta[:,5] = 1.0
+    etaout = _np.einsum('nij,nj->ni', m, eta)
+    d['DX']  = etaout[:,0]
+    d['DPX'] = etaout[:,1]
+    d['DY']  = etaout[:,2]
+    d['DPY'] = etaout[:,3]
+    return d
+
+def _BeamSizes(tfs, d, beta):
+    """
+    Add SIGMAX and SIGMAY to the dictionary d of optical functions using
+    the emittance and energy spread in the header in the same way as Tfs.
+    """
+    h = tfs.header
+    if {'SIGE', 'EX', 'EY'}.issubset(h):
+        ex, ey, sige = h['EX'], h['EY'], h['SIGE']
+    elif {'EXN', 'EYN', 'GAMMA'}.issubset(h):
+        ex, ey, sige = h['EXN']*h['GAMMA'], h['EYN']*h['GAMMA'], 0
+    else:
+        return
+    if tfs.ptctwiss:
+        dxbeta, dybeta = d['DX'], d['DY']
+    else:
+        dxbeta, dybeta = d['DX']*beta, d['DY']*beta
+    d['SIGMAX'] = _np.sqrt(d['BETX']*ex + (dxbeta*sige/beta**2)**2)
+    d['SIGMAY'] = _np.sqrt(d['BETY']*ey + (dybeta*sige/beta**2)**2)
+
+_TWISSKEYS = ['BETX', 'ALFX', 'BETY', 'ALFY', 'DX', 'DPX', 'DY', 'DPY']
+
+def _EntranceTwiss(tfs, m):
+    """
+    Return the Twiss parameters at the entrance of every element as a
+    dictionary of arrays. These are the values of the previous row and for
+    the first element they are propagated back through its matrix.
+    """
+    exit = dict((key, _ColumnOrZeros(tfs, key)) for key in _TWISSKEYS)
+    first = PropagateTwiss(_np.linalg.inv(m[:1]), *[exit[key][:1] for key in _TWISSKEYS])
+    entrance = {}
+    for key in _TWISSKEYS:
+        entrance[key] = _np.concatenate([first[key], exit[key][:-1]])
+    return entrance
+
+def Interpolate(tfsfile, s):
+    """
+    Return the optical functions at arbitrary S positions, including inside
+    drifts, quadrupoles, dipoles and solenoids, reconstructed from the element
+    transfer matrices. The Tfs instance must contain BETX, ALFX, BETY, ALFY, S and L.
+
+    tfsfile - Tfs instance or file name
+    s       - S position or array of S positions
+
+    returns a dictionary of arrays with the keys S, BETX, ALFX, BETY, ALFY,
+    DX, DPX, DY, DPY and, if the emittance is in the header, SIGMAX and SIGMAY.
+
+    >>> d = Interpolate(tfs, numpy.linspace(0, tfs.smax, 5000))
+    >>> plot(d['S'], d['BETX'])
+    """
+    tfs = _Data.CheckItsTfs(tfsfile)
+    s   = _np.atleast_1d(_np.asarray(s, dtype=float))
+    beta, igamma2 = _RelativisticFactors(tfs)
+
+    data  = ElementData(tfs)
+    l     = data['L']
+    send  = tfs.GetColumn('S').astype(float)
+    m     = Matrices(data, beta, igamma2)
+    entrance = _EntranceTwiss(tfs, m)
+
+    # element containing each point - MADX S is at the end of the element so
+    # a point at an element boundary is after all the elements ending there
+    index = _np.searchsorted(send, s, side='right')
+    index = _np.clip(index, 0, len(send) - 1)
+    ds    = _np.clip(s - (send[index] - l[index]), 0, l[index])
+    ds[ds < 1e-6] = 0 # limited precision of S in the file at element entrances
+
+    subset = dict((key, value[index]) for key, value in data.items())
+    mpart  = Matrices(subset, beta, igamma2, ds)
+    mpart[(l[index] <= 0) & (s < send[index])] = _np.identity(6)
+    d = PropagateTwiss(mpart, *[entrance[key][index] for key in _TWISSKEYS])
+    d['S'] = s
+    _BeamSizes(tfs, d, beta)
+    return d
+
+def InterpolationPositions(tfsfile, npoints=2000):
+    """
+    Return a sorted array of S positions that includes the end of every
+    element and approximately npoints evenly spaced points along the line.
+    """
+    tfs   = _Data.CheckItsTfs(tfsfile)
+    send  = tfs.GetColumn('S').astype(float)
+    start = send[0] - _ColumnOrZeros(tfs, 'L')[0]
+    return _np.union1d(send, _np.linspace(start, send[-1], npoints))
+
+def _PeriodicTwiss(r):
+    """
+    Return the periodic Twiss parameters and dispersion for a one turn
+    matrix r as a list in the order of PropagateTwiss arguments.
+    """
+    result = []
+    for i in (0, 2):
+        cosmu = 0.5*(r[i,i] + r[i+1,i+1])
+        if abs(cosmu) >= 1:
+            raise ValueError("No stable periodic solution - unstable motion in plane " + str(i//2 + 1))
+        sinmu = _np.sign(r[i,i+1]) * _np.sqrt(1.0 - cosmu**2)
+        result.append(r[i,i+1] / sinmu)
+        result.append(0.5*(r[i,i] - r[i+1,i+1]) / sinmu)
+    eta = _np.linalg.solve(_np.identity(4) - r[:4,:4], r[:4,5])
+    return result + list(eta)
+
+def TwissFromMatrices(m, p, betx, alfx, bety, alfy, dx=0.0, dpx=0.0, dy=0.0, dpy=0.0):
+    """
+    Calculate the optical functions at the end of each element given the
+    (N,6,6) element matrices m, their accumulated products p and the
+    initial conditions.
+
+    returns a dictionary of arrays with the keys BETX, ALFX, MUX, BETY, ALFY,
+    MUY, DX, DPX, DY and DPY. MUX and MUY are in units of 2 pi as in MADX.
+    """
+    d = PropagateTwiss(p, betx, alfx, bety, alfy, dx, dpx, dy, dpy)
+    # phase advance of each element from the Twiss parameters at its entrance
+    for plane, i in (('X', 0), ('Y', 2)):
+        b0 = _np.concatenate([[betx if i == 0 else bety], d['BET'+plane][:-1]])
+        a0 = _np.concatenate([[alfx if i == 0 else alfy], d['ALF'+plane][:-1]])
+        dmu = _np.arctan2(m[:,i,i+1], m[:,i,i]*b0 - m[:,i,i+1]*a0)
+        d['MU'+plane] = _np.cumsum(_np.mod(dmu, 2*_np.pi)) / (2*_np.pi)
+    return d
+
+def Twiss(tfsfile, betx=None, alfx=None, bety=None, alfy=None,
+          dx=None, dpx=None, dy=None, dpy=None, periodic=False):
+    """
+    Recalculate the linear optics along the line of a Tfs instance from the
+    element data alone.
+
+    tfsfile  - Tfs instance or file name
+    betx etc - initial conditions at the start of the line. Any not given are
+               taken from the Tfs instance at the start of the first element.
+    periodic - if True, use the periodic solution of the one turn matrix as
+               the initial conditions instead (for rings).
+
+    returns a dictionary of arrays with the keys S, BETX, ALFX, MUX, BETY, ALFY,
+    MUY, DX, DPX, DY, DPY and, if the emittance is in the header, SIGMAX and
+    SIGMAY.
+
+    This is typically used to see the effect of changing element strengths:
+
+    >>> t = pymadx.Data.Tfs("twiss.tfs")
+    >>> t.EditComponent(12, 'K1L', 0.35)
+    >>> d = pymadx.Optics.Twiss(t)
+    >>> plot(d['S'], d['BETX'])
+    """
+    tfs = _Data.CheckItsTfs(tfsfile)
+    beta, igamma2 = _RelativisticFactors(tfs)
+    m = Matrices(ElementData(tfs), beta, igamma2)
+    p = CumulativeMatrices(m)
+
+    given  = [betx, alfx, bety, alfy, dx, dpx, dy, dpy]
+    if periodic:
+        initial = _PeriodicTwiss(p[-1])
+    else:
+        entrance = _EntranceTwiss(tfs, m)
+        initial  = [entrance[key][0] for key in _TWISSKEYS]
+    initial = [i if g is None else g for i, g in zip(initial, given)]
+
+    d = TwissFromMatrices(m, p, *initial)
+    d['S'] = tfs.GetColumn('S').astype(float)
+    _BeamSizes(tfs, d, beta)
+    return d
+
+class _MatrixTree(object):
+    """
+    Segment tree of accumulated transfer matrices. Each node holds the
+    product of the matrices of the elements below it so that any element
+    can be replaced and the product over any range of elements found with
+    O(log N) matrix multiplications.
+    """
+    def __init__(self, m):
+        self.n    = len(m)
+        self.size = 1
+        while self.size < self.n:
+            self.size *= 2
+        self.nodes = _np.zeros((2*self.size, 6, 6))
+        self.nodes[:] = _np.identity(6)
+        self.nodes[self.size:self.size+self.n] = m
+        # build a level at a time - later elements multiply from the left
+        lo = self.size // 2
+        while lo >= 1:
+            hi = 2*lo
+            self.nodes[lo:hi] = _np.matmul(self.nodes[2*lo+1:2*hi:2], self.nodes[2*lo:2*hi:2])
+            lo //= 2
+
+    def Update(self, index, matrix):
+        """
+        Replace the matrix of element index and update its parent nodes.
+        """
+        i = self.size + index
+        self.nodes[i] = matrix
+        i //= 2
+        while i >= 1:
+            self.nodes[i] = _np.dot(self.nodes[2*i+1], self.nodes[2*i])
+            i //= 2
+
+    def Product(self, start, stop):
+        """
+        Return the product of the matrices of elements start to stop - 1,
+        i.e. M[stop-1] x ... x M[start].
+        """
+        left  = _np.identity(6)
+        right = _np.identity(6)
+        lo = start + self.size
+        hi = stop + self.size
+        while lo < hi:
+            if lo & 1:
+                left = _np.dot(self.nodes[lo], left)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                right = _np.dot(right, self.nodes[hi])
+            lo //= 2
+            hi //= 2
+        return _np.dot(right, left)
+
+    def Prefix(self, index):
+        """
+        Return the accumulated matrix from the start to the end of element index.
+        """
+        return self.Product(0, index + 1)
+
+class LinearOptics(object):
+    """
+    Linear optics of a Tfs instance that is kept up to date incrementally.
+
+    The element matrices are held in a segment tree along with the cached
+    accumulated matrices to the end of each element. When an element of
+    the Tfs instance is changed with Tfs.EditComponent, only that element
+    matrix and O(log N) nodes of the tree are recalculated and the
+    accumulated matrices downstream are corrected with a single batched
+    matrix multiplication rather than propagating again from the start.
+    Twiss and UpdateTfs then only recalculate the optics downstream of the
+    first edited element (the whole line if periodic).
+
+    The Tfs instance only keeps a weak reference to this instance.
+
+    >>> t = pymadx.Data.Tfs("twiss.tfs")
+    >>> o = pymadx.Optics.LinearOptics(t)
+    >>> t.EditComponent(12, 'K1L', 0.35)
+    >>> d = o.Twiss()
+    >>> o.UpdateTfs() # write the new optics into the Tfs instance
+
+    tfsfile  - Tfs instance or file name
+    periodic - use the periodic solution as the initial conditions
+    initial  - optional initial conditions as keyword arguments with the
+               same names as Twiss (betx, alfx, etc.)
+    """
+    def __init__(self, tfsfile, periodic=False, **initial):
+        self.tfs      = _Data.CheckItsTfs(tfsfile)
+        self.periodic = periodic
+        self._given   = initial
+        self.tfs._AddListener(self)
+        self._Build()
+
+    def __repr__(self):
+        return "<{}.{}, {} elements>".format(__name__, type(self).__name__, self._n)
+
+    def _Build(self):
+        tfs = self.tfs
+        self._n = len(tfs)
+        self._beta, self._igamma2 = _RelativisticFactors(tfs)
+        self._data  = ElementData(tfs)
+        self._m     = Matrices(self._data, self._beta, self._igamma2)
+        self._tree  = _MatrixTree(self._m)
+        self._p     = CumulativeMatrices(self._m)
+        self._twiss = None
+        self._twissfrom    = 0 # first row of the cached optics that is out of date
+        self._firstchanged = 0 # first row of the Tfs instance that is out of date
+        entrance = _EntranceTwiss(tfs, self._m)
+        self._entrance = [entrance[key][0] for key in _TWISSKEYS]
+
+    def Detach(self):
+        """
+        Stop following edits of the Tfs instance.
+        """
+        self.tfs._RemoveListener(self)
+
+    def ComponentEdited(self, index, variable):
+        """
+        Update the optics for a change of variable of element index. This
+        is called automatically by Tfs.EditComponent.
+        """
+        if len(self.tfs) != self._n:
+            self._Build() # the sequence itself has changed
+            return
+        if variable not in self._data:
+            return
+        self._data[variable][index] = float(self.tfs.data[self.tfs.sequence[index]][self.tfs.ColumnIndex(variable)])
+        element = dict((key, value[index:index+1]) for key, value in self._data.items())
+        mnew = Matrices(element, self._beta, self._igamma2)[0]
+
+        # P'[k] = M[k]...M'[i]P[i-1] = P[k] x inv(P[i]) x M'[i] x P[i-1] for k >= i
+        before = self._tree.Prefix(index - 1) if index > 0 else _np.identity(6)
+        old    = _np.dot(self._m[index], before)
+        x      = _np.linalg.solve(old, _np.dot(mnew, before))
+        self._p[index:] = _np.matmul(self._p[index:], x)
+
+        self._m[index] = mnew
+        self._tree.Update(index, mnew)
+        self._twissfrom    = min(self._twissfrom, index)
+        self._firstchanged = min(self._firstchanged, index)
+
+    def InitialConditions(self):
+        """
+        Return the initial Twiss parameters and dispersion at the start of
+        the line as a dictionary.
+        """
+        if self.periodic:
+            initial = _PeriodicTwiss(self._tree.nodes[1])
+        else:
+            initial = list(self._entrance)
+        for i, key in enumerate(_TWISSKEYS):
+            if key.lower() in self._given:
+                initial[i] = self._given[key.lower()]
+        return dict(zip(_TWISSKEYS, initial))
+
+    def OneTurnMatrix(self):
+        """
+        Return the accumulated transfer matrix of the whole line.
+        """
+        return self._tree.nodes[1].copy()
+
+    def Twiss(self):
+        """
+        Return the optical functions at the end of every element as a
+        dictionary of arrays with the same keys as Optics.Twiss.
+
+        After edits only the rows from the first edited element onwards are
+        recalculated. With periodic=True the initial conditions depend on
+        every element, so the whole line is recalculated.
+        """
+        k = self._twissfrom
+        if self._twiss is None or (self.periodic and k < self._n):
+            initial = self.InitialConditions()
+            d = TwissFromMatrices(self._m, self._p, *[initial[key] for key in _TWISSKEYS])
+            d['S'] = self.tfs.GetColumn('S').astype(float)
+            _BeamSizes(self.tfs, d, self._beta)
+            self._twiss = d
+        elif k < self._n:
+            d = self._twiss
+            initial = self.InitialConditions()
+            if k == 0:
+                entrance = [initial[key] for key in _TWISSKEYS]
+                mu0 = [0.0, 0.0]
+            else:
+                entrance = [d[key][k-1] for key in _TWISSKEYS]
+                mu0 = [d['MUX'][k-1], d['MUY'][k-1]]
+            # the propagated optics downstream use the accumulated matrices from the
+            # start and the phase advance continues from the element before
+            part = TwissFromMatrices(self._m[k:], self._p[k:], *[initial[key] for key in _TWISSKEYS])
+            entrancepart = TwissFromMatrices(self._m[k:k+1], self._m[k:k+1], *entrance)
+            for plane, i in (('X', 0), ('Y', 1)):
+                part['MU'+plane] += entrancepart['MU'+plane][0] - part['MU'+plane][0] + mu0[i]
+            _BeamSizes(self.tfs, part, self._beta)
+            for key in part:
+                d[key][k:] = part[key]
+        self._twissfrom = self._n
+        return self._twiss
+
+    def TwissAt(self, index):
+        """
+        Return the optical functions (excluding phase advance) at the end of
+        a single element as a dictionary. Only O(log N) matrix
+        multiplications are required.
+        """
+        initial = self.InitialConditions()
+        p = self._tree.Prefix(index)[_np.newaxis]
+        d = PropagateTwiss(p, *[initial[key] for key in _TWISSKEYS])
+        return dict((key, value[0]) for key, value in d.items())
+
+    def UpdateTfs(self):
+        """
+        Write the recalculated optical functions into the Tfs instance for
+        the elements downstream of the first edit since the last update.
+        """
+        d = self.Twiss()
+        if self.periodic:
+            self._firstchanged = 0 # the initial conditions have changed too
+        keys = [key for key in d if key != 'S' and key in self.tfs.columns]
+        indices = [self.tfs.ColumnIndex(key) for key in keys]
+        for i in range(self._firstchanged, self._n):
+            row = self.tfs.data[self.tfs.sequence[i]]
+            for key, column in zip(keys, indices):
+                row[column] = d[key][i]
+        self._firstchanged = self._n
+
+def _ParticleArray(particles):
+    """
+    Return particles as an (N,6) float array. A pymadx.Ptc.Inrays instance
+    may be supplied as well as an array.
+    """
+    if hasattr(particles, 'GetArray'):
+        return particles.GetArray()
+    particles = _np.array(particles, dtype=float, ndmin=2)
+    if particles.shape[1] != 6:
+        raise ValueError("Particles must be an (N,6) array of x, px, y, py, t, pt")
+    return particles
+
+def _ObservationIndices(tfs, observe):
+    """
+    Return a sorted array of element indices from None (the end of the line),
+    'all' or a list of element names or indices.
+    """
+    if observe is None:
+        return _np.array([len(tfs) - 1])
+    if type(observe) == str:
+        if observe == 'all':
+            return _np.arange(len(tfs))
+        observe = [observe]
+    indices = [tfs.IndexFromName(o) if type(o) == str else int(o) % len(tfs) for o in observe]
+    return _np.unique(indices)
+
+def _SextupoleKick(coords, k2l, tilt):
+    """
+    Apply a thin sextupole kick in place to an (N,6) array in the frame of
+    an element rotated by tilt.
+    """
+    c, s = _np.cos(tilt), _np.sin(tilt)
+    x = c*coords[:,0] + s*coords[:,2]
+    y = c*coords[:,2] - s*coords[:,0]
+    dpx = -0.5*k2l*(x*x - y*y)
+    dpy = k2l*x*y
+    coords[:,1] += c*dpx - s*dpy
+    coords[:,3] += s*dpx + c*dpy
+
+def _HalfMatrices(element, beta, igamma2):
+    """
+    Return the matrices from the entrance to the centre and from the centre
+    to the exit of one element (a dictionary of length 1 arrays as from
+    ElementData). Only the first includes the entrance pole face and only
+    the second the exit pole face. For a thin element the first is the
+    whole element and the second the identity.
+    """
+    if element['L'][0] <= 0:
+        return Matrices(element, beta, igamma2)[0], _np.identity(6)
+    half = 0.5*element['L']
+    first  = _Matrices(element, beta, igamma2, half, True, False)[0]
+    second = _Matrices(element, beta, igamma2, half, False, True)[0]
+    return first, second
+
+def Track(tfsfile, particles, observe=None, order=1):
+    """
+    Track an ensemble of particles through the line of a Tfs instance using
+    the element transfer matrices.
+
+    tfsfile   - Tfs instance or file name
+    particles - (N,6) array of x, px, y, py, t, pt or a pymadx.Ptc.Inrays instance
+    observe   - None for the end of the line only, 'all' for every element, or
+                a list of element names or indices to record the coordinates at
+    order     - 1 for linear tracking, 2 to also include the thin sextupole
+                kicks (K2L) at the centre of each element
+
+    returns an (M,6) array of coordinates for each of the M observation points
+    as a single (M,N,6) array in the order of the sequence.
+
+    The matrices between consecutive observation points (or sextupoles) are
+    combined first so each particle is only transformed once per observation
+    point regardless of the number of elements in between. Higher order
+    effects other than the sextupole kicks (e.g. chromatic focusing) and
+    orbit kicks are not included.
+
+    >>> coords = Track(tfs, numpy.random.normal(0, 1e-6, (1000000, 6)), observe=['IP'])
+    """
+    tfs = _Data.CheckItsTfs(tfsfile)
+    if order not in (1, 2):
+        raise ValueError("Only first or second order tracking is possible")
+    coords = _ParticleArray(particles).copy()
+    beta, igamma2 = _RelativisticFactors(tfs)
+    data = ElementData(tfs)
+    tree = _MatrixTree(Matrices(data, beta, igamma2))
+
+    observations = _ObservationIndices(tfs, observe)
+    kicks = _np.array([], dtype=int)
+    if order == 2:
+        kicks = _np.nonzero(_ColumnOrZeros(tfs, 'K2L'))[0]
+        k2l   = _ColumnOrZeros(tfs, 'K2L')
+    events = _np.union1d(observations, kicks).astype(int)
+    isobservation = set(observations)
+    iskick        = set(kicks)
+
+    result = _np.zeros((len(observations), len(coords), 6))
+    position = 0 # index of the next element to transport through
+    iobs = 0
+    for event in events:
+        if event in iskick:
+            coords = _np.dot(coords, tree.Product(position, event).T)
+            element = dict((key, value[event:event+1]) for key, value in data.items())
+            first, second = _HalfMatrices(element, beta, igamma2)
+            coords = _np.dot(coords, first.T)
+            _SextupoleKick(coords, k2l[event], element['TILT'][0])
+            coords = _np.dot(coords, second.T)
+        else:
+            coords = _np.dot(coords, tree.Product(position, event + 1).T)
+        position = event + 1
+        if event in isobservation:
+            result[iobs] = coords
+            iobs += 1
+    return result
+
+def _RotationY(angle):
+    """(N,3,3) rotations about the vertical axis as in the MADX survey."""
+    c, s = _np.cos(angle), _np.sin(angle)
+    m = _np.zeros((len(angle), 3, 3))
+    m[:,0,0] = c
+    m[:,0,2] = s
+    m[:,1,1] = 1.0
+    m[:,2,0] = -s
+    m[:,2,2] = c
+    return m
+
+def _RotationX(angle):
+    """(N,3,3) rotations about the horizontal axis as in the MADX survey."""
+    c, s = _np.cos(angle), _np.sin(angle)
+    m = _np.zeros((len(angle), 3, 3))
+    m[:,0,0] = 1.0
+    m[:,1,1] = c
+    m[:,1,2] = s
+    m[:,2,1] = -s
+    m[:,2,2] = c
+    return m
+
+def _RotationZ(angle):
+    """(N,3,3) rotations about the longitudinal axis as in the MADX survey."""
+    c, s = _np.cos(angle), _np.sin(angle)
+    m = _np.zeros((len(angle), 3, 3))
+    m[:,0,0] = c
+    m[:,0,1] = -s
+    m[:,1,0] = s
+    m[:,1,1] = c
+    m[:,2,2] = 1.0
+    return m
+
+def Survey(tfsfile, x0=0.0, y0=0.0, z0=0.0, theta0=0.0, phi0=0.0, psi0=0.0):
+    """
+    Calculate the global floor coordinates at the end of every element from
+    the L, ANGLE and TILT columns of a Tfs instance (e.g. twiss output) in
+    the same way as the MADX survey command.
+
+    tfsfile  - Tfs instance or file name
+    x0 etc   - optional initial position and orientation
+
+    returns a dictionary of arrays with the keys S, X, Y, Z, THETA, PHI and PSI.
+
+    The rotation of each element is accumulated with a log2(N) batched
+    prefix product rather than a loop over the elements.
+    """
+    tfs   = _Data.CheckItsTfs(tfsfile)
+    l     = _ColumnOrZeros(tfs, 'L')
+    angle = _ColumnOrZeros(tfs, 'ANGLE')
+    tilt  = _ColumnOrZeros(tfs, 'TILT')
+
+    # displacement and rotation of each element in its own frame
+    # (1-cos(a))/a and sin(a)/a are written with sinc to avoid division by 0
+    v = _np.zeros((len(l), 3))
+    v[:,0] = -l * _np.sin(0.5*angle) * _np.sinc(0.5*angle/_np.pi)
+    v[:,2] =  l * _np.sinc(angle/_np.pi)
+    s = _RotationY(-angle)
+    tilted = tilt != 0
+    if tilted.any():
+        t = _RotationZ(tilt[tilted])
+        v[tilted] = _np.einsum('nij,nj->ni', t, v[tilted])
+        s[tilted] = _np.matmul(t, _np.matmul(s[tilted], _np.transpose(t, (0,2,1))))
+
+    # W[i] = W0 x S[0] x ... x S[i], accumulated as transposes
+    w0 = _np.dot(_RotationY([theta0])[0], _np.dot(_RotationX([phi0])[0], _RotationZ([psi0])[0]))
+    w  = _np.matmul(w0, _np.transpose(CumulativeMatrices(_np.transpose(s, (0,2,1))), (0,2,1)))
+    wprev = _np.concatenate([w0[_np.newaxis], w[:-1]])
+    position = _np.cumsum(_np.einsum('nij,nj->ni', wprev, v), axis=0) + [x0, y0, z0]
+
+    d = {}
+    d['S']     = tfs.GetColumn('S').astype(float)
+    d['X']     = position[:,0]
+    d['Y']     = position[:,1]
+    d['Z']     = position[:,2]
+    d['THETA'] = _np.arctan2(w[:,0,2], w[:,2,2])
+    d['PHI']   = _np.arctan2(w[:,1,2], _np.hypot(w[:,1,0], w[:,1,1]))
+    d['PSI']   = _np.arctan2(w[:,1,0], w[:,1,1])
+    return d
@@ -43,6 +43,28 @@ def _GetOpticalDataFromTfs(tfsobject, dispersion=True):
     d['sigmayp']   = tfsobject.GetColumn('SIGMAYP')
     return d
 
+def _GetInterpolatedOpticalData(tfsobject, npoints=2000, sigma=False):
+    """
+    Utility to reconstruct the optical functions inside elements as a simple
+    dictionary with the same keys as _GetOpticalDataFromTfs. The beam sizes
+    are only included if sigma is True - a ValueError is raised if they can't
+    be calculated as there's no emittance in the header.
+    """
+    import pymadx.Optics as _Optics
+    o = _Optics.Interpolate(tfsobject, _Optics.InterpolationPositions(tfsobject, npoints))
+    d = {}
+    d['s']      = o['S']
+    d['betx']   = o['BETX']
+    d['bety']   = o['BETY']
+    d['dispx']  = o['DX']
+    if sigma:
+        if 'SIGMAX' not in o:
+            raise ValueError("No emittance in the Tfs header (EX, EY and SIGE or EXN, EYN and GAMMA) - "
+                             "the beam sizes can't be interpolated")
+        d['sigmax'] = o['SIGMAX']
+        d['sigmay'] = o['SIGMAY']
+    return d
+
 def Centroids(tfsfile, title='', outputfilename=None, machine=True):
     """
     Plot the centroid (mean) x and y from the a Tfs file or pymadx.Tfs instance.
@@ -82,11 +104,21 @@ def Centroids(tfsfile, title='', outputfilename=None, machine=True):
 def Survey(tfsfile, title='', outputfilename=None):
     """
     Plot the x and z coordinates from a tfs file.
+
+    If the file is not from the MADX survey command (i.e. there is no Z
+    column, such as twiss output), the coordinates are calculated from the
+    L, ANGLE and TILT columns with pymadx.Optics.Survey.
     """
     import pymadx.Data as _Data
     madx = _Data.CheckItsTfs(tfsfile)
-    x    = madx.GetColumn('X')
-    z    = madx.GetColumn('Z')
+    if 'Z' in madx.columns:
+        x = madx.GetColumn('X')
+        z = madx.GetColumn('Z')
+    else:
+        import pymadx.Optics as _Optics
+        d = _Optics.Survey(madx)
+        x = d['X']
+        z = d['Z']
 
     f = _plt.figure()
     ax = f.add_subplot(111)
@@ -98,7 +130,7 @@ def Survey(tfsfile, title='', outputfilename=None):
     _plt.ylabel('Z (m)')
 
 
-def Beta(tfsfile, title='', outputfilename=None, machine=True, dispersion=False, squareroot=True):
+def Beta(tfsfile, title='', outputfilename=None, machine=True, dispersion=False, squareroot=True, interpolate=False):
     """
     Plot sqrt(beta x,y) as a function of S. By default, a machine diagram is shown at
     the top of the plot.
@@ -106,14 +138,21 @@ def Beta(tfsfile, title='', outputfilename=None, machine=True, dispersion=False,
     Optionally set dispersion=True to plot x dispersion as second axis.
     Optionally turn off machine overlay at top with machine=False
     Specify outputfilename (without extension) to save the plot as both pdf and png.
+    Optionally set interpolate=True to reconstruct the optics inside elements
+    rather than drawing straight lines between element ends.
     """
     import pymadx.Data as _Data
     madx = _Data.CheckItsTfs(tfsfile)
 
     d = {}
-    d['s']    = madx.GetColumn('S')
-    d['betx'] = madx.GetColumn('BETX')
-    d['bety'] = madx.GetColumn('BETY')
+    if interpolate:
+        d.update(_GetInterpolatedOpticalData(madx))
+    else:
+        d['s']    = madx.GetColumn('S')
+        d['betx'] = madx.GetColumn('BETX')
+        d['bety'] = madx.GetColumn('BETY')
+        if dispersion:
+            d['dispx'] = madx.GetColumn('DX')
     smax = madx.smax
 
     f    = _plt.figure(figsize=(9,5))
@@ -139,9 +178,8 @@ def Beta(tfsfile, title='', outputfilename=None, machine=True, dispersion=False,
 
     #plot dispersion - only in horizontal
     if dispersion:
-        d['dispxbeta'] = madx.GetColumn('DX')
         ax2 = axoptics.twinx()
-        ax2.plot(d['s'],d['dispxbeta'],'r--')
+        ax2.plot(d['s'],d['dispx'],'r--')
         ax2.set_ylabel(r'Dispersion / $\beta$ (m)')
 
     #add lattice to plot
@@ -156,7 +194,7 @@ def Beta(tfsfile, title='', outputfilename=None, machine=True, dispersion=False,
         _plt.savefig(outputfilename+'.pdf')
         _plt.savefig(outputfilename+'.png')
 
-def Sigma(tfsfile, title='', outputfilename=None, machine=True, dispersion=False):
+def Sigma(tfsfile, title='', outputfilename=None, machine=True, dispersion=False, interpolate=False):
     """
     Plot sqrt(beta x,y) as a function of S. By default, a machine diagram is shown at
     the top of the plot.
@@ -164,10 +202,15 @@ def Sigma(tfsfile, title='', outputfilename=None, machine=True, dispersion=False
     Optionally set dispersion=True to plot x dispersion as second axis.
     Optionally turn off machine overlay at top with machine=False
     Specify outputfilename (without extension) to save the plot as both pdf and png.
+    Optionally set interpolate=True to reconstruct the beam size inside elements
+    rather than drawing straight lines between element ends.
     """
     import pymadx.Data as _Data
     madx = _Data.CheckItsTfs(tfsfile)
-    d    = _GetOpticalDataFromTfs(madx)
+    if interpolate:
+        d = _GetInterpolatedOpticalData(madx, sigma=True)
+    else:
+        d = _GetOpticalDataFromTfs(madx)
     smax = madx.smax
 
     f    = _plt.figure(figsize=(9,5))
@@ -2,13 +2,15 @@
 Classes to handle PTC runs and data.
 """
 
+import gzip as _gzip
+import multiprocessing as _multiprocessing
 import numpy as _np
-import re as _re
+
+from . import Data as _Data
 try:
     import matplotlib.pyplot as _plt
 except ImportError:
     pass
-from numpy.random import multivariate_normal as _multivariate_normal
 
 class Inray(object):
     """
@@ -41,21 +43,78 @@ class Inray(object):
         s += ';\n'
         return s
 
-class Inrays(list):
+class Inrays(object):
     """
-    Class based on python list for Inray class
+    Collection of madx ptc input rays stored in an (N,6) numpy array with
+    the columns x, px, y, py, t, pt.
+
+    Particles may be added one at a time with AddParticle (the storage grows
+    geometrically so this is amortised constant time) or many at a time from
+    an array with AddParticles. The getters X(), PX() etc. and GetArray()
+    return views of the storage rather than copies.
+
+    Iterating over the instance or indexing it with an integer returns Inray
+    instances for compatibility.
     """
-    def __init__(self):
-        list.__init__(self)
+    def __init__(self, particles=None):
+        self._buffer = _np.zeros((0,6))
+        self._n      = 0
         variables = ['X','PX','Y','PY','T','PT']
-        for v in variables:
-            self._AddMethod(v)
+        for i,v in enumerate(variables):
+            self._AddMethod(v, i)
+        if particles is not None:
+            self.AddParticles(particles)
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for row in self.GetArray().tolist():
+            yield Inray(*row)
+
+    def __getitem__(self, index):
+        if type(index) == slice:
+            return Inrays(self.GetArray()[index])
+        return Inray(*self.GetArray()[index].tolist())
+
+    def __repr__(self):
+        return 'pymadx.Ptc.Inrays instance with ' + str(self._n) + ' particles'
+
+    def _Reserve(self, n):
+        """Ensure there is storage for at least n particles."""
+        if n > len(self._buffer):
+            buf = _np.zeros((max(n, 2*len(self._buffer), 16), 6))
+            buf[:self._n] = self._buffer[:self._n]
+            self._buffer = buf
 
     def AddParticle(self,x=0.0,px=0.0,y=0.0,py=0.0,t=0.0,pt=0.0):
-        self.append(Inray(x,px,y,py,t,pt))
+        self._Reserve(self._n + 1)
+        self._buffer[self._n] = (x,px,y,py,t,pt)
+        self._n += 1
+
+    def AddParticles(self, particles):
+        """
+        Append an (N,6) array of x, px, y, py, t, pt.
+        """
+        particles = _np.atleast_2d(_np.asarray(particles, dtype=float))
+        if particles.shape[1] != 6:
+            raise ValueError("Particles must be an (N,6) array of x, px, y, py, t, pt")
+        self._Reserve(self._n + len(particles))
+        self._buffer[self._n:self._n+len(particles)] = particles
+        self._n += len(particles)
+
+    def append(self, inray):
+        """For compatibility with the previous list based class."""
+        self.AddParticle(inray.x, inray.px, inray.y, inray.py, inray.t, inray.pt)
+
+    def GetArray(self):
+        """
+        Return an (N,6) view of the particle coordinates.
+        """
+        return self._buffer[:self._n]
 
     def Clear(self):
-        del self[:]
+        self._n = 0
 
     def Write(self,filename):
         WriteInrays(filename,self)
@@ -63,69 +122,352 @@ class Inrays(list):
     def Plot(self):
         PlotInrays(self)
 
-    def _AddMethod(self, variablename):
+    def _AddMethod(self, variablename, columnindex):
         """This is used to easily and dynamically add a getter function for a variable name."""
         def GetAttribute():
-            return _np.array([getattr(p,str.lower(variablename)) for p in self])
+            return self._buffer[:self._n,columnindex]
         setattr(self,variablename,GetAttribute)
 
-    def Statistics(self):
-        print('TBC - will return various moments')
-        
-def LoadInrays(fileName): 
+    def Statistics(self, gamma=None, chunkSize=1000000):
+        """
+        Return a dictionary of the beam statistics. See BeamStatistics.
+
+        gamma     - relativistic gamma for the normalised emittances
+        chunkSize - number of particles accumulated at a time
+        """
+        moments = BeamMoments()
+        particles = self.GetArray()
+        for start in range(0, len(particles), chunkSize):
+            moments.Update(particles[start:start+chunkSize])
+        return BeamStatistics(moments, gamma)
+
+# ptc_start statements are tokenised by turning the separators into spaces
+_INRAYNAMES = _np.array(['pt','px','py','t','x','y']) # sorted for searchsorted
+_INRAYCOLUMNS = _np.array([5, 1, 3, 4, 0, 2])          # x, px, y, py, t, pt order
+try:
+    _INRAYSEPARATORS = str.maketrans(',;=', '   ')
+except AttributeError:
+    import string as _string
+    _INRAYSEPARATORS = _string.maketrans(',;=', '   ')
+
+_INRAYFORMAT = 'ptc_start, x=%.17g, px=%.17g, y=%.17g, py=%.17g, t=%.17g, pt=%.17g;\n'
+_INRAYBUFFERSIZE = 1<<20
+
+def _ParseInrays(lines):
+    """
+    Parse a list of ptc_start lines into an (N,6) array. Coordinates
+    that are not given are 0.
+    """
+    tokens = _np.array(''.join(lines).lower().translate(_INRAYSEPARATORS).split())
+    start  = tokens == 'ptc_start'
+    result = _np.zeros((start.sum(), 6))
+    if len(result) == 0:
+        return result
+    row   = _np.cumsum(start) - 1
+    index = _np.searchsorted(_INRAYNAMES, tokens)
+    index[index == len(_INRAYNAMES)] = 0
+    name  = (_INRAYNAMES[index] == tokens) & (row >= 0)
+    name[-1] = False # a name needs a value after it
+    value = _np.roll(name, 1)
+    result[row[name], _INRAYCOLUMNS[index[name]]] = tokens[value].astype(float)
+    return result
+
+def _OpenInrays(fileName, mode):
+    """Open a plain or, if the name ends with .gz, gzipped file in binary mode."""
+    if fileName.endswith('.gz'):
+        return _gzip.open(fileName, mode, 6) # zlib default, level 9 is much slower
+    return open(fileName, mode, _INRAYBUFFERSIZE)
+
+def _FormatInrays(particles):
+    """Return the ptc_start lines for an (N,6) array as ascii bytes."""
+    return ((_INRAYFORMAT*len(particles)) % tuple(particles.ravel().tolist())).encode('ascii')
+
+def LoadInrays(fileName, chunkSize=100000):
     """Load input rays from file
-    fileName : inrays.madx 
-    return   : Inrays instance""" 
-    i = Inrays()
-    
-    # open file 
-    f = open(fileName) 
-    for l in f : 
-        inre_x  = _re.search('\s*x\s*=\s*([0-9.eE+-]+)\s*',l)
-        inre_px = _re.search('\s*px\s*=\s*([0-9.eE+-]+)\s*',l)
-        inre_y  = _re.search('\s*y\s*=\s*([0-9.eE+-]+)\s*',l)
-        inre_py = _re.search('\s*py\s*=\s*([0-9.eE+-]+)\s*',l)
-        inre_t  = _re.search(' t\s*=\s*([0-9.eE+-]+)\s*',l)
-        inre_pt = _re.search('\s*pt\s*=\s*([0-9.eE+-]+)\s*',l)
-
-        if inre_x : 
-            x = float(inre_x.group(1))
-        else :
-            x = 0.0
-        if inre_px : 
-            px = float(inre_px.group(1))
-        else : 
-            px = 0.0 
-        if inre_y : 
-            y  = float(inre_y.group(1))
-        else : 
-            y  = 0.0
-        if inre_py :             
-            py = float(inre_py.group(1))
-        else : 
-            py = 0.0
-        if inre_t :             
-            t  = float(inre_t.group(1))
-        else : 
-            t = 0.0
-
-        if inre_pt:
-            pt = float(inre_pt.group(1))
-        else:
-            pt = 0.0
+    fileName  : inrays.madx or inrays.madx.gz
+    chunkSize : number of lines read and converted at a time
+    return    : Inrays instance
 
-        i.AddParticle(x,px,y,py,t,pt)
+    Only lines starting with ptc_start are read. Coordinates that are not
+    specified are 0."""
+    i = Inrays()
+    for particles in IterInrays(fileName, chunkSize):
+        i.AddParticles(particles)
 
     print('LoadInrays> Loaded ',len(i))
     return i
-  
-def WriteInrays(fileName, inrays):
-    print('pymadx.Ptc> WriteInrays - inrays written to: ',fileName)
-    f = open(fileName, 'w') 
-    for particle in inrays:
-        f.write(str(particle))
+
+def IterInrays(fileName, chunkSize=100000):
+    """
+    Iterate over an inrays file in (N,6) arrays of about chunkSize particles
+    without loading the whole file. See LoadInrays.
+    """
+    f = _OpenInrays(fileName, 'rb')
+    try:
+        while True:
+            lines = f.readlines(chunkSize*80) # approximate bytes per line
+            if not lines:
+                break
+            if not isinstance(lines[0], str):
+                lines = [l.decode('ascii') for l in lines]
+            lines = [l for l in lines if l.lstrip()[:9].lower() == 'ptc_start']
+            yield _ParseInrays(lines)
+    finally:
+        f.close()
+
+def InraysStatistics(fileName, gamma=None, chunkSize=100000):
+    """
+    Return the statistics (see BeamStatistics) of an inrays file in one
+    pass without loading the whole file.
+    """
+    moments = BeamMoments()
+    for particles in IterInrays(fileName, chunkSize):
+        moments.Update(particles)
+    return BeamStatistics(moments, gamma)
+
+def WriteInrays(fileName, inrays, chunkSize=100000):
+    """Write input rays to file
+    fileName  : inrays.madx, or inrays.madx.gz to write a gzipped file
+    inrays    : Inrays instance, (N,6) array or list of Inray instances
+    chunkSize : number of particles formatted at a time
+
+    Whole blocks of particles are formatted with a single string operation.
+    Coordinates are written with 17 significant digits so they are read
+    back exactly."""
+    if hasattr(inrays, 'GetArray'):
+        particles = inrays.GetArray()
+    elif isinstance(inrays, _np.ndarray):
+        particles = inrays.reshape(-1,6)
+    else:
+        particles = _np.array([[p.x,p.px,p.y,p.py,p.t,p.pt] for p in inrays]).reshape(-1,6)
+
+    f = _OpenInrays(fileName, 'wb')
+    for start in range(0, len(particles), chunkSize):
+        f.write(_FormatInrays(particles[start:start+chunkSize]))
     f.close()
-   
+    print('pymadx.Ptc> WriteInrays - inrays written to: ',fileName)
+
+def _Binomial(n, k):
+    result = 1
+    for i in range(k):
+        result = result * (n-i) // (i+1)
+    return result
+
+class Moments(object):
+    """
+    Streaming central moments of several variables, optionally for several
+    groups (e.g. samplers) at once.
+
+    nvariables - number of variables (columns of the data)
+    exponents  - list of tuples of the powers of each variable of the
+                 central moments to keep, e.g. (2,0) for var(x) and (1,1)
+                 for cov(x,px). The lower order moments needed to merge
+                 are added automatically.
+    ngroups    - number of groups
+
+    Data are added with Update, which computes the moments of the chunk
+    about its own (per group) mean and merges them into the totals with the
+    pairwise formula of Chan et al. / Pebay:
+
+      C_p = sum_{q<=p} (p choose q) [ C^A_q (-n_B d/n)^(p-q) + C^B_q (n_A d/n)^(p-q) ]
+
+    where C_q are sums of central products, d = mean_B - mean_A and the
+    binomial coefficients and powers are products over the variables.
+    This is numerically stable for any number of chunks, and Moments
+    instances computed separately (e.g. in other processes) can be
+    combined with Merge.
+    """
+    def __init__(self, nvariables, exponents, ngroups=1):
+        closed = set()
+        for p in exponents:
+            for q in _np.ndindex(*[pi+1 for pi in p]):
+                if sum(q) > 1:
+                    closed.add(tuple(q))
+        self.nvariables = nvariables
+        self.ngroups    = ngroups
+        self.exponents  = sorted(closed, key=lambda p: (sum(p), p))
+        self.columns    = dict((p,i) for i,p in enumerate(self.exponents))
+        self.maxorder   = max([sum(p) for p in self.exponents] + [1])
+        self.n          = _np.zeros(ngroups)
+        self.mean       = _np.zeros((ngroups, nvariables))
+        self.sums       = _np.zeros((ngroups, len(self.exponents)))
+        self._terms     = [self._Terms(p) for p in self.exponents]
+
+    def _Terms(self, p):
+        """(column of q or None for q=0, coefficient, p-q) for each q <= p."""
+        terms = []
+        for q in _np.ndindex(*[pi+1 for pi in p]):
+            q = tuple(q)
+            if sum(q) == 1:
+                continue # first central moments are 0
+            coefficient = 1
+            for pi,qi in zip(p,q):
+                coefficient *= _Binomial(pi, qi)
+            column = None if sum(q) == 0 else self.columns[q]
+            terms.append((column, coefficient, tuple(pi-qi for pi,qi in zip(p,q))))
+        return terms
+
+    def _Empty(self):
+        return Moments(self.nvariables, self.exponents, self.ngroups)
+
+    def Update(self, data, groups=None):
+        """
+        Add a chunk of data.
+
+        data   - (N, nvariables) array
+        groups - integer group (>= 0) of each row, default all 0. The
+                 number of groups grows if needed.
+        """
+        data = _np.asarray(data, dtype=float).reshape(-1, self.nvariables)
+        if groups is None:
+            groups = _np.zeros(len(data), dtype=int)
+        if len(groups) > 0 and groups.max() >= self.ngroups:
+            self.Resize(groups.max() + 1)
+        chunk = self._Empty()
+        chunk.n = _np.bincount(groups, minlength=self.ngroups).astype(float)
+        filled  = _np.maximum(chunk.n, 1)
+        for i in range(self.nvariables):
+            chunk.mean[:,i] = _np.bincount(groups, data[:,i], self.ngroups) / filled
+        centred = data - chunk.mean[groups]
+        powers  = [[None, centred[:,i]] for i in range(self.nvariables)]
+        for i in range(self.nvariables):
+            for k in range(2, self.maxorder+1):
+                powers[i].append(powers[i][-1] * centred[:,i])
+        for j,p in enumerate(self.exponents):
+            product = None
+            for i,pi in enumerate(p):
+                if pi > 0:
+                    product = powers[i][pi] if product is None else product*powers[i][pi]
+            chunk.sums[:,j] = _np.bincount(groups, product, self.ngroups)
+        self.Merge(chunk)
+
+    def Resize(self, ngroups):
+        """Increase the number of groups. New groups are empty."""
+        extra = ngroups - self.ngroups
+        if extra <= 0:
+            return
+        self.n       = _np.concatenate([self.n, _np.zeros(extra)])
+        self.mean    = _np.vstack([self.mean, _np.zeros((extra, self.nvariables))])
+        self.sums    = _np.vstack([self.sums, _np.zeros((extra, len(self.exponents)))])
+        self.ngroups = ngroups
+
+    def Merge(self, other):
+        """Merge the moments of another instance with the same exponents."""
+        self.Resize(other.ngroups)
+        other.Resize(self.ngroups)
+        na, nb = self.n, other.n
+        n      = na + nb
+        filled = _np.maximum(n, 1)
+        delta  = other.mean - self.mean
+        a = -(nb/filled)[:,None] * delta # shift of A's moments to the new mean
+        b =  (na/filled)[:,None] * delta
+        apow = [_np.ones_like(a)]
+        bpow = [_np.ones_like(b)]
+        for k in range(self.maxorder):
+            apow.append(apow[-1]*a)
+            bpow.append(bpow[-1]*b)
+
+        sums = _np.zeros_like(self.sums)
+        for j,terms in enumerate(self._terms):
+            for column,coefficient,r in terms:
+                fa = _np.ones(self.ngroups)
+                fb = _np.ones(self.ngroups)
+                for i,ri in enumerate(r):
+                    if ri > 0:
+                        fa = fa * apow[ri][:,i]
+                        fb = fb * bpow[ri][:,i]
+                ca = na if column is None else self.sums[:,column]
+                cb = nb if column is None else other.sums[:,column]
+                sums[:,j] += coefficient*(ca*fa + cb*fb)
+        self.mean = self.mean + (nb/filled)[:,None]*delta
+        self.sums = sums
+        self.n    = n
+
+    def Central(self, exponent):
+        """
+        Return the central moment (divided by n) for a tuple of powers, for
+        each group.
+        """
+        exponent = tuple(exponent)
+        if sum(exponent) == 0:
+            return _np.ones(self.ngroups)
+        if sum(exponent) == 1:
+            return _np.zeros(self.ngroups)
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums[:,self.columns[exponent]] / self.n
+
+    def Covariance(self):
+        """Return the (ngroups, nvariables, nvariables) covariance matrices."""
+        d = self.nvariables
+        cov = _np.zeros((self.ngroups, d, d))
+        for i in range(d):
+            for j in range(d):
+                p = [0]*d
+                p[i] += 1
+                p[j] += 1
+                cov[:,i,j] = self.Central(p)
+        return cov
+
+def BeamMoments():
+    """
+    Return a Moments instance for (N,6) particle arrays with the covariance
+    matrix and the third and fourth moments of each coordinate.
+    """
+    exponents = []
+    for i in range(6):
+        for j in range(i, 6):
+            p = [0]*6
+            p[i] += 1
+            p[j] += 1
+            exponents.append(tuple(p))
+        exponents.append(tuple(4 if k == i else 0 for k in range(6)))
+    return Moments(6, exponents)
+
+def BeamStatistics(moments, gamma=None):
+    """
+    Return a dictionary of beam statistics from a BeamMoments instance.
+
+    N                   - number of particles
+    MEAN, RMS           - arrays of x, px, y, py, t, pt
+    COV                 - 6x6 covariance matrix
+    SKEWNESS, KURTOSIS  - arrays of x, px, y, py, t, pt (kurtosis is not
+                          the excess, i.e. 3 for a gaussian)
+    EMITX, EMITY        - rms emittances sqrt(det) of the 2x2 covariances
+    EMITXN, EMITYN      - normalised emittances, if gamma is given
+    BETX, ALFX, BETY, ALFY - twiss parameters from the covariances
+    EMITXB, EMITYB, BETXB, ALFXB ... - the same without the part correlated
+                                       with pt
+    DX, DPX, DY, DPY    - dispersion <u pt>/<pt^2>
+    """
+    cov = moments.Covariance()[0]
+    rms = _np.sqrt(_np.diag(cov))
+    result = {'N'    : int(moments.n[0]),
+              'MEAN' : moments.mean[0].copy(),
+              'COV'  : cov,
+              'RMS'  : rms}
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        third  = _np.array([moments.Central(tuple(3 if k == i else 0 for k in range(6)))[0] for i in range(6)])
+        fourth = _np.array([moments.Central(tuple(4 if k == i else 0 for k in range(6)))[0] for i in range(6)])
+        result['SKEWNESS'] = third / rms**3
+        result['KURTOSIS'] = fourth / rms**4
+
+        # dispersion and betatron (pt uncorrelated) part of the covariance
+        dispersion = cov[:4,5] / cov[5,5] if cov[5,5] > 0 else _np.zeros(4)
+        betatron   = cov[:4,:4] - _np.outer(dispersion, dispersion)*cov[5,5]
+        for key,value in zip(['DX','DPX','DY','DPY'], dispersion):
+            result[key] = value
+
+        for plane,i in [('X',0),('Y',2)]:
+            for suffix,c in [('',cov),('B',betatron)]:
+                block = c[i:i+2,i:i+2]
+                emittance = _np.sqrt(_np.linalg.det(block))
+                result['EMIT'+plane+suffix] = emittance
+                result['BET'+plane+suffix]  =  block[0,0] / emittance
+                result['ALF'+plane+suffix]  = -block[0,1] / emittance
+            if gamma is not None:
+                result['EMIT'+plane+'N'] = _np.sqrt(gamma**2 - 1.0) * result['EMIT'+plane]
+    return result
+
 def PlotInrays(i): 
     """Plot Inrays instance, if input is a sting the instance is created from the file"""    
 
@@ -164,6 +506,77 @@ def PlotInrays(i):
     
     _plt.subplots_adjust(hspace=0.35,wspace=0.15,top=0.98,right=0.98,left=0.05)
   
+def _GenerateChunk(task):
+    """
+    Generate and format one chunk of particles. The random numbers only
+    depend on the seed and the chunk index. Module level so it can be run
+    in a process pool.
+    """
+    generator, args, start, stop, seed, index = task
+    rng = _np.random.RandomState([seed, index])
+    return _FormatInrays(generator._Chunk(start, stop, rng, *args))
+
+def _ChunkFileName(fileName, index):
+    """inrays.madx.gz -> inrays_<index>.madx.gz"""
+    base, ext = fileName, ''
+    if base.endswith('.gz'):
+        base, ext = base[:-3], '.gz'
+    dot = base.rfind('.')
+    if dot > base.rfind('/'):
+        base, ext = base[:dot], base[dot:] + ext
+    return base + '_' + str(index) + ext
+
+def _GenerateToFiles(generator, args, nTotal, fileName, seed, chunkSize, workers, chunksPerFile):
+    """
+    Generate nTotal particles in chunks of chunkSize and write them to disk
+    without holding more than a few chunks per worker in memory. Chunk i
+    uses numpy.random.RandomState([seed, i]) so the output is the same for
+    any number of workers.
+
+    Returns the list of files written.
+    """
+    if seed is None:
+        seed = _np.random.randint(2**31)
+    nChunks = int(_np.ceil(nTotal / float(chunkSize)))
+    tasks   = [(generator, args, i*chunkSize, min((i+1)*chunkSize, nTotal), seed, i)
+               for i in range(nChunks)]
+
+    if chunksPerFile is None:
+        fileNames = [fileName]
+        chunksPerFile = max(nChunks, 1)
+    else:
+        nFiles    = max(int(_np.ceil(nChunks / float(chunksPerFile))), 1)
+        fileNames = [_ChunkFileName(fileName, i) for i in range(nFiles)]
+
+    workers = max(workers, 1)
+    pool    = None
+    if workers > 1:
+        pool = _multiprocessing.Pool(workers)
+    f = _OpenInrays(fileNames[0], 'wb')
+    try:
+        pending = []
+        for i in range(nChunks):
+            # keep a bounded window of chunks in flight
+            while len(pending) < 2*workers and len(tasks) > 0:
+                task = tasks.pop(0)
+                if pool is None:
+                    pending.append(_GenerateChunk(task))
+                else:
+                    pending.append(pool.apply_async(_GenerateChunk, (task,)))
+            if i > 0 and i % chunksPerFile == 0:
+                f.close()
+                f = _OpenInrays(fileNames[i // chunksPerFile], 'wb')
+            data = pending.pop(0)
+            f.write(data if pool is None else data.get())
+    finally:
+        f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print('pymadx.Ptc> ',nTotal,' particles written to: ',', '.join(fileNames))
+    return fileNames
+
 class GaussGenerator(object): 
     """Simple ptx inray file generator"""
     def __init__(self,
@@ -216,24 +629,129 @@ class GaussGenerator(object):
         s+= 'sT : '+str(self.sigmat)+' spt : '+str(self.sigmapt)
         return s
 
-    def Generate(self, nToGenerate=1000, fileName='inrays.madx'): 
-        """ returns an Inrays structure""" 
-        i = Inrays()
-        
-        for c in range(0,nToGenerate,1):
-            rv = _multivariate_normal(self.means,self.sigmas,1)[0]
-            i.AddParticle(rv[0],rv[1],rv[2],rv[3],rv[4],rv[5]) 
+    def Generate(self, nToGenerate=1000, fileName='inrays.madx', rng=None):
+        """
+        Generate all particles at once from a single factorisation of the
+        sigma matrix.
+
+        nToGenerate - number of particles
+        fileName    - inrays file to write, None to not write a file
+        rng         - random number generator with a standard_normal method,
+                      e.g. numpy.random.RandomState(seed). Default is the
+                      numpy.random module.
+
+        returns an (N,6) array of x, px, y, py, t, pt
+        """
+        if rng is None:
+            rng = _np.random
+        particles = rng.standard_normal((nToGenerate,6)).dot(self.Factor().T)
+        particles += self.means
 
-        WriteInrays(fileName,i)
-        #return i
+        if fileName is not None:
+            WriteInrays(fileName,particles)
+        return particles
+
+    def GenerateToFile(self, nToGenerate=1000, fileName='inrays.madx', seed=None,
+                       chunkSize=100000, workers=1, chunksPerFile=None):
+        """
+        Generate particles in chunks straight to disk, optionally in a pool
+        of worker processes. The files are identical for a given seed and
+        chunkSize whatever the number of workers.
+
+        nToGenerate   - number of particles
+        fileName      - inrays file to write (.gz for gzipped)
+        seed          - integer seed; chunk i uses RandomState([seed, i])
+        chunkSize     - number of particles generated at a time
+        workers       - number of processes
+        chunksPerFile - if given, start a new file inrays_0.madx,
+                        inrays_1.madx... after this many chunks
+
+        returns the list of files written
+        """
+        return _GenerateToFiles(self, (), nToGenerate, fileName, seed, chunkSize, workers, chunksPerFile)
+
+    def _Chunk(self, start, stop, rng):
+        return self.Generate(stop-start, None, rng)
+
+    def Factor(self):
+        """
+        Return a matrix L with L L^T equal to the sigma matrix. This is the
+        Cholesky factor unless the sigma matrix is singular (e.g. a zero
+        spread), in which case it is built from the eigen decomposition.
+        """
+        try:
+            return _np.linalg.cholesky(self.sigmas)
+        except _np.linalg.LinAlgError:
+            w, v = _np.linalg.eigh(self.sigmas)
+            return v * _np.sqrt(_np.clip(w, 0, None))
+
+# Sobol direction numbers (Joe & Kuo) for dimensions 2-6: s, a, m_1..m_s.
+# Dimension 1 is the van der Corput sequence in base 2.
+_SOBOLDIRECTIONS = [(1, 0, [1]),
+                    (2, 1, [1, 3]),
+                    (3, 1, [1, 3, 1]),
+                    (3, 2, [1, 1, 1]),
+                    (4, 1, [1, 1, 3, 3])]
+_SOBOLBITS = 30
+
+def _SobolVectors(ndim):
+    """Return the (ndim, _SOBOLBITS) integer direction vectors."""
+    v = _np.zeros((ndim, _SOBOLBITS), dtype=_np.int64)
+    v[0] = [1 << (_SOBOLBITS-k-1) for k in range(_SOBOLBITS)]
+    for d in range(1, ndim):
+        sd, ad, md = _SOBOLDIRECTIONS[d-1]
+        for k in range(_SOBOLBITS):
+            if k < sd:
+                v[d,k] = md[k] << (_SOBOLBITS-k-1)
+            else:
+                value = v[d,k-sd] ^ (v[d,k-sd] >> sd)
+                for j in range(1, sd):
+                    if (ad >> (sd-1-j)) & 1:
+                        value ^= v[d,k-j]
+                v[d,k] = value
+    return v
+
+def Sobol(n, ndim, skip=1):
+    """
+    Return the first n points of the ndim (<= 6) dimensional Sobol sequence
+    as an (n,ndim) array in [0,1). The first skip points are left out; the
+    default drops the point at the origin.
+    """
+    if ndim > len(_SOBOLDIRECTIONS) + 1:
+        raise ValueError("Sobol sequence only available for up to 6 dimensions")
+    index  = _np.arange(skip, skip+n, dtype=_np.int64)
+    points = _np.zeros((n, ndim), dtype=_np.int64)
+    for k, vk in enumerate(_SobolVectors(ndim).T):
+        points ^= ((index >> k) & 1)[:,None] * vk
+    return points / float(1 << _SOBOLBITS)
+
+def LatinHypercube(n, ndim, rng=None):
+    """
+    Return n points of a random Latin hypercube sample as an (n,ndim) array
+    in [0,1). Each dimension has exactly one point in each of its n strata.
+    """
+    if rng is None:
+        rng = _np.random
+    u = rng.uniform(size=(n, ndim))
+    for d in range(ndim):
+        u[:,d] += rng.permutation(n)
+    return u / n
 
 class FlatGenerator(object):
-    """Simple ptc inray file generator - even distribution"""
+    """
+    Simple ptc inray file generator - even distribution
+
+    Each of the six coordinates is spread evenly over mu -/+ width/2. Only
+    coordinates with a width greater than 0 are varied, the others are
+    fixed at their mu.
+    """
     def __init__(self,
                  mux =0.0, widthx =1e-3,
                  mupx=0.0, widthpx=1e-3,
                  muy =0.0, widthy =1e-3,
-                 mupy=0.0, widthpy=1e-3):
+                 mupy=0.0, widthpy=1e-3,
+                 mut =0.0, widtht =0.0,
+                 mupt=0.0, widthpt=0.0):
         self.mux     = mux
         self.muy     = muy
         self.widthx  = widthx
@@ -242,50 +760,331 @@ class FlatGenerator(object):
         self.mupy    = mupy
         self.widthpx = widthpx
         self.widthpy = widthpy
+        self.mut     = mut
+        self.widtht  = widtht
+        self.mupt    = mupt
+        self.widthpt = widthpt
+
+    def __repr__(self):
+        names = ['x','px','y','py','t','pt']
+        return ' '.join([n+' : '+str(m)+' +- '+str(w/2.0) for n,m,w in
+                         zip(names, self.Means(), self.Widths())])
+
+    def Means(self):
+        return _np.array([self.mux, self.mupx, self.muy, self.mupy, self.mut, self.mupt])
+
+    def Widths(self):
+        return _np.array([self.widthx, self.widthpx, self.widthy, self.widthpy, self.widtht, self.widthpt])
+
+    def Generate(self, nToGenerate=100, fileName='inrays.madx', method='grid', rng=None):
+        """
+        Generate particles evenly spread over the coordinates with a width.
+
+        nToGenerate - number of particles
+        fileName    - inrays file to write, None to not write a file
+        method      - 'grid'   : regular grid with the same number of points
+                                 in each dimension, including the edges.
+                                 The number of particles is rounded up to
+                                 fill the grid.
+                      'latin'  : random Latin hypercube sample
+                      'sobol'  : Sobol quasi-random sequence
+                      'random' : uniform random sample
+        rng         - random number generator for 'latin' and 'random',
+                      e.g. numpy.random.RandomState(seed)
+
+        returns an (N,6) array of x, px, y, py, t, pt
+
+        If all the widths are 0, nToGenerate copies of the means are returned.
+        """
+        nTotal = self._Total(nToGenerate, method)
+        if method == 'grid':
+            print("FlatGenerator> making array square - there'll be ",nTotal,'particles')
+        if rng is None:
+            rng = _np.random
+        particles = self._Chunk(0, nTotal, rng, nToGenerate, method)
+
+        if fileName is not None:
+            WriteInrays(fileName,particles)
+        return particles
+
+    def GenerateToFile(self, nToGenerate=100, fileName='inrays.madx', method='grid', seed=None,
+                       chunkSize=100000, workers=1, chunksPerFile=None):
+        """
+        Generate particles in chunks straight to disk, optionally in a pool
+        of worker processes. The files are identical for a given seed and
+        chunkSize whatever the number of workers. See Generate for the
+        methods; 'latin' is not available as it needs the whole sample at
+        once. See GaussGenerator.GenerateToFile for the other arguments.
+
+        returns the list of files written
+        """
+        if method == 'latin':
+            raise ValueError("A Latin hypercube sample cannot be generated in chunks")
+        nTotal = self._Total(nToGenerate, method)
+        return _GenerateToFiles(self, (nToGenerate, method), nTotal, fileName, seed,
+                                chunkSize, workers, chunksPerFile)
+
+    def _Active(self):
+        return _np.flatnonzero(self.Widths() > 0)
+
+    def _GridPoints(self, nToGenerate):
+        nd = len(self._Active())
+        return int(_np.ceil(nToGenerate**(1.0/nd)-1e-9)) if nd > 0 else 1
+
+    def _Total(self, nToGenerate, method):
+        if method == 'grid' and len(self._Active()) > 0:
+            return self._GridPoints(nToGenerate)**len(self._Active())
+        return nToGenerate
+
+    def _Chunk(self, start, stop, rng, nToGenerate, method):
+        """Particles start to stop of the complete sample."""
+        means  = self.Means()
+        widths = self.Widths()
+        active = self._Active()
+        nd     = len(active)
+        n      = stop - start
+
+        if method not in ('grid', 'latin', 'sobol', 'random'):
+            raise ValueError("Unknown method '" + str(method) + "'")
+
+        if nd == 0:
+            # no width in any coordinate - every particle is at the means
+            u = _np.zeros((n, 0))
+        elif method == 'grid':
+            nperdim = self._GridPoints(nToGenerate)
+            index   = _np.unravel_index(_np.arange(start, stop), (nperdim,)*nd)
+            u       = _np.array(index, dtype=float).T.reshape(n, nd) / max(nperdim-1, 1)
+        elif method == 'latin':
+            u = LatinHypercube(n, nd, rng)
+        elif method == 'sobol':
+            u = Sobol(n, nd, skip=start+1)
+        else:
+            u = rng.uniform(size=(n, nd))
+
+        particles = _np.tile(means, (n, 1))
+        particles[:,active] += (u - 0.5) * widths[active]
+        return particles
+
+def TwissFromTfs(tfs, startname=None):
+    """
+    Return a dictionary of the optical functions and beam parameters to
+    generate a matched beam at the start of element startname (name or
+    index, default the first element) of a Tfs instance or file. As in
+    Convert.MadxTfsToPtcBeam the values of the element before are used as
+    MADX gives them at the end of elements.
+
+    Keys are betx, alfx, bety, alfy, dx, dpx, dy, dpy (0 if the column is
+    missing), emitx, emity, sigmat, sigmapt (from the header EX, EY, SIGT
+    and SIGE, 0 if missing).
+    """
+    tfs = _Data.CheckItsTfs(tfs)
+    if startname is None:
+        startindex = 0
+    elif type(startname) == int:
+        startindex = startname
+    else:
+        startindex = tfs.IndexFromName(startname)
+    if startindex > 0:
+        startindex -= 1
+
+    row    = tfs.GetRowDict(tfs.sequence[startindex])
+    header = tfs.header
+    result = {}
+    for key in ['BETX','ALFX','BETY','ALFY','DX','DPX','DY','DPY']:
+        result[key.lower()] = float(row.get(key, 0.0))
+    result['emitx']  = float(header.get('EX', 0.0))
+    result['emity']  = float(header.get('EY', 0.0))
+    result['sigmat'] = float(header.get('SIGT', 0.0))
+    # SIGE is the relative energy spread, pt = dE/(p0 c)
+    gamma = float(header.get('GAMMA', 1e10))
+    beta  = _np.sqrt(1.0 - 1.0/gamma**2)
+    result['sigmapt'] = float(header.get('SIGE', 0.0)) / beta
+    return result
+
+class _MatchedGenerator(object):
+    """
+    Base class for generators of beams matched to twiss parameters.
+
+    Subclasses provide _Normalised(n, rng), which returns an (n,4) array of
+    normalised coordinates (X, PX, Y, PY) in units of sqrt(m). These are
+    transformed with
+
+      x  = sqrt(betx) X + dx pt
+      px = (PX - alfx X) / sqrt(betx) + dpx pt
+
+    and likewise in y. t and pt are gaussian with sigmat and sigmapt, so
+    dispersion correlates x and px with pt.
+    """
+    def __init__(self,
+                 emitx=1e-10, betx=0.1, alfx=0.0, dx=0.0, dpx=0.0,
+                 emity=1e-10, bety=0.1, alfy=0.0, dy=0.0, dpy=0.0,
+                 sigmat=1e-12, sigmapt=1e-12):
+        """
+        emitx, emity   : rms geometric emittances
+        betx, alfx ... : twiss parameters
+        dx, dpx ...    : dispersion with respect to pt
+        sigmat         : gaussian spread in t
+        sigmapt        : gaussian spread in pt
+        """
+        self.emitx   = emitx
+        self.betx    = betx
+        self.alfx    = alfx
+        self.dx      = dx
+        self.dpx     = dpx
+        self.emity   = emity
+        self.bety    = bety
+        self.alfy    = alfy
+        self.dy      = dy
+        self.dpy     = dpy
+        self.sigmat  = sigmat
+        self.sigmapt = sigmapt
+
+    @classmethod
+    def FromTfs(cls, tfs, startname=None, **kwargs):
+        """
+        Create a generator matched to the start of element startname of a
+        Tfs instance or file. Keyword arguments override the values from
+        the file or set distribution parameters.
+        """
+        parameters = TwissFromTfs(tfs, startname)
+        parameters.update(kwargs)
+        return cls(**parameters)
 
     def __repr__(self):
-        s = '' #TBC
+        s = 'ex : '+str(self.emitx)+' bx : '+str(self.betx)+' ax : '+str(self.alfx)
+        s+= ' dx : '+str(self.dx)+' dpx : '+str(self.dpx)+'\n'
+        s+= 'ey : '+str(self.emity)+' by : '+str(self.bety)+' ay : '+str(self.alfy)
+        s+= ' dy : '+str(self.dy)+' dpy : '+str(self.dpy)+'\n'
+        s+= 'sT : '+str(self.sigmat)+' spt : '+str(self.sigmapt)
         return s
 
-    def Generate(self,nToGenerate=100, fileName='inrays.madx'):
-        """ returns an Inrays structure""" 
-        i = Inrays()
-
-        nd = 0.0
-        if self.widthx > 0:
-            nd +=1
-        if self.widthy > 0:
-            nd +=1
-        if self.widthpx > 0:
-            nd +=1
-        if self.widthpy > 0:
-            nd +=1
-        nperdim = _np.ceil(nToGenerate**(1/nd))
-        print("FlatGenerator> making array square - there'll be ",nperdim**nd,'particles')
-
-        xmin = self.mux - self.widthx/2.0
-        xmax = self.mux + self.widthx/2.0
-        ymin = self.muy - self.widthy/2.0
-        ymax = self.muy + self.widthy/2.0
-        pxmin = self.mupx - self.widthpx/2.0
-        pxmax = self.mupx + self.widthpx/2.0
-        pymin = self.mupy - self.widthpy/2.0
-        pymax = self.mupy + self.widthpy/2.0
-
-        def GetX():
-            return _np.linspace(ymin,ymax,nperdim)
-
-        def GetY():
-            return _np.linspace(xmin,xmax,nperdim)
-
-        def GetXp():
-            return _np.linspace(pymin,pymax,nperdim)
-
-        def GetYp():
-            return _np.linspace(pxmin,pxmax,nperdim)
-
-        #we don't actually use 'd' here but just take advantage of list comprehensions
-        d = [i.AddParticle(x=x,px=px,y=y,py=py) for x in GetX() for px in GetXp() for y in GetY() for py in GetYp()]
-
-        WriteInrays(fileName,i)
-        #return i
+    def Generate(self, nToGenerate=1000, fileName='inrays.madx', rng=None):
+        """
+        nToGenerate - number of particles
+        fileName    - inrays file to write, None to not write a file
+        rng         - random number generator, e.g.
+                      numpy.random.RandomState(seed)
+
+        returns an (N,6) array of x, px, y, py, t, pt
+        """
+        if rng is None:
+            rng = _np.random
+        particles = self._Chunk(0, nToGenerate, rng)
+        if fileName is not None:
+            WriteInrays(fileName,particles)
+        return particles
+
+    def GenerateToFile(self, nToGenerate=1000, fileName='inrays.madx', seed=None,
+                       chunkSize=100000, workers=1, chunksPerFile=None):
+        """
+        Generate particles in chunks straight to disk. See
+        GaussGenerator.GenerateToFile.
+        """
+        return _GenerateToFiles(self, (), nToGenerate, fileName, seed, chunkSize, workers, chunksPerFile)
+
+    def _Chunk(self, start, stop, rng):
+        n = stop - start
+        u = self._Normalised(n, rng)
+        particles = _np.empty((n,6))
+        particles[:,4] = self.sigmat  * rng.standard_normal(n)
+        particles[:,5] = self.sigmapt * rng.standard_normal(n)
+        pt = particles[:,5]
+        for i,(beta,alpha,d,dp) in enumerate([(self.betx,self.alfx,self.dx,self.dpx),
+                                                (self.bety,self.alfy,self.dy,self.dpy)]):
+            sqrtbeta = _np.sqrt(beta)
+            particles[:,2*i]   = sqrtbeta*u[:,2*i] + d*pt
+            particles[:,2*i+1] = (u[:,2*i+1] - alpha*u[:,2*i])/sqrtbeta + dp*pt
+        return particles
+
+    def _Emittances(self):
+        return _np.array([self.emitx, self.emitx, self.emity, self.emity])
+
+def _UnitSphere4D(n, rng):
+    """n points uniformly distributed on the surface of the 4D unit sphere."""
+    u = rng.standard_normal((n,4))
+    return u / _np.sqrt((u**2).sum(axis=1))[:,None]
+
+class WaterbagGenerator(_MatchedGenerator):
+    """
+    Matched 4D waterbag beam - uniformly filled hyperellipsoid in
+    (x, px, y, py) with the given rms emittances. The edge is at 6 times the
+    rms emittance in each plane.
+    """
+    def _Normalised(self, n, rng):
+        radius = rng.uniform(size=n)**0.25
+        return _UnitSphere4D(n, rng) * radius[:,None] * _np.sqrt(6*self._Emittances())
+
+class KVGenerator(_MatchedGenerator):
+    """
+    Matched Kapchinskij-Vladimirskij beam - uniformly populated surface of
+    the 4D hyperellipsoid in (x, px, y, py) with the given rms emittances.
+    The projection onto (x, y) is a uniform ellipse. The surface is at 4 times
+    the rms emittance in each plane.
+    """
+    def _Normalised(self, n, rng):
+        return _UnitSphere4D(n, rng) * _np.sqrt(4*self._Emittances())
+
+class ShellGenerator(_MatchedGenerator):
+    """
+    Ring in normalised phase space of each plane at nsigmax (nsigmay) times
+    the rms beam size, with random phase. Set nsigmay to 0 for a ring in x
+    only.
+    """
+    def __init__(self, nsigmax=1.0, nsigmay=1.0, **kwargs):
+        _MatchedGenerator.__init__(self, **kwargs)
+        self.nsigmax = nsigmax
+        self.nsigmay = nsigmay
+
+    def _Normalised(self, n, rng):
+        phase  = rng.uniform(0, 2*_np.pi, size=(n,2))
+        radius = _np.array([self.nsigmax, self.nsigmay]) * _np.sqrt([self.emitx, self.emity])
+        u = _np.empty((n,4))
+        u[:,0::2] =  radius * _np.cos(phase)
+        u[:,1::2] = -radius * _np.sin(phase)
+        return u
+
+class HaloGenerator(_MatchedGenerator):
+    """
+    Flat-top core with a power law halo in normalised phase space, in each
+    plane independently. Radii are in units of the rms beam size.
+
+    coreradius   - edge of the uniformly filled core
+    haloradius   - outer edge of the halo
+    halofraction - fraction of particles in the halo
+    halopower    - the halo density falls as r^-halopower
+    """
+    def __init__(self, coreradius=2.0, haloradius=10.0, halofraction=0.01, halopower=3.0, **kwargs):
+        _MatchedGenerator.__init__(self, **kwargs)
+        self.coreradius   = coreradius
+        self.haloradius   = haloradius
+        self.halofraction = halofraction
+        self.halopower    = halopower
+
+    def _Radii(self, n, rng):
+        """Radii in units of the rms beam size for one plane."""
+        u      = rng.uniform(size=n)
+        halo   = rng.uniform(size=n) < self.halofraction
+        radius = self.coreradius * _np.sqrt(u)
+        rc, rh, q = self.coreradius, self.haloradius, 2.0 - self.halopower
+        if q == 0:
+            radius[halo] = rc * (rh/rc)**u[halo]
+        else:
+            radius[halo] = (rc**q + u[halo]*(rh**q - rc**q))**(1.0/q)
+        return radius
+
+    def _Normalised(self, n, rng):
+        u = _np.empty((n,4))
+        for i,emittance in enumerate([self.emitx, self.emity]):
+            radius = self._Radii(n, rng) * _np.sqrt(emittance)
+            phase  = rng.uniform(0, 2*_np.pi, size=n)
+            u[:,2*i]   =  radius * _np.cos(phase)
+            u[:,2*i+1] = -radius * _np.sin(phase)
+        return u
+
+class DispersionGaussGenerator(_MatchedGenerator):
+    """
+    Matched gaussian beam including the correlation of x, px, y and py with
+    pt through the dispersion.
+    """
+    def _Normalised(self, n, rng):
+        return rng.standard_normal((n,4)) * _np.sqrt(self._Emittances())
@@ -3,11 +3,19 @@ Analysis utilities for PTC data.
 """
 
 from . import Ptc as _Ptc
+from . import Data as _Data
 from .Data import Tfs as _Tfs
+import ctypes as _ctypes
+import gzip as _gzip
+import math as _math
+import multiprocessing as _multiprocessing
 import numpy as _np
 import csv
 import time
 
+# Variables of the moments used for the optical functions
+_X, _XP, _Y, _YP, _E, _S = range(6)
+
 class PtcAnalysis(object):
     """
     Deprecated.
@@ -18,7 +26,14 @@ class PtcAnalysis(object):
     in rebdsim.
 
     """
-    def __init__(self,ptcInput = None, ptcOutput = None) : 
+    def __init__(self,ptcInput = None, ptcOutput = None, stream = False) : 
+        """
+        ptcInput  - inrays file name or Ptc.Inrays instance
+        ptcOutput - PTC track output file name or Data.Tfs instance
+        stream    - if True, do not load the output file. It is read in
+                    chunks when the optical functions are calculated so
+                    that files larger than memory can be analysed.
+        """
 
         # Load input rays 
         if type(ptcInput) == str: 
@@ -27,7 +42,7 @@ class PtcAnalysis(object):
             self.ptcInput = ptcInput 
 
         # Load output rays 
-        if type(ptcOutput) == str:
+        if type(ptcOutput) == str and not stream:
             self.ptcOutput = _Tfs(ptcOutput)
         else : 
             self.ptcOutput = ptcOutput
@@ -44,395 +59,506 @@ class PtcAnalysis(object):
 
             print(isampler+1, xrms, pxrms, yrms, pyrms)
 
-    def CalculateOpticalFunctions(self, output):
+    def CalculateOpticalFunctions(self, output=None, chunkSize=100000, workers=1, progress=None):
         """
         Calulates optical functions from a PTC output file
-    
-        output - the name of the output file
-        """
-        sampler  = []
-        S        = []
-        betx     = []
-        bety     = []
-        alphx    = []
-        alphy    = []
-        dispx    = []
-        dispy    = []
-        dispxp   = []
-        dispyp   = []
-        emittx   = []
-        emitty   = []
-        sigmax   = []
-        sigmay   = []
-        sigmaxp  = []
-        sigmayp  = []
-        sigmaxxp = []
-        sigmayyp = []
-        meanx    = []
-        meany    = []
-        meanxp   = []
-        meanyp   = []
-        Wgt      = []
-        sigm_emx = []
-        sigm_emy = []
-        sigm_btx = []
-        sigm_bty = []
-        sigm_alx = []
-        sigm_aly = []
-        
-
-        
-        #for segment in ptcOutput.segments:
-        nsegments = len(self.ptcOutput.segments)
-        for isampler in range(1,len(self.ptcOutput.segments)+1):
-            samplerData = self.ptcOutput.GetSegment(isampler)
-            print('segment:', isampler ,'/', nsegments)
-        
-            x  = samplerData.GetColumn('X')
-            y  = samplerData.GetColumn('Y') 
-            xp = samplerData.GetColumn('PX')
-            yp = samplerData.GetColumn('PY')
-            s  = samplerData.GetColumn('S')
-            E0 = samplerData.GetColumn('E')  #this is the specified beam  energy
-            PT = samplerData.GetColumn('PT') # this is defined as pt= deltaE/(p0*c)
-            E=E0*(1+PT) #This is the energy with a spread
-
-            #Calculate sums
-            s_s    = _np.sum(s)
-            x_s    = _np.sum(x)
-            y_s    = _np.sum(y)
-            xp_s   = _np.sum(xp)
-            yp_s   = _np.sum(yp)
-            E_s    = _np.sum(E)
-            EE_s   = _np.sum(E*E)
-            xx_s   = _np.sum(x*x)
-            xxp_s  = _np.sum(x*xp)
-            xpxp_s = _np.sum(xp*xp)
-            xpE_s  = _np.sum(xp*E)
-            xE_s   = _np.sum(x*E)
-            yy_s   = _np.sum(y*y)
-            yyp_s  = _np.sum(y*yp)
-            ypyp_s = _np.sum(yp*yp)
-            ypE_s  = _np.sum(yp*E)
-            yE_s   = _np.sum(y*E)
-
-            wgt   = len(x) #this is a valid for ptc output as weight is always 1
-
-            #normalise
-            s_s    /= wgt
-            x_s    /= wgt
-            y_s    /= wgt
-            xp_s   /= wgt
-            yp_s   /= wgt
-            E_s    /= wgt
-            EE_s   /= wgt
-            xx_s   /= wgt
-            xxp_s  /= wgt
-            xpxp_s /= wgt
-            xpE_s  /= wgt
-            xE_s   /= wgt
-            yy_s   /= wgt
-            yyp_s  /= wgt
-            ypyp_s /= wgt
-            ypE_s  /= wgt
-            yE_s   /= wgt
-            
-            x_sv    = _np.sum(x-_np.mean(x))
-            xx_sv   = _np.sum((x-_np.mean(x))*(x-_np.mean(x)))
-            y_sv    = _np.sum(y-_np.mean(y))
-            yy_sv   = _np.sum((y-_np.mean(y))*(y-_np.mean(y)))
-
-            xp_sv   = _np.sum(xp-_np.mean(xp))
-            xpxp_sv = _np.sum((xp-_np.mean(xp))*(xp-_np.mean(xp)))
-            yp_sv   = _np.sum(yp-_np.mean(yp))
-            ypyp_sv = _np.sum((yp-_np.mean(yp))*(yp-_np.mean(yp)))
-            
-            #Calculate variances/sigmas
-            variance_x = (xx_sv - (x_sv * x_sv)/wgt)/wgt
-            variance_y = (yy_sv - (y_sv * y_sv)/wgt)/wgt
-            sigma_x    = _np.sqrt(variance_x)
-            sigma_y    = _np.sqrt(variance_y)
-            variance_xp = (xpxp_sv - (xp_sv * xp_sv)/wgt)/wgt
-            variance_yp = (ypyp_sv - (yp_sv * yp_sv)/wgt)/wgt
-            sigma_xp   = _np.sqrt(variance_xp)
-            sigma_yp   = _np.sqrt(variance_yp)
-        
-            #Calculate means
-            x_m  = x_s/wgt
-            y_m  = y_s/wgt
-            xp_m = xp_s/wgt
-            yp_m = yp_s/wgt
-        
-            #Calculate sigmas
-            sigma_x_xp = xxp_s - xx_s * xp_s;
-            sigma_y_yp = yyp_s - y_s * yp_s;
-            
-            #####################
-            #Calculate moments for error calculations
-            
-            mx_1_1  = _np.sum((x-x_m)*(xp-xp_m))/wgt
-            mx_0_2  = _np.sum((xp-xp_m)**2)/wgt
-            mx_2_0  = _np.sum((x-x_m)**2)/wgt
-            mx_2_2  = _np.sum((x-x_m)**2*(xp-xp_m)**2)/wgt
-            mx_1_3  = _np.sum((x-x_m)*(xp-xp_m)**3)/wgt
-            mx_3_1  = _np.sum((x-x_m)**3*(xp-xp_m))/wgt
-            mx_4_0  = _np.sum((x-x_m)**4)/wgt
-            mx_0_4  = _np.sum((xp-xp_m)**4)/wgt
-
-            my_1_1  = _np.sum((y-y_m)*(yp-yp_m))/wgt
-            my_0_2  = _np.sum((yp-yp_m)**2)/wgt
-            my_2_0  = _np.sum((y-y_m)**2)/wgt
-            my_2_2  = _np.sum((y-y_m)**2*(yp-yp_m)**2)/wgt
-            my_1_3  = _np.sum((y-y_m)*(yp-yp_m)**3)/wgt
-            my_3_1  = _np.sum((y-y_m)**3*(yp-yp_m))/wgt
-            my_4_0  = _np.sum((y-y_m)**4)/wgt
-            my_0_4  = _np.sum((yp-yp_m)**4)/wgt
-            
-            
-            #caculate higher moment covariances
-            cov_vv_x       = -((-3+wgt)*mx_2_0**2)/((-1+wgt)*wgt)+mx_4_0/wgt
-            cov_vv_xp      = -((-3+wgt)*mx_0_2**2)/((-1+wgt)*wgt)+mx_0_4/wgt
-            cov_cc_xxp_xxp = -((-2+wgt)*mx_1_1**2)/((-1+wgt)*wgt)+(mx_0_2*mx_2_0)/((-1+wgt)*wgt)+mx_2_2/wgt
-            cov_vc_x_xxp   = -((-3+wgt)*mx_1_1*mx_2_0)/((-1+wgt)*wgt)+mx_3_1/wgt
-            cov_vc_xp_xxp  = -((-3+wgt)*mx_1_1*mx_0_2)/((-1+wgt)*wgt)+mx_1_3/wgt
-            cov_vv_x_xp    = (2*mx_1_1**2)/((-1+wgt)*wgt)-(mx_0_2*mx_2_0)/wgt+mx_2_2/wgt
-
-            cov_vv_y       = -((-3+wgt)*my_2_0**2)/((-1+wgt)*wgt)+my_4_0/wgt
-            cov_vv_yp      = -((-3+wgt)*my_0_2**2)/((-1+wgt)*wgt)+my_0_4/wgt
-            cov_cc_yyp_yyp = -((-2+wgt)*my_1_1**2)/((-1+wgt)*wgt)+(my_0_2*my_2_0)/((-1+wgt)*wgt)+my_2_2/wgt
-            cov_vc_y_yyp   = -((-3+wgt)*my_1_1*my_2_0)/((-1+wgt)*wgt)+my_3_1/wgt
-            cov_vc_yp_yyp  = -((-3+wgt)*my_1_1*my_0_2)/((-1+wgt)*wgt)+my_1_3/wgt
-            cov_vv_y_yp    = (2*my_1_1**2)/((-1+wgt)*wgt)-(my_0_2*my_2_0)/wgt+my_2_2/wgt
- 
-            #Calculate the moments using the sums
-            xx_s   -= x_s*x_s
-            xxp_s  -= x_s*xp_s
-            xpxp_s -= xp_s*xp_s
-            yy_s   -= y_s*y_s  
-            yyp_s  -= y_s*yp_s
-            ypyp_s -= yp_s*yp_s
-
-            #Calculate emittance
-            emitt_x = _np.sqrt(xx_s*xpxp_s - xxp_s*xxp_s)
-            emitt_y = _np.sqrt(yy_s*ypyp_s - yyp_s*yyp_s)
-
-            #Calculate optical functions
-            beta_x  =  xx_s  / emitt_x;
-            beta_y  =  yy_s  / emitt_y;
-            alph_x  = -xxp_s / emitt_x;
-            alph_y  = -yyp_s / emitt_y;
-            
-            #if there is no energy spread it is expected that the dispersion would evaluate to inf, hence ignore
-            #'divide by 0' runtime warning
-            with _np.errstate(divide='ignore'):
-                disp_x  = (xE_s  - (x_s  * E_s)) / (EE_s - (E_s * E_s))
-                disp_xp = (xpE_s - (xp_s * E_s)) / (EE_s - (E_s * E_s))
-                disp_y  = (yE_s  - (y_s  * E_s)) / (EE_s - (E_s * E_s))
-                disp_yp = (ypE_s - (yp_s * E_s)) / (EE_s - (E_s * E_s))
-            
 
-            #error calculation
-            d_emx_d_xx   = xpxp_s/(2*emitt_x)
-            d_emx_d_xxp  = -xxp_s/emitt_x
-            d_emx_d_xpxp = xx_s/(2*emitt_x)
-            
-            var_emitt_x = (d_emx_d_xx)**2*cov_vv_x+(d_emx_d_xxp)**2*cov_cc_xxp_xxp+(d_emx_d_xpxp)**2*cov_vv_xp
-            var_emitt_x += 2*(d_emx_d_xx*d_emx_d_xxp)*cov_vc_x_xxp+2*(d_emx_d_xx*d_emx_d_xpxp)*cov_vv_x_xp
-            var_emitt_x += 2*(d_emx_d_xxp*d_emx_d_xpxp)*cov_vc_xp_xxp
-            
-            sigma_emitt_x = _np.sqrt(var_emitt_x)
-
-            d_emy_d_yy   = ypyp_s/(2*emitt_y)
-            d_emy_d_yyp  = -yyp_s/emitt_y
-            d_emy_d_ypyp = yy_s/(2*emitt_y)
-
-            var_emitt_y = (d_emy_d_yy)**2*cov_vv_y+(d_emy_d_yyp)**2*cov_cc_yyp_yyp+(d_emy_d_ypyp)**2*cov_vv_yp
-            var_emitt_y += 2*(d_emy_d_yy*d_emy_d_yyp)*cov_vc_y_yyp+2*(d_emy_d_yy*d_emy_d_ypyp)*cov_vv_y_yp
-            var_emitt_y += 2*(d_emy_d_yyp*d_emy_d_ypyp)*cov_vc_yp_yyp
-            
-            sigma_emitt_y = _np.sqrt(var_emitt_y)
-         
-            d_btx_d_xx   = (xx_s*xpxp_s-2*xxp_s**2)/(2*(xx_s*xpxp_s - xxp_s*xxp_s)**(3./2.))
-            d_btx_d_xxp  = (xx_s*xxp_s)/((xx_s*xpxp_s - xxp_s*xxp_s)**(3./2.))
-            d_btx_d_xpxp = -(xx_s**2)/(2*(xx_s*xpxp_s - xxp_s*xxp_s)**(3./2.))
-
-            var_beta_x = (d_btx_d_xx)**2*cov_vv_x+(d_btx_d_xxp)**2*cov_cc_xxp_xxp+(d_btx_d_xpxp)**2*cov_vv_xp
-            var_beta_x+= 2*(d_btx_d_xx*d_btx_d_xxp)*cov_vc_x_xxp+2*(d_btx_d_xx*d_btx_d_xpxp)*cov_vv_x_xp
-            var_beta_x+= 2*(d_btx_d_xxp*d_btx_d_xpxp)*cov_vc_xp_xxp
-            
-            sigma_beta_x = _np.sqrt(var_beta_x)
-
-            d_bty_d_yy   = (yy_s*ypyp_s-2*yyp_s**2)/(2*(yy_s*ypyp_s - yyp_s*yyp_s)**(3./2.))
-            d_bty_d_yyp  = (yy_s*yyp_s)/((yy_s*ypyp_s - yyp_s*yyp_s)**(3./2.))
-            d_bty_d_ypyp = -(yy_s**2)/(2*(yy_s*ypyp_s - yyp_s*yyp_s)**(3./2.))
-
-            var_beta_y = (d_bty_d_yy)**2*cov_vv_y+(d_bty_d_yyp)**2*cov_cc_yyp_yyp+(d_bty_d_ypyp)**2*cov_vv_yp
-            var_beta_y+= 2*(d_bty_d_yy*d_bty_d_yyp)*cov_vc_y_yyp+2*(d_bty_d_yy*d_bty_d_ypyp)*cov_vv_y_yp
-            var_beta_y+= 2*(d_bty_d_yyp*d_bty_d_ypyp)*cov_vc_yp_yyp
-            
-            sigma_beta_y = _np.sqrt(var_beta_y)
-
-            d_alx_d_xx   = -(xxp_s*xpxp_s)/(2*(xx_s*xpxp_s - xxp_s*xxp_s)**(3./2.))
-            d_alx_d_xxp  = (xx_s*xpxp_s)/((xx_s*xpxp_s - xxp_s*xxp_s)**(3./2.))
-            d_alx_d_xpxp = -(xx_s*xxp_s)/(2*(xx_s*xpxp_s - xxp_s*xxp_s)**(3./2.))
-
-            var_alph_x = (d_alx_d_xx)**2*cov_vv_x+(d_alx_d_xxp)**2*cov_cc_xxp_xxp+(d_alx_d_xpxp)**2*cov_vv_xp
-            var_alph_x+= 2*(d_alx_d_xx*d_alx_d_xxp)*cov_vc_x_xxp+2*(d_alx_d_xx*d_alx_d_xpxp)*cov_vv_x_xp
-            var_alph_x+= 2*(d_alx_d_xxp*d_alx_d_xpxp)*cov_vc_xp_xxp
-            
-            sigma_alph_x = _np.sqrt(var_alph_x)
+        output    - the name of the output file. A name ending in .npz is
+                    written in numpy binary format (see LoadOpticalFunctions),
+                    otherwise as tab separated text. None for no file.
+        chunkSize - number of lines read at a time when streaming
+        workers   - number of processes to share the samplers between
+                    (loaded, not streamed, output only)
+        progress  - optional function called as progress(done, total)
+                    as the work proceeds; total is None when streaming
+
+        The moments of all samplers are accumulated in a single pass over
+        the track table grouped by segment (see Ptc.Moments).
+
+        The optical functions are stored in self.opticalFunctions as a
+        dictionary of arrays and returned as a Data.Tfs instance (see
+        OpticalFunctionsTfs) that can be used with Plot and Compare.
+        """
+        if type(self.ptcOutput) == str:
+            segments = {}
+            moments  = StreamOpticsMoments(self.ptcOutput, chunkSize, progress, segments)
+            names    = [segments.get(i+1, 'SAMPLER'+str(i+1)) for i in range(moments.ngroups)]
+        else:
+            moments = self._OpticsMoments(workers, progress)
+            names   = self.ptcOutput.segments
+
+        self.opticalFunctions = OpticalFunctions(moments)
+        if len(names) == moments.ngroups:
+            self.opticalFunctions['name'] = _np.array(names)
+        if output is not None and output.endswith('.npz'):
+            _np.savez(output, **self.opticalFunctions)
+        elif output is not None:
+            WriteOpticalFunctions(self.opticalFunctions, output)
+        return OpticalFunctionsTfs(self.opticalFunctions)
+
+    def _Variables(self):
+        """
+        Return the (N,6) array of x, px, y, py, E, S, the sampler index of
+        each row and the number of samplers of the loaded output.
+        """
+        data = self.ptcOutput
+        if type(data) == str:
+            raise ValueError("The PTC output must be loaded, not streamed, for this")
+        ngroups = len(data.segments)
+        groups  = _np.array(data.GetColumn('SEGMENT'), dtype=int) - 1
+        valid   = (groups >= 0) & (groups < ngroups)
+        E0      = data.GetColumn('E')  #this is the specified beam  energy
+        PT      = data.GetColumn('PT') # this is defined as pt= deltaE/(p0*c)
+        columns = [data.GetColumn('X'), data.GetColumn('PX'),
+                   data.GetColumn('Y'), data.GetColumn('PY'),
+                   E0*(1+PT), #This is the energy with a spread
+                   data.GetColumn('S')]
+        return _np.array(columns).T[valid], groups[valid], ngroups
+
+    def _OpticsMoments(self, workers=1, progress=None):
+        variables, groups, ngroups = self._Variables()
+
+        if workers <= 1:
+            moments = OpticsMoments(ngroups)
+            moments.Update(variables, groups)
+            if progress is not None:
+                progress(1, 1)
+            return moments
+        return _ParallelOpticsMoments(variables, groups, ngroups, workers, progress)
+
+    def ResampledOpticalFunctions(self, method='bootstrap', nresamples=1000,
+                                  confidence=0.6827, rng=None):
+        """
+        Statistical errors and confidence intervals of the optical
+        functions of every sampler by resampling the particles.
+
+        method     - 'bootstrap' : nresamples resamples with replacement,
+                                   percentile confidence intervals
+                     'jackknife' : all leave-one-out samples, intervals
+                                   from the jackknife error assuming a
+                                   normal distribution
+        nresamples - number of bootstrap resamples
+        confidence - probability content of the intervals
+        rng        - random number generator for the bootstrap, e.g.
+                     numpy.random.RandomState(seed)
+
+        Returns a dictionary with 'Segment' and, for each of beta, alph,
+        disp, dispp (dispersion of px or py), emitt, sigma, sigmap,
+        sigma_uup (covariance of u and pu) and mean, meanp in x and y,
+        e.g. 'beta_x', the value and 'error_beta_x', 'lower_beta_x' and
+        'upper_beta_x' arrays over the samplers.
+        """
+        if method not in ('bootstrap', 'jackknife'):
+            raise ValueError("Unknown method '" + str(method) + "'")
+        if rng is None:
+            rng = _np.random
+        variables, groups, ngroups = self._Variables()
+        variables = variables[:,:_S] # the position is not resampled
+        order     = _np.argsort(groups, kind='mergesort')
+        variables = variables[order]
+        starts    = _np.searchsorted(groups[order], _np.arange(ngroups+1))
+
+        result = {'Segment' : list(range(1, ngroups+1))}
+        lowerq = 100*(1-confidence)/2.0
+        upperq = 100*(1+confidence)/2.0
+        z      = _NormalQuantile(0.5 + confidence/2.0)
+        for g in range(ngroups):
+            v = variables[starts[g]:starts[g+1]]
+            v = v - v.mean(axis=0) # shift for precision; added back to the means
+            products = _Products(v)
+            value    = _OpticsFromSums(products.sum(axis=0))
+            if method == 'bootstrap':
+                samples = _OpticsFromSums(_BootstrapSums(products, nresamples, rng))
+            else:
+                samples = _OpticsFromSums(products.sum(axis=0) - products)
+            shift = variables[starts[g]:starts[g+1]].mean(axis=0)
+            for key in value:
+                if key in _MEANS:
+                    value[key]   += shift[_MEANS[key]]
+                    samples[key] += shift[_MEANS[key]]
+                if key not in result:
+                    for prefix in ['', 'error_', 'lower_', 'upper_']:
+                        result[prefix+key] = _np.zeros(ngroups)
+                result[key][g] = value[key]
+                if method == 'bootstrap':
+                    result['error_'+key][g] = _np.std(samples[key], ddof=1)
+                    result['lower_'+key][g] = _np.percentile(samples[key], lowerq)
+                    result['upper_'+key][g] = _np.percentile(samples[key], upperq)
+                else:
+                    n = len(samples[key])
+                    error = _np.sqrt((n-1.0)/n * ((samples[key] - samples[key].mean())**2).sum())
+                    result['error_'+key][g] = error
+                    result['lower_'+key][g] = value[key] - z*error
+                    result['upper_'+key][g] = value[key] + z*error
+        return result
+
+# Pairs of x, px, y, py, E for the second order products used by resampling
+_PAIRS = [(i,j) for i in range(5) for j in range(i,5)]
+_MEANS = {'mean_x':_X, 'mean_xp':_XP, 'mean_y':_Y, 'mean_yp':_YP}
+
+def _Products(v):
+    """(n,21) array of 1, the 5 variables and their 15 second order products."""
+    return _np.hstack([_np.ones((len(v),1)), v] + [(v[:,i]*v[:,j])[:,None] for i,j in _PAIRS])
+
+def _BootstrapSums(products, nresamples, rng, maxentries=2000000):
+    """
+    Sums of the products for nresamples resamples with replacement. The
+    resamples are drawn as blocks of index arrays and turned into counts
+    of each particle with one bincount, so each block is a single matrix
+    product.
+    """
+    n      = len(products)
+    block  = max(1, min(nresamples, maxentries // max(n,1)))
+    sums   = []
+    for start in range(0, nresamples, block):
+        b       = min(block, nresamples - start)
+        index   = rng.randint(0, n, size=(b,n)) + n*_np.arange(b)[:,None]
+        counts  = _np.bincount(index.ravel(), minlength=b*n).reshape(b,n)
+        sums.append(counts.dot(products))
+    return _np.vstack(sums)
+
+def _OpticsFromSums(sums):
+    """
+    Optical functions from (..., 21) sums of the products of _Products.
+    Returns a dictionary of arrays of the leading shape.
+    """
+    sums  = _np.asarray(sums, dtype=float)
+    w     = sums[...,0]
+    mean  = sums[...,1:6] / w[...,None]
+    cov   = {}
+    for k,(i,j) in enumerate(_PAIRS):
+        cov[i,j] = sums[...,6+k]/w - mean[...,i]*mean[...,j]
+    result = {}
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        for u,up,name in [(_X,_XP,'x'),(_Y,_YP,'y')]:
+            emitt = _np.sqrt(cov[u,u]*cov[up,up] - cov[u,up]**2)
+            result['emitt_'+name]  = emitt
+            result['beta_'+name]   =  cov[u,u]  / emitt
+            result['alph_'+name]   = -cov[u,up] / emitt
+            result['disp_'+name]   = cov[u,_E]  / cov[_E,_E]
+            result['disp_'+name+'p'] = cov[up,_E] / cov[_E,_E]
+            result['sigma_'+name]  = _np.sqrt(cov[u,u])
+            result['sigma_'+name+'p'] = _np.sqrt(cov[up,up])
+            result['sigma_'+name+'_'+name+'p'] = cov[u,up]
+            result['mean_'+name]   = mean[...,u]
+            result['mean_'+name+'p'] = mean[...,up]
+    return result
+
+def _NormalQuantile(p):
+    """Inverse of the standard normal cumulative distribution by bisection."""
+    low, high = -40.0, 40.0
+    for i in range(200):
+        middle = 0.5*(low + high)
+        if 0.5*(1 + _math.erf(middle/_math.sqrt(2))) < p:
+            low = middle
+        else:
+            high = middle
+    return 0.5*(low + high)
+
+# column arrays shared with the worker processes of _ParallelOpticsMoments
+_shared = {}
+
+def _InitialiseWorker(variables, groups, shape):
+    _shared['variables'] = _np.frombuffer(variables).reshape(shape)
+    _shared['groups']    = _np.frombuffer(groups, dtype=_np.int64)
+
+def _SamplerBlockMoments(task):
+    """Moments of the rows start to stop of the shared, sorted, arrays."""
+    start, stop, ngroups = task
+    moments = OpticsMoments(ngroups)
+    moments.Update(_shared['variables'][start:stop], _shared['groups'][start:stop])
+    return moments
+
+def _ParallelOpticsMoments(variables, groups, ngroups, workers, progress=None):
+    """
+    Sort the rows by sampler into shared memory and accumulate the moments
+    of blocks of samplers in a pool of processes. Only the row ranges and
+    the (small) moments of each block are sent between processes.
+    """
+    order   = _np.argsort(groups, kind='mergesort')
+    sharedv = _multiprocessing.RawArray(_ctypes.c_double, variables.size)
+    sharedg = _multiprocessing.RawArray(_ctypes.c_int64, groups.size)
+    _np.frombuffer(sharedv).reshape(variables.shape)[:] = variables[order]
+    _np.frombuffer(sharedg, dtype=_np.int64)[:] = groups[order]
+
+    # a few blocks of whole samplers per worker for load balancing
+    nblocks    = min(4*workers, max(ngroups, 1))
+    boundaries = _np.searchsorted(_np.frombuffer(sharedg, dtype=_np.int64),
+                                  _np.linspace(0, ngroups, nblocks+1).astype(int))
+    tasks = [(boundaries[i], boundaries[i+1], ngroups) for i in range(nblocks)]
+
+    moments = OpticsMoments(ngroups)
+    pool = _multiprocessing.Pool(workers, _InitialiseWorker, (sharedv, sharedg, variables.shape))
+    try:
+        for i,block in enumerate(pool.imap_unordered(_SamplerBlockMoments, tasks)):
+            moments.Merge(block)
+            if progress is not None:
+                progress(i+1, nblocks)
+    finally:
+        pool.close()
+        pool.join()
+    return moments
+
+def IterTrack(filename, chunkSize=100000, names=None):
+    """
+    Read a PTC track (trackone) output file in chunks of about chunkSize
+    lines without loading the whole file.
 
-            
-            d_aly_d_yy   = -(yyp_s*ypyp_s)/(2*(yy_s*ypyp_s - yyp_s*yyp_s)**(3./2.))
-            d_aly_d_yyp  = (yy_s*ypyp_s)/((yy_s*ypyp_s - yyp_s*yyp_s)**(3./2.))
-            d_aly_d_ypyp = -(yy_s*yyp_s)/(2*(yy_s*ypyp_s - yyp_s*yyp_s)**(3./2.))
+    Yields (segments, data, columns) where segments is the segment number
+    of each row (0 before the first segment line), data the (N,ncolumns)
+    array of the numerical columns and columns their names. If a dictionary
+    is given as names, the segment names are added to it by number.
+    """
+    if filename.endswith('.gz'):
+        f = _gzip.open(filename, 'rb')
+    else:
+        f = open(filename, 'rb')
+    columns = None
+    segment = 0
+    try:
+        while True:
+            lines = f.readlines(chunkSize*150) # approximate bytes per line
+            if not lines:
+                break
+            if not isinstance(lines[0], str):
+                lines = [l.decode('ascii') for l in lines]
+            rows     = []
+            segments = []
+            for line in lines:
+                c = line[:1]
+                if c == '#':
+                    sl = line.split()
+                    segment = int(sl[1])
+                    if names is not None:
+                        names[segment] = sl[-1]
+                elif c == '*':
+                    columns = line.split()[1:]
+                elif c != '@' and c != '$' and line.strip():
+                    rows.append(line)
+                    segments.append(segment)
+            if not rows:
+                continue
+            if columns is None:
+                raise IOError("No column names found before the data in "+filename)
+            data = _np.fromstring(''.join(rows), sep=' ')
+            if len(data) != len(rows)*len(columns):
+                raise IOError("Non numerical or missing data in "+filename)
+            yield _np.array(segments), data.reshape(len(rows), len(columns)), columns
+    finally:
+        f.close()
+
+def StreamOpticsMoments(filename, chunkSize=100000, progress=None, names=None):
+    """
+    Return an OpticsMoments instance for a PTC track output file, read in
+    chunks with bounded memory. progress is called as progress(rows, None)
+    after each chunk if given. See IterTrack for names.
+    """
+    moments = OpticsMoments(0)
+    rows    = 0
+    for segments, data, columns in IterTrack(filename, chunkSize, names):
+        c = dict((name,i) for i,name in enumerate(columns))
+        groups = segments - 1
+        valid  = groups >= 0
+        E = data[:,c['E']]*(1 + data[:,c['PT']])
+        variables = _np.array([data[:,c['X']], data[:,c['PX']], data[:,c['Y']],
+                               data[:,c['PY']], E, data[:,c['S']]]).T
+        moments.Update(variables[valid], groups[valid])
+        rows += len(data)
+        if progress is not None:
+            progress(rows, None)
+    return moments
+
+_COLUMNS = {'x':_X, 'xp':_XP, 'px':_XP, 'y':_Y, 'yp':_YP, 'py':_YP, 'e':_E, 's':_S}
+
+def _Exponent(**powers):
+    p = [0]*6
+    for name,power in powers.items():
+        if name not in _COLUMNS:
+            raise ValueError("Unknown column '"+name+"' - must be one of "+", ".join(sorted(_COLUMNS)))
+        p[_COLUMNS[name]] = power
+    return tuple(p)
+
+def OpticsMoments(nsamplers):
+    """
+    Return a Ptc.Moments instance for the columns x, px, y, py, E, S
+    grouped by sampler, with the moments needed by OpticalFunctions: up to
+    fourth order in each transverse plane and the covariances with E.
+    """
+    exponents = []
+    for u,up in [('x','xp'),('y','yp')]:
+        for i in range(5):
+            exponents.append(_Exponent(**{u:i, up:4-i}))
+        exponents.append(_Exponent(**{u:1, 'e':1}))
+        exponents.append(_Exponent(**{up:1, 'e':1}))
+    exponents.append(_Exponent(e=2))
+    return _Ptc.Moments(6, exponents, nsamplers)
+
+def _PlaneOpticalFunctions(moments, u, up):
+    """
+    Emittance, twiss parameters and their statistical errors for one
+    plane, for all samplers.
+    """
+    def m(i, j):
+        return moments.Central(_Exponent(**{u:i, up:j}))
+
+    wgt   = moments.n
+    m_1_1 = m(1,1)
+    m_0_2 = m(0,2)
+    m_2_0 = m(2,0)
+    m_2_2 = m(2,2)
+    m_1_3 = m(1,3)
+    m_3_1 = m(3,1)
+    m_4_0 = m(4,0)
+    m_0_4 = m(0,4)
+
+    #caculate higher moment covariances
+    cov_vv_u       = -((-3+wgt)*m_2_0**2)/((-1+wgt)*wgt)+m_4_0/wgt
+    cov_vv_up      = -((-3+wgt)*m_0_2**2)/((-1+wgt)*wgt)+m_0_4/wgt
+    cov_cc_uup_uup = -((-2+wgt)*m_1_1**2)/((-1+wgt)*wgt)+(m_0_2*m_2_0)/((-1+wgt)*wgt)+m_2_2/wgt
+    cov_vc_u_uup   = -((-3+wgt)*m_1_1*m_2_0)/((-1+wgt)*wgt)+m_3_1/wgt
+    cov_vc_up_uup  = -((-3+wgt)*m_1_1*m_0_2)/((-1+wgt)*wgt)+m_1_3/wgt
+    cov_vv_u_up    = (2*m_1_1**2)/((-1+wgt)*wgt)-(m_0_2*m_2_0)/wgt+m_2_2/wgt
+
+    def Variance(d_uu, d_uup, d_upup):
+        var  = d_uu**2*cov_vv_u + d_uup**2*cov_cc_uup_uup + d_upup**2*cov_vv_up
+        var += 2*d_uu*d_uup*cov_vc_u_uup + 2*d_uu*d_upup*cov_vv_u_up
+        var += 2*d_uup*d_upup*cov_vc_up_uup
+        return var
+
+    uu, uup, upup = m_2_0, m_1_1, m_0_2
+    det   = uu*upup - uup*uup
+    emitt = _np.sqrt(det)
+    d32   = det**(3./2.)
+
+    result = {}
+    result['emitt'] = emitt
+    result['beta']  =  uu  / emitt
+    result['alph']  = -uup / emitt
+    result['sigma_emitt'] = _np.sqrt(Variance(upup/(2*emitt), -uup/emitt, uu/(2*emitt)))
+    result['sigma_beta']  = _np.sqrt(Variance((uu*upup-2*uup**2)/(2*d32), (uu*uup)/d32, -(uu**2)/(2*d32)))
+    result['sigma_alph']  = _np.sqrt(Variance(-(uup*upup)/(2*d32), (uu*upup)/d32, -(uu*uup)/(2*d32)))
+    return result
+
+def OpticalFunctions(moments):
+    """
+    Return the dictionary of optical functions per sampler, as
+    PtcAnalysis.opticalFunctions, from an OpticsMoments instance. The
+    values are arrays over the samplers. The dispersion is with respect
+    to the energy E. 'energy' is the mean energy.
+    """
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        of = {'Segment' : _np.arange(1, moments.ngroups+1),
+              'S'       : moments.mean[:,_S].copy(),
+              'energy'  : moments.mean[:,_E].copy(),
+              'wgt'     : moments.n.astype(int)}
+        #if there is no energy spread it is expected that the dispersion would evaluate to inf
+        varE = moments.Central(_Exponent(e=2))
+        for u,up,name in [('x','xp','x'),('y','yp','y')]:
+            plane = _PlaneOpticalFunctions(moments, u, up)
+            for key,value in plane.items():
+                of[key+'_'+name] = value
+            of['disp_'+name]   = moments.Central(_Exponent(**{u:1,  'e':1})) / varE
+            of['disp_'+name+'p'] = moments.Central(_Exponent(**{up:1, 'e':1})) / varE
+            of['sigma_'+name]    = _np.sqrt(moments.Central(_Exponent(**{u:2})))
+            of['sigma_'+name+'p'] = _np.sqrt(moments.Central(_Exponent(**{up:2})))
+            of['sigma_'+name+'_'+name+'p'] = moments.Central(_Exponent(**{u:1, up:1}))
+            of['mean_'+name]   = moments.mean[:,_COLUMNS[u]].copy()
+            of['mean_'+name+'p'] = moments.mean[:,_COLUMNS[up]].copy()
+    return of
+
+# Tfs column and opticalFunctions key of each column of OpticalFunctionsTfs
+_TFSCOLUMNS = [('BETX','beta_x'), ('BETY','beta_y'), ('ALFX','alph_x'), ('ALFY','alph_y'),
+               ('EMITX','emitt_x'), ('EMITY','emitt_y'),
+               ('SIGMAX','sigma_x'), ('SIGMAY','sigma_y'),
+               ('SIGMAXP','sigma_xp'), ('SIGMAYP','sigma_yp'),
+               ('SIGMAXXP','sigma_x_xp'), ('SIGMAYYP','sigma_y_yp'),
+               ('X','mean_x'), ('Y','mean_y'), ('PX','mean_xp'), ('PY','mean_yp'),
+               ('BETXERR','sigma_beta_x'), ('BETYERR','sigma_beta_y'),
+               ('ALFXERR','sigma_alph_x'), ('ALFYERR','sigma_alph_y'),
+               ('EMITXERR','sigma_emitt_x'), ('EMITYERR','sigma_emitt_y'),
+               ('WGT','wgt')]
+
+def OpticalFunctionsTfs(of):
+    """
+    Return a Data.Tfs instance with one row per sampler from a dictionary of
+    optical functions (see OpticalFunctions) for use with Plot and Compare.
+
+    Columns are NAME, KEYWORD (MARKER), S, L and K1L (0) so a machine diagram
+    can be drawn, the MADX style optical functions BETX, ALFX, DX, DPX etc.,
+    SIGMAX, SIGMAXP, the means X, PX, EMITX, the errors BETXERR, ALFXERR,
+    EMITXERR and WGT, and likewise in y. DX, DPX, DY and DPY are with respect
+    to pt, taking p0 c as the mean energy, and DXBETA etc. are the same as
+    ultra relativistic.
+    """
+    nsamplers = len(of['S'])
+    names     = of['name'] if 'name' in of else ['SAMPLER'+str(i+1) for i in range(nsamplers)]
+    columns   = [('NAME', '%s', list(names)),
+                 ('KEYWORD', '%s', ['MARKER']*nsamplers),
+                 ('S', '%le', of['S']),
+                 ('L', '%le', _np.zeros(nsamplers)),
+                 ('K1L', '%le', _np.zeros(nsamplers))]
+    columns.extend([(column, '%le', of[key]) for column,key in _TFSCOLUMNS])
+    for plane in ['x','y']:
+        for p in ['','p']:
+            d = of['disp_'+plane+p] * of['energy']
+            columns.append(('D'+p.upper()+plane.upper(), '%le', d))
+            columns.append(('D'+p.upper()+plane.upper()+'BETA', '%le', d))
+
+    tfs = _Data.Tfs()
+    timestamp = time.localtime()
+    tfs.header   = {'NAME'   : 'PTCANALYSIS',
+                    'TYPE'   : 'PTCANALYSIS',
+                    'ORIGIN' : 'pymadx',
+                    'DATE'   : time.strftime("%d/%m/%y", timestamp),
+                    'TIME'   : time.strftime("%H.%M.%S", timestamp)}
+    tfs.columns  = [c[0] for c in columns]
+    tfs.formats  = [c[1] for c in columns]
+    values = [list(c[2]) if c[1] == '%s' else _np.asarray(c[2], dtype=float).tolist() for c in columns]
+    for row in zip(*values):
+        tfs._AppendDataEntry(tfs._CheckName(row[0]), list(row))
+    tfs.nsegments = 1
+    if nsamplers > 0:
+        tfs.smin = tfs.data[tfs.sequence[0]][2]
+        tfs.smax = tfs.data[tfs.sequence[-1]][2]
+    return tfs
+
+def LoadOpticalFunctions(filename):
+    """
+    Load optical functions written by CalculateOpticalFunctions in .npz
+    format. Returns a Data.Tfs instance (see OpticalFunctionsTfs).
+    """
+    f = _np.load(filename)
+    of = dict((key, f[key]) for key in f.files)
+    f.close()
+    return OpticalFunctionsTfs(of)
 
-            var_alph_y = (d_aly_d_yy)**2*cov_vv_y+(d_aly_d_yyp)**2*cov_cc_yyp_yyp+(d_aly_d_ypyp)**2*cov_vv_yp
-            var_alph_y+= 2*(d_aly_d_yy*d_aly_d_yyp)*cov_vc_y_yyp+2*(d_aly_d_yy*d_aly_d_ypyp)*cov_vv_y_yp
-            var_alph_y+= 2*(d_aly_d_yyp*d_aly_d_ypyp)*cov_vc_yp_yyp
-            
-            sigma_alph_y = _np.sqrt(var_alph_y)
-            
-            """
-            print "mx_2_0= ",mx_2_0,", mx_0_2= ",mx_0_2,", mx_1_1= ",mx_1_1
-            print "mx_4_0= ",mx_4_0,", mx_0_4= ",mx_0_4
-            print "mx_3_1= ",mx_3_1,", mx_1_3= ",mx_1_3,", mx_2_2= ",mx_2_2
-            print "my_2_0= ",my_2_0,", my_0_2= ",my_0_2,", my_1_1= ",my_1_1
-            print "my_4_0= ",my_4_0,", my_0_4= ",my_0_4
-            print "my_3_1= ",my_3_1,", my_1_3= ",my_1_3,", my_2_2= ",my_2_2
-
-            print "cov_vv_x= ", cov_vv_x,", cov_vv_xp= ",cov_vv_xp,", cov_cc_xxp_xxp= ",cov_cc_xxp_xxp
-            print "cov_vc_x_xxp= ",cov_vc_x_xxp,", cov_vc_xp_xxp= ",cov_vc_xp_xxp,", cov_vv_x_xp=",cov_vv_x_xp
-            print "cov_vv_y= ",cov_vv_y,", cov_vv_yp= ",cov_vv_yp,", cov_cc_yyp_yyp= ",cov_cc_yyp_yyp
-            print "cov_vc_y_yyp= ",cov_vc_y_yyp,", cov_vc_yp_yyp= ",cov_vc_yp_yyp,", cov_vv_y_yp=",cov_vv_y_yp
-           
-            print "dedx= ",d_emx_d_xx," ,dedxp= ",d_emx_d_xpxp,", dedxxp= ",d_emx_d_xxp
-            print "dbdx= ",d_btx_d_xx,",dbdxp= ",d_btx_d_xpxp,", dbdxxp= ",d_btx_d_xxp
-            print "dadx= ",d_alx_d_xx,",dadxp= ",d_alx_d_xpxp,", dadxxp= ",d_alx_d_xxp
-            print "dedy= ",d_emy_d_yy," ,dedyp= ",d_emy_d_ypyp,", dedyyp= ",d_emy_d_yyp
-            print "dbdy= ",d_bty_d_yy,",dbdyp= ",d_bty_d_ypyp,", dbdyyp= ",d_bty_d_yyp
-            print "dady= ",d_aly_d_yy,",dadyp= ",d_aly_d_ypyp,", dadyyp= ",d_aly_d_yyp
-
-            print "var_emitt_x= ",var_emitt_x,", var_beta_x= ",var_beta_x,", var_alph_x= ",var_alph_x
-            print "var_emitt_y= ",var_emitt_y,", var_beta_y= ",var_beta_y,", var_alph_y= ",var_alph_y
-
-            print "Emiitance_x= ",emitt_x," Sigma_Emittance_x = ",sigma_emitt_x, " Frac error= ", sigma_emitt_x/emitt_x 
-            print "Beta_x= ",beta_x," Sigma_Beta_x = ",sigma_beta_x, " Frac error= ", sigma_beta_x/beta_x
-            print "Alpha_x= ",alph_x," Sigma_Alpha_x = ",sigma_alph_x, " Frac error= ", sigma_alph_x/alph_x
-            """
-
-            sampler.append(isampler)
-            S.append(s_s)            
-            betx.append(beta_x)
-            bety.append(beta_y)
-            alphx.append(alph_x)
-            alphy.append(alph_y)
-            dispx.append(disp_x)
-            dispy.append(disp_y)
-            dispxp.append(disp_xp)
-            dispyp.append(disp_yp)
-            emittx.append(emitt_x)
-            emitty.append(emitt_y)
-            sigmax.append(sigma_x)
-            sigmay.append(sigma_y)
-            sigmaxp.append(sigma_xp)
-            sigmayp.append(sigma_yp)
-            sigmaxxp.append(sigma_x_xp)
-            sigmayyp.append(sigma_y_yp)
-            meanx.append(x_m)
-            meany.append(y_m)
-            meanxp.append(xp_m)
-            meanyp.append(yp_m)
-            Wgt.append(wgt)
-            sigm_emx.append(sigma_emitt_x)
-            sigm_emy.append(sigma_emitt_y)
-            sigm_btx.append(sigma_beta_x)
-            sigm_bty.append(sigma_beta_y)
-            sigm_alx.append(sigma_alph_x)
-            sigm_aly.append(sigma_alph_y)
-
-        #prepare header    
-        header = ['Segment','S[m]','Beta_x[m]','Beta_y[m]','Alph_x','Alph_y']
-        header.extend(['Disp_x','Disp_xp','Disp_y','Disp_yp'])
-        header.extend(['Emitt_x','Emitt_y'])
-        header.extend(['Sigma_x[m]','Sigma_y[m]','Sigma_xp[rad]','Sigma_yp[rad]'])
-        header.extend(['Sigma_x_xp[m*rad]','Sigma_y_yp[m*rad]'])
-        header.extend(['Mean_x[m]','Mean_y[m]','Mean_xp[rad]','Mean_yp[rad]','Wgt'])
-        header.extend(['Sigma_emitt_x','Sigma_emitt_y','Sigma_beta_x','Sigma_beta_y'])
-        header.extend(['Sigma_alph_x','Sigma_alph_y'])
-
-
-        #prepare optical function arrays for writing to file
-
-        for i in range(len(S)):
-            """
-            S[i]=float("{0:.4e}".format(S[i]))
-            betx[i]=float("{0:.4e}".format(betx[i]))
-            bety[i]=float("{0:.4e}".format(bety[i]))
-            alphx[i]=float("{0:.4e}".format(alphx[i]))
-            alphy[i]=float("{0:.4e}".format(alphy[i]))
-            dispx[i]=float("{0:.4e}".format(dispx[i]))
-            dispy[i]=float("{0:.4e}".format(dispy[i]))
-            dispxp[i]=float("{0:.4e}".format(dispxp[i]))
-            dispyp[i]=float("{0:.4e}".format(dispyp[i]))
-            emittx[i]=float("{0:.4e}".format(emittx[i]))
-            emitty[i]=float("{0:.4e}".format(emitty[i]))
-            sigmax[i]=float("{0:.4e}".format(sigmax[i]))
-            sigmay[i]=float("{0:.4e}".format(sigmay[i]))
-            sigmaxp[i]=float("{0:.4e}".format(sigmaxp[i]))
-            sigmayp[i]=float("{0:.4e}".format(sigmayp[i]))
-            sigmaxxp[i]=float("{0:.4e}".format(sigmaxxp[i]))
-            sigmayyp[i]=float("{0:.4e}".format(sigmayyp[i]))
-            meanx[i]=float("{0:.4e}".format(meanx[i]))
-            meany[i]=float("{0:.4e}".format(meany[i]))
-            meanxp[i]=float("{0:.4e}".format(meanxp[i]))
-            meanyp[i]=float("{0:.4e}".format(meanyp[i]))
-            Wgt[i]=float("{0:.4e}".format(Wgt[i]))
-            """
-
-        with open(output,'w') as ofile:        
-            writer=csv.writer(ofile, delimiter='\t',lineterminator='\n',)
-            timestamp = time.strftime("%Y/%m/%d-%H:%M:%S")
-            writer.writerow(['# ','Optical functions from PTC output', timestamp])
-            writer.writerow(header)
-            for i in range(len(S)):
-                row = [sampler[i],S[i],betx[i],bety[i],alphx[i],alphy[i],dispx[i],dispy[i]]
-                row.extend([dispxp[i],dispyp[i],emittx[i],emitty[i]])
-                row.extend([sigmax[i],sigmay[i],sigmaxp[i],sigmayp[i],sigmaxxp[i],sigmayyp[i]])
-                row.extend([meanx[i],meany[i],meanxp[i],meanyp[i],Wgt[i]])
-                row.extend([sigm_emx[i],sigm_emy[i],sigm_btx[i],sigm_bty[i]])
-                row.extend([sigm_alx[i],sigm_aly[i]])
-                writer.writerow(row)
-
-        self.opticalFunctions = {
-            'Segment'       : sampler,
-            'S'             : S,
-            'beta_x'        : betx,
-            'beta_y'        : bety,
-            'alph_x'        : alphx,
-            'alph_y'        : alphy,
-            'disp_x'        : dispx,
-            'disp_xp'       : dispxp,
-            'disp_y'        : dispy,
-            'disp_yp'       : dispyp,
-            'emitt_x'       : emittx,
-            'emitt_y'       : emitty,
-            'sigma_x'       : sigmax,
-            'sigma_y'       : sigmay,
-            'sigma_xp'      : sigmaxp,
-            'sigma_yp'      : sigmayp,
-            'sigma_x_xp'    : sigmaxxp,
-            'sigma_y_yp'    : sigmayyp,
-            'mean_x'        : meanx,
-            'mean_y'        : meany,
-            'mean_xp'       : meanxp,
-            'mean_yp'       : meanyp,
-            'wgt'           : Wgt,
-            'sigma_emitt_x' : sigm_emx,
-            'sigma_emitt_y' : sigm_emy,
-            'sigma_beta_x'  : sigm_btx,
-            'sigma_beta_y'  : sigm_bty,
-            'sigma_alph_x'  : sigm_alx,
-            'sigma_alph_y'  : sigm_aly
-            }
-        
+def WriteOpticalFunctions(of, output):
+    """
+    Write a dictionary of optical functions (see OpticalFunctions) to a tab
+    separated file.
+    """
+    #prepare header    
+    header = ['Segment','S[m]','Beta_x[m]','Beta_y[m]','Alph_x','Alph_y']
+    header.extend(['Disp_x','Disp_xp','Disp_y','Disp_yp'])
+    header.extend(['Emitt_x','Emitt_y'])
+    header.extend(['Sigma_x[m]','Sigma_y[m]','Sigma_xp[rad]','Sigma_yp[rad]'])
+    header.extend(['Sigma_x_xp[m*rad]','Sigma_y_yp[m*rad]'])
+    header.extend(['Mean_x[m]','Mean_y[m]','Mean_xp[rad]','Mean_yp[rad]','Wgt'])
+    header.extend(['Sigma_emitt_x','Sigma_emitt_y','Sigma_beta_x','Sigma_beta_y'])
+    header.extend(['Sigma_alph_x','Sigma_alph_y'])
+
+    keys = ['Segment','S','beta_x','beta_y','alph_x','alph_y']
+    keys.extend(['disp_x','disp_xp','disp_y','disp_yp'])
+    keys.extend(['emitt_x','emitt_y'])
+    keys.extend(['sigma_x','sigma_y','sigma_xp','sigma_yp','sigma_x_xp','sigma_y_yp'])
+    keys.extend(['mean_x','mean_y','mean_xp','mean_yp','wgt'])
+    keys.extend(['sigma_emitt_x','sigma_emitt_y','sigma_beta_x','sigma_beta_y'])
+    keys.extend(['sigma_alph_x','sigma_alph_y'])
+
+    with open(output,'w') as ofile:        
+        writer=csv.writer(ofile, delimiter='\t',lineterminator='\n',)
+        timestamp = time.strftime("%Y/%m/%d-%H:%M:%S")
+        writer.writerow(['# ','Optical functions from PTC output', timestamp])
+        writer.writerow(header)
+        for row in zip(*[_np.asarray(of[key]).tolist() for key in keys]):
+            writer.writerow(row)
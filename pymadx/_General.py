@@ -9,6 +9,7 @@ General utilities for day to day housekeeping
 
 import os
 import math
+import numbers as _numbers
 
 def CheckFileExists(filename):
     i = 1
@@ -45,6 +46,8 @@ def Cast(string):
         return string
 
 def IsFloat(stringtotest):
+    if isinstance(stringtotest, _numbers.Real):
+        return True
     try:
         float(stringtotest)
         return True
@@ -21,6 +21,7 @@ from . import Builder
 #import Compare
 #import Convert
 from . import Data
+from . import Optics
 from . import Plot
 from . import Ptc
 from . import PtcAnalysis
@@ -30,6 +31,7 @@ __all__ = ['Beam',
            'Compare',
            'Convert',
            'Data',
+           'Optics',
            'Plot',
            'Ptc',
            'PtcAnalysis']
@@ -0,0 +1,141 @@
+import gzip
+import os
+import pickle
+import re
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+import pymadx
+
+def test_element_numbers():
+    values = [0.1, -2.5e-7, 1e16, 123456.789, 3, np.float64(1.0/3), 5e-324]
+    for value in values:
+        e = pymadx.Builder.Element('q1', 'quadrupole', k1=value, l=(value, 'm'))
+        expected = str(Decimal(str(value)))
+        assert repr(e) == 'q1: quadrupole, k1={0}, l={0}*m;\n'.format(expected) \
+            or repr(e) == 'q1: quadrupole, l={0}*m, k1={0};\n'.format(expected)
+        assert e.length == float(value)
+
+def test_element_strings():
+    e = pymadx.Builder.Element('d1', 'drift', l='0.50', apertype='circle')
+    assert str(e['l']) == '0.50'
+    assert e['apertype'] == '"circle"'
+    assert e.length == 0.5
+    f = pickle.loads(pickle.dumps(e))
+    assert repr(f) == repr(e)
+    assert f.length == e.length
+
+def test_machine_samplers():
+    m = pymadx.Builder.Machine()
+    for i in range(10):
+        m.AddQuadrupole('q{}'.format(i), length=0.5, k1=0.1)
+    m.AddDrift('q3', length=0.5)
+    assert len(m) == 10
+    assert len(m.sequence) == 11
+    assert m['q3'].category == 'quadrupole'
+    assert [e.name for e in m][-1] == 'q3'
+    m.AddSampler(['q1', 'q2'])
+    m.AddSampler('q5')
+    assert [s.name for s in m.samplers] == ['q1', 'q2', 'q5']
+    try:
+        m.AddSampler('q4', 'nothere')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("invalid sampler name accepted")
+    assert len(m.samplers) == 3
+
+def test_write_machine(tmpdir):
+    m = pymadx.Builder.Machine()
+    for i in range(250):
+        m.AddQuadrupole('q{}'.format(i), length=0.5, k1=0.1*(-1)**i)
+        m.AddDrift('d{}'.format(i), length=1e-5*(i+1))
+    m.beam.SetDistributionType('ptc')
+    m.beam.SetDistribFileName('inrays.madx')
+    for compress in (False, True):
+        name = str(tmpdir.join('ring{}'.format(int(compress))))
+        pymadx.Builder.WriteMachine(m, name, compress=compress)
+        fn = name + '_components.madx' + ('.gz' if compress else '')
+        f = gzip.open(fn, 'rt') if compress else open(fn)
+        components = f.readlines()[4:]
+        f.close()
+        assert ''.join(components) == ''.join([str(e) for e in m.elements])
+        with open(name + '_sequence.madx') as f:
+            sequence = f.readlines()[4:]
+        assert sequence[0].startswith('l0: line = (q0, d0, q1,')
+        assert sequence[-2] == 'lattice: line = (l0, l1, l2, l3, l4);\n'
+        with open(name + '.madx') as f:
+            main = f.read()
+        # every call must be to a plain file MADX can read, available once
+        # any gzipped file is decompressed as the main file says
+        calls = re.findall(r"call, file='([^']*)';", main)
+        assert os.path.basename(name + '_components.madx') in calls
+        if compress:
+            assert 'decompress ' + os.path.basename(fn) in main
+            with gzip.open(fn, 'rb') as f, open(fn[:-3], 'wb') as g:
+                g.write(f.read())
+        for call in calls:
+            assert not call.endswith('.gz')
+            assert os.path.exists(os.path.join(str(tmpdir), call))
+
+def test_write_variants(tmpdir):
+    m = pymadx.Builder.Machine()
+    m.AddQuadrupole('qf', length=0.5, k1=0.2)
+    m.AddDrift('d1', length=1.0)
+    m.AddQuadrupole('qd', length=0.5, k1=-0.2)
+    m.beam.SetDistributionType('ptc')
+    m.beam.SetDistribFileName('inrays.madx')
+    name = str(tmpdir.join('fodo'))
+    variants = [{'qf' : {'k1' : 0.2 + 0.01*i}, 'qd' : {'k1' : 'kqd'}, 'kqd' : -0.2}
+                for i in range(12)]
+    fns = m.WriteVariants(name, variants)
+    assert fns == [name + '_{}.madx'.format(i) for i in range(12)]
+    assert sorted(os.listdir(str(tmpdir)))[:3] == ['fodo.madx', 'fodo_0.madx', 'fodo_1.madx']
+    with open(fns[11]) as f:
+        lines = f.readlines()
+    i = lines.index("call, file='fodo_components.madx';\n")
+    assert lines[i+2:i+6] == ['! VARIANT 11\n', 'kqd = -0.2;\n', 'qd->k1 := kqd;\n',
+                              'qf->k1 = 0.31;\n']
+    assert lines[i+7] == "call, file='fodo_sequence.madx';\n"
+    try:
+        m.WriteVariants(str(tmpdir.join('bad')), {'a' : {'nothere' : {'k1' : 1}}})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("invalid element name accepted")
+    assert not tmpdir.join('bad.madx').exists()
+    with pytest.raises(ValueError) as excinfo:
+        m.WriteVariants(str(tmpdir.join('clash')), {'beam' : {'kqd' : -0.2}, 'a' : {}})
+    assert 'beam' in str(excinfo.value)
+    assert not tmpdir.join('clash_beam.madx').exists()
+
+def test_write_machines(tmpdir):
+    machines = []
+    for i in range(11):
+        m = pymadx.Builder.Machine()
+        m.AddQuadrupole('qf', length=0.5, k1=0.1*i)
+        m.AddDrift('d1', length=1.0)
+        m.AddSampler('all')
+        m.beam.SetDistributionType('ptc')
+        m.beam.SetDistribFileName('inrays.madx')
+        machines.append(m)
+    serial = pymadx.Builder.WriteMachines(machines, str(tmpdir.join('serial')))
+    assert serial == [str(tmpdir.join('serial', 'machine_{:02d}.madx'.format(i))) for i in range(11)]
+    for threads in (False, True):
+        d = tmpdir.join('parallel{}'.format(int(threads)))
+        result = pymadx.Builder.WriteMachines(machines, str(d), workers=2, threads=threads)
+        assert [os.path.basename(fn) for fn in result] == [os.path.basename(fn) for fn in serial]
+        for fn in os.listdir(str(d)):
+            with open(str(d.join(fn))) as f, open(str(tmpdir.join('serial', fn))) as g:
+                assert f.readlines()[1:] == g.readlines()[1:]
+    # same names again overwrite the files
+    pymadx.Builder.WriteMachines(machines[:2], str(tmpdir.join('serial')), names=['machine_00', 'machine_01'])
+    assert len(os.listdir(str(tmpdir.join('serial')))) == 11*5
+    try:
+        pymadx.Builder.WriteMachines(machines[:2], str(tmpdir), names=['a', 'a'])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("duplicate names accepted")
@@ -0,0 +1,70 @@
+import os.path
+
+import pytest
+
+import pymadx
+import pymadx.Convert
+
+PATH_TO_TEST_INPUT = "{}/../test_input/".format(
+    os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def atf2():
+    return pymadx.Data.Tfs("{}/atf2-nominal-twiss-v5.2.tfs.tar.gz".format(
+        PATH_TO_TEST_INPUT))
+
+def test_tfs_to_machine(atf2):
+    m = pymadx.Convert.TfsToMachine(atf2)
+    rows = [atf2.GetRowDict(name) for name in atf2.sequence]
+    thick = [row for row in rows if row['L'] >= 1e-9]
+    assert len(m.sequence) == len(thick)
+    assert abs(m.length - sum(row['L'] for row in thick)) < 1e-9
+    quad = atf2.GetRowDict('QM6RX')
+    assert m['QM6RX'].category == 'quadrupole'
+    assert m['QM6RX']['k1'] == quad['K1L'] / quad['L']
+    bend = atf2.GetRowDict('KEX1A')
+    assert m['KEX1A'].category == 'sbend'
+    assert m['KEX1A']['angle'] == bend['ANGLE']
+    assert m['KEX1A']['e1'] == bend['E1']
+    assert m['ZH100RX'].category == 'hkicker'
+    assert 'KEX1MULT1' not in m.elementsd
+
+def test_tfs_to_machine_range(atf2):
+    m = pymadx.Convert.TfsToMachine(atf2, 'QM6RX', 200, ignorezerolengthitems=False)
+    start = atf2.IndexFromName('QM6RX')
+    rows = [atf2.GetRowDict(name) for name in atf2.sequence[start:200]]
+    # zero length items of unknown types (here monitors) are left out
+    assert len(m.sequence) == len([row for row in rows if row['L'] >= 1e-9
+                                   or row['KEYWORD'] != 'MONITOR'])
+    assert m.sequence[0] == 'QM6RX'
+    row = [row for row in rows if row['KEYWORD'] == 'MULTIPOLE'][0]
+    multipole = m[row['NAME']]
+    assert multipole.category == 'multipole'
+    assert multipole['knl'][1] == row['K1L']
+
+def test_tfs_to_ptc_batch(tmpdir):
+    fn = "{}/atf2-nominal-twiss-v5.2.tfs.tar.gz".format(PATH_TO_TEST_INPUT)
+    jobs = [(fn, str(tmpdir.join('all'))),
+            (fn, str(tmpdir.join('part')), 'QM6RX', 200),
+            (str(tmpdir.join('missing.tfs')), str(tmpdir.join('missing'))),
+            (fn, str(tmpdir.join('bad')), 'NOTANELEMENT', None)]
+    for workers in (1, 2):
+        result = pymadx.Convert.TfsToPtcBatch(jobs, 'inrays.madx', workers=workers)
+        assert [job['output'] for job in result] == [job[1] for job in jobs]
+        assert [job['error'] is None for job in result] == [True, True, False, False]
+        assert result[0]['load'] == result[1]['load']
+        assert tmpdir.join('part.madx').exists()
+        assert tmpdir.join('part_sequence.madx').exists()
+        for f in tmpdir.listdir():
+            f.remove()
+
+def test_tfs_to_ptc_batch_checks_columns_once(tmpdir, monkeypatch):
+    module = pymadx.Convert._TfsToPtc
+    checked = []
+    check = module._CheckColumns
+    monkeypatch.setattr(module, '_CheckColumns', lambda madx: checked.append(check(madx)))
+    fn = "{}/atf2-nominal-twiss-v5.2.tfs.tar.gz".format(PATH_TO_TEST_INPUT)
+    jobs = [(fn, str(tmpdir.join('a'))), (fn, str(tmpdir.join('b')), 'QM6RX', 200)]
+    result = pymadx.Convert.TfsToPtcBatch(jobs, 'inrays.madx')
+    assert [job['error'] for job in result] == [None, None]
+    assert len(checked) == 1
@@ -0,0 +1,96 @@
+import gc
+import os.path
+import pickle
+
+import numpy as np
+import pytest
+
+import pymadx
+
+PATH_TO_TEST_INPUT = "{}/../test_input/".format(
+    os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def atf2():
+    return pymadx.Data.Tfs("{}/atf2-nominal-twiss-v5.2.tfs.tar.gz".format(
+        PATH_TO_TEST_INPUT))
+
+def test_interpolate_element_ends(atf2):
+    s = atf2.GetColumn('S')
+    last = np.append(s[1:] != s[:-1], True) # last element at each S
+    d = pymadx.Optics.Interpolate(atf2, s[last])
+    for key in ['BETX', 'ALFX', 'BETY', 'ALFY', 'DX', 'DPX']:
+        ref = atf2.GetColumn(key)[last]
+        assert np.allclose(d[key], ref, rtol=1e-6, atol=1e-6*abs(ref).max())
+
+def test_twiss_matches_madx(atf2):
+    d = pymadx.Optics.Twiss(atf2)
+    for key in ['BETX', 'ALFX', 'MUX', 'BETY', 'ALFY', 'MUY', 'DX', 'DPX']:
+        ref = atf2.GetColumn(key)
+        assert np.allclose(d[key], ref, rtol=1e-6, atol=1e-6*abs(ref).max())
+
+def test_incremental_edit(atf2):
+    o = pymadx.Optics.LinearOptics(atf2)
+    index = atf2.IndexFromName(atf2.GetElementNamesOfType('QUADRUPOLE')[3])
+    atf2.EditComponent(index, 'K1L', 1.05*atf2[index]['K1L'])
+    initial = dict((k.lower(), v) for k, v in o.InitialConditions().items())
+    ref = pymadx.Optics.Twiss(atf2, **initial)
+    d = o.Twiss()
+    for key in ['BETX', 'BETY', 'MUX', 'DX']:
+        assert np.allclose(d[key], ref[key], rtol=1e-9)
+    # a second edit further down only recalculates the rows after it
+    index2 = atf2.IndexFromName(atf2.GetElementNamesOfType('QUADRUPOLE')[20])
+    before = o.Twiss()['BETX'][:index2].copy()
+    atf2.EditComponent(index2, 'K1L', 0.9*atf2[index2]['K1L'])
+    ref = pymadx.Optics.Twiss(atf2, **initial)
+    d = o.Twiss()
+    assert np.array_equal(d['BETX'][:index2], before)
+    for key in ['BETX', 'ALFX', 'BETY', 'MUX', 'MUY', 'DX', 'DPX']:
+        assert np.allclose(d[key], ref[key], rtol=1e-9)
+
+def test_edit_listeners(atf2):
+    o = pymadx.Optics.LinearOptics(atf2)
+    t = pickle.loads(pickle.dumps(atf2))
+    assert len(t._listeners) == 0
+    t.EditComponent(3, 'K1L', 0.1)
+    # a Tfs pickled before it had listeners
+    del t.__dict__['_listeners']
+    t.EditComponent(3, 'K1L', 0.2)
+    # only a weak reference is kept
+    del o
+    gc.collect()
+    assert len(atf2._listeners) == 0
+
+def test_track_linear(atf2):
+    particles = np.random.normal(0, 1e-5, (100, 6))
+    coords = pymadx.Optics.Track(atf2, particles, observe=[100, -1])
+    p = pymadx.Optics.CumulativeMatrices(pymadx.Optics.ElementMatrices(atf2))
+    assert coords.shape == (2, 100, 6)
+    assert np.allclose(coords[0], particles.dot(p[100].T))
+    assert np.allclose(coords[1], particles.dot(p[-1].T))
+
+def test_track_second_order_vanishing_amplitude(atf2):
+    # a thin multipole with a quadrupole component and a bend with pole face
+    # angles and fringe fields, each with a weak sextupole component
+    for column, value in [('K1L', 0.5), ('K2L', 1e-9)]:
+        atf2.EditComponent(1, column, value)
+    for column, value in [('E1', 0.1), ('E2', 0.05), ('FINT', 0.5),
+                          ('HGAP', 0.01), ('K2L', 1e-9)]:
+        atf2.EditComponent(27, column, value)
+    particles = np.random.normal(0, 1e-12, (100, 6))
+    linear = pymadx.Optics.Track(atf2, particles, observe=[1, 27], order=1)
+    second = pymadx.Optics.Track(atf2, particles, observe=[1, 27], order=2)
+    assert np.allclose(second, linear, rtol=1e-6, atol=1e-20)
+
+def test_survey(atf2):
+    d = pymadx.Optics.Survey(atf2)
+    assert np.isclose(d['THETA'][-1], -atf2.GetColumn('ANGLE').sum())
+    assert d['Z'][-1] < atf2.smax
+
+def test_interpolated_sigma_needs_emittance(atf2):
+    for key in ['EX', 'EY', 'SIGE', 'EXN', 'EYN']:
+        atf2.header.pop(key, None)
+    pymadx.Plot.Beta(atf2, interpolate=True)
+    with pytest.raises(ValueError):
+        pymadx.Plot.Sigma(atf2, interpolate=True)
+    pymadx.Plot._plt.close('all')
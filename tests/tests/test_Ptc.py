@@ -0,0 +1,137 @@
+import os.path
+
+import numpy as np
+
+import pymadx
+
+PATH_TO_TEST_INPUT = "{}/../test_input/".format(
+    os.path.dirname(os.path.abspath(__file__)))
+
+def test_inrays_array_storage():
+    inrays = pymadx.Ptc.Inrays()
+    for i in range(100):
+        inrays.AddParticle(x=i, pt=-i)
+    inrays.AddParticles(np.ones((5, 6)))
+    assert len(inrays) == 105
+    assert inrays.X()[99] == 99
+    assert inrays.PT()[99] == -99
+    assert inrays[104].y == 1
+    assert np.shares_memory(inrays.X(), inrays.GetArray())
+
+def test_load_inrays(tmpdir):
+    fn = str(tmpdir.join('inrays.madx'))
+    with open(fn, 'w') as f:
+        f.write('! header\n')
+        f.write('ptc_start, x=1e-3, px=-2.5E-4, y=0.1, py=0, t=1, pt=2;\n')
+        f.write('PTC_START, PT = -1e-3 , y=3;\n')
+        f.write('\n')
+    inrays = pymadx.Ptc.LoadInrays(fn)
+    assert len(inrays) == 2
+    assert np.allclose(inrays[0:1].GetArray(), [[1e-3, -2.5e-4, 0.1, 0, 1, 2]])
+    assert np.allclose(inrays.GetArray()[1], [0, 0, 3, 0, 0, -1e-3])
+
+def test_write_inrays_roundtrip(tmpdir):
+    particles = np.random.RandomState(1).normal(size=(250, 6))
+    inrays = pymadx.Ptc.Inrays(particles)
+    for fn in ['inrays.madx', 'inrays.madx.gz']:
+        fn = str(tmpdir.join(fn))
+        pymadx.Ptc.WriteInrays(fn, inrays, chunkSize=100)
+        assert np.array_equal(pymadx.Ptc.LoadInrays(fn).GetArray(), particles)
+
+def test_gauss_generator():
+    g = pymadx.Ptc.GaussGenerator(gemx=2e-9, betax=4.0, alfx=-1.5, sigmat=0)
+    a = g.Generate(200000, None, np.random.RandomState(2))
+    b = g.Generate(200000, None, np.random.RandomState(2))
+    assert a.shape == (200000, 6)
+    assert np.array_equal(a, b)
+    scale = np.sqrt(np.outer(np.diag(g.sigmas), np.diag(g.sigmas)))
+    assert (np.abs(np.cov(a.T) - g.sigmas) <= 0.02*scale).all()
+
+def test_flat_generator():
+    f = pymadx.Ptc.FlatGenerator(mux=1.0, widthx=2.0, widthpx=0, muy=0.5,
+                                 widthy=0, widthpy=0, widthpt=1e-3)
+    grid = f.Generate(9, None)
+    assert grid.shape == (9, 6)
+    assert np.array_equal(np.unique(grid[:,0]), [0, 1, 2])
+    assert (grid[:,2] == 0.5).all()
+    for method in ['latin', 'sobol', 'random']:
+        a = f.Generate(64, None, method, np.random.RandomState(0))
+        assert a.shape == (64, 6)
+        assert (np.abs(a[:,0] - 1) <= 1).all()
+        assert (a[:,1] == 0).all()
+    # nothing to vary
+    point = pymadx.Ptc.FlatGenerator(mux=1.0, widthx=0, widthpx=0, widthy=0, widthpy=0)
+    for method in ['grid', 'latin', 'sobol', 'random']:
+        a = point.Generate(5, None, method, np.random.RandomState(0))
+        assert np.array_equal(a, np.tile(point.Means(), (5, 1)))
+    # one point in each stratum per dimension
+    lh = pymadx.Ptc.LatinHypercube(64, 2, np.random.RandomState(0))
+    assert (np.sort(np.floor(lh*64), axis=0) == np.arange(64)[:,None]).all()
+    assert np.array_equal(pymadx.Ptc.Sobol(4, 2, skip=0), [[0, 0], [0.5, 0.5], [0.25, 0.75], [0.75, 0.25]])
+
+def test_generate_to_file_reproducible(tmpdir):
+    g = pymadx.Ptc.GaussGenerator()
+    one = g.GenerateToFile(250, str(tmpdir.join('one.madx')), seed=3, chunkSize=100)
+    two = g.GenerateToFile(250, str(tmpdir.join('two.madx')), seed=3, chunkSize=100,
+                           workers=2, chunksPerFile=2)
+    assert [f.split('/')[-1] for f in two] == ['two_0.madx', 'two_1.madx']
+    a = pymadx.Ptc.LoadInrays(one[0]).GetArray()
+    b = np.vstack([pymadx.Ptc.LoadInrays(f).GetArray() for f in two])
+    assert a.shape == (250, 6)
+    assert np.array_equal(a, b)
+
+def _emittance(particles, plane):
+    return np.sqrt(np.linalg.det(np.cov(particles[:,2*plane:2*plane+2].T)))
+
+def test_matched_generators():
+    twiss = dict(emitx=2e-9, betx=6.0, alfx=0.6, dx=0.5, dpx=-0.1,
+                 emity=1e-11, bety=5.0, alfy=-2.4, sigmat=1e-3, sigmapt=1e-3)
+    for cls in [pymadx.Ptc.WaterbagGenerator, pymadx.Ptc.KVGenerator,
+                pymadx.Ptc.DispersionGaussGenerator]:
+        g = cls(**twiss)
+        a = g.Generate(100000, None, np.random.RandomState(0))
+        assert a.shape == (100000, 6)
+        # remove the dispersive part before checking the betatron emittance
+        b = a - np.outer(a[:,5], [twiss['dx'], twiss['dpx'], 0, 0, 0, 0])
+        assert abs(_emittance(b, 0)/twiss['emitx'] - 1) < 0.02
+        assert abs(_emittance(b, 1)/twiss['emity'] - 1) < 0.02
+        assert abs(np.var(b[:,0])/(twiss['emitx']*twiss['betx']) - 1) < 0.02
+        assert abs(np.polyfit(a[:,5], a[:,0], 1)[0]/twiss['dx'] - 1) < 0.02
+
+def test_matched_generator_from_tfs():
+    tfs = pymadx.Data.Tfs("{}/atf2-nominal-twiss-v5.2.tfs.tar.gz".format(PATH_TO_TEST_INPUT))
+    g = pymadx.Ptc.HaloGenerator.FromTfs(tfs, 10, halofraction=0.1)
+    assert g.betx == tfs.GetColumn('BETX')[9]
+    assert g.emitx == tfs.header['EX']
+    a = g.Generate(1000, None, np.random.RandomState(0))
+    assert a.shape == (1000, 6)
+
+def test_inrays_statistics():
+    rng = np.random.RandomState(0)
+    particles = rng.standard_normal((20000, 6)) * [1e-3, 1e-4, 1e-3, 1e-4, 1e-2, 1e-3] + 5.0
+    particles[:,1] += 0.3*(particles[:,0] - 5.0)
+    st = pymadx.Ptc.Inrays(particles).Statistics(gamma=10.0, chunkSize=3000)
+    assert st['N'] == 20000
+    assert np.allclose(st['MEAN'], particles.mean(axis=0), rtol=1e-12)
+    assert np.allclose(st['COV'], np.cov(particles.T, bias=True), rtol=1e-9)
+    centred = particles - particles.mean(axis=0)
+    assert np.allclose(st['KURTOSIS'], (centred**4).mean(axis=0)/centred.var(axis=0)**2, rtol=1e-8)
+    c = np.cov(particles[:,:2].T, bias=True)
+    emitx = np.sqrt(np.linalg.det(c))
+    assert np.isclose(st['EMITX'], emitx)
+    assert np.isclose(st['BETX'], c[0,0]/emitx)
+    assert np.isclose(st['EMITXN'], np.sqrt(99.0)*emitx)
+
+def test_moments_merge():
+    rng = np.random.RandomState(1)
+    data = rng.standard_normal((5000, 2))
+    groups = rng.randint(0, 3, 5000)
+    a = pymadx.Ptc.Moments(2, [(2, 2), (1, 3), (4, 0)], ngroups=3)
+    b = pymadx.Ptc.Moments(2, [(2, 2), (1, 3), (4, 0)], ngroups=3)
+    a.Update(data[:2000], groups[:2000])
+    b.Update(data[2000:], groups[2000:])
+    a.Merge(b)
+    x = data[groups == 2] - data[groups == 2].mean(axis=0)
+    assert np.isclose(a.Central((2, 2))[2], np.mean(x[:,0]**2 * x[:,1]**2))
+    assert np.isclose(a.Central((1, 3))[2], np.mean(x[:,0] * x[:,1]**3))
+    assert a.n[2] == len(x)
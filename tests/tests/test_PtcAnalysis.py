@@ -0,0 +1,138 @@
+import csv
+import numpy as np
+import pytest
+
+import pymadx
+
+def _write_track(filename, nsegments=3, nparticles=400):
+    """Write a small PTC trackone style file and return the particles."""
+    rng = np.random.RandomState(0)
+    particles = []
+    with open(filename, 'w') as f:
+        f.write('@ NAME             %07s "TRACKONE"\n')
+        f.write('@ TYPE             %09s "TRACKONE"\n')
+        f.write('@ ORIGIN           %16s "5.02.08 Linux 64"\n')
+        f.write('@ DATE             %08s "01/01/19"\n')
+        f.write('@ TIME             %08s "12.00.00"\n')
+        f.write('* NUMBER TURN X PX Y PY T PT S E\n')
+        f.write('$ %d %d %le %le %le %le %le %le %le %le\n')
+        for segment in range(nsegments):
+            f.write('#segment {} {} {} 0 obs{}\n'.format(segment+1, nsegments, nparticles, segment))
+            p = rng.standard_normal((nparticles, 6)) * [1e-3, 1e-4, 2e-3, 3e-4, 1e-3, 1e-3]
+            p[:,1] += (0.2 + segment) * p[:,0]
+            p[:,0] += 0.5 * p[:,5] + 1e-4
+            for i, row in enumerate(p):
+                f.write(' {} 1 {} {} {} {} {} {} {} 1.3\n'.format(i+1, *(list(row) + [1.5*segment])))
+            particles.append(p)
+    return particles
+
+@pytest.fixture
+def track(tmpdir):
+    filename = str(tmpdir.join('track.tfs'))
+    return filename, _write_track(filename)
+
+def test_optical_functions(track, tmpdir):
+    filename, particles = track
+    analysis = pymadx.PtcAnalysis.PtcAnalysis(None, filename)
+    analysis.CalculateOpticalFunctions(str(tmpdir.join('optics.dat')))
+    of = analysis.opticalFunctions
+    assert list(of['Segment']) == [1, 2, 3]
+    for i, p in enumerate(particles):
+        c = np.cov(p[:,:2].T, bias=True)
+        emittance = np.sqrt(np.linalg.det(c))
+        e = 1.3 * (1 + p[:,5])
+        assert of['wgt'][i] == len(p)
+        assert np.isclose(of['S'][i], 1.5*i)
+        assert np.isclose(of['mean_x'][i], p[:,0].mean())
+        assert np.isclose(of['emitt_x'][i], emittance)
+        assert np.isclose(of['beta_x'][i], c[0,0]/emittance)
+        assert np.isclose(of['alph_x'][i], -c[0,1]/emittance)
+        assert np.isclose(of['sigma_x_xp'][i], c[0,1])
+        assert np.isclose(of['disp_x'][i], np.cov(p[:,0], e)[0,1]/np.var(e, ddof=1))
+        assert 0 < of['sigma_beta_x'][i] < of['beta_x'][i]
+    assert len(open(str(tmpdir.join('optics.dat'))).readlines()) == 5
+
+def test_optical_functions_streamed(track, tmpdir):
+    filename, particles = track
+    loaded = pymadx.PtcAnalysis.PtcAnalysis(None, filename)
+    loaded.CalculateOpticalFunctions(str(tmpdir.join('loaded.dat')))
+    streamed = pymadx.PtcAnalysis.PtcAnalysis(None, filename, stream=True)
+    streamed.CalculateOpticalFunctions(str(tmpdir.join('streamed.dat')), chunkSize=77)
+    for key, value in loaded.opticalFunctions.items():
+        if key == 'name':
+            assert list(streamed.opticalFunctions[key]) == list(value)
+        else:
+            assert np.allclose(streamed.opticalFunctions[key], value, rtol=1e-10, atol=0), key
+
+def test_optical_functions_parallel(track, tmpdir):
+    filename, particles = track
+    serial = pymadx.PtcAnalysis.PtcAnalysis(None, filename)
+    serial.CalculateOpticalFunctions(str(tmpdir.join('serial.dat')))
+    calls = []
+    parallel = pymadx.PtcAnalysis.PtcAnalysis(None, serial.ptcOutput)
+    parallel.CalculateOpticalFunctions(str(tmpdir.join('parallel.dat')), workers=2,
+                                       progress=lambda done, total: calls.append((done, total)))
+    assert calls[-1][0] == calls[-1][1]
+    for key, value in serial.opticalFunctions.items():
+        if key != 'name':
+            assert np.allclose(parallel.opticalFunctions[key], value, rtol=1e-10, atol=0), key
+
+def test_resampled_optical_functions(track, tmpdir):
+    filename, particles = track
+    analysis = pymadx.PtcAnalysis.PtcAnalysis(None, filename)
+    analysis.CalculateOpticalFunctions(str(tmpdir.join('optics.dat')))
+    of = analysis.opticalFunctions
+    boot = analysis.ResampledOpticalFunctions(nresamples=400, rng=np.random.RandomState(0))
+    jack = analysis.ResampledOpticalFunctions('jackknife')
+    for key in ['beta_x', 'alph_x', 'emitt_y', 'disp_x', 'mean_x']:
+        assert np.allclose(boot[key], of[key])
+        assert np.allclose(jack[key], of[key])
+        assert (boot['lower_'+key] < boot[key]).all()
+        assert (boot['upper_'+key] > boot[key]).all()
+    # the resampling errors agree with the analytical estimates
+    for key in ['beta_x', 'alph_y', 'emitt_x']:
+        assert np.allclose(jack['error_'+key], of['sigma_'+key], rtol=0.1)
+        assert np.allclose(boot['error_'+key], of['sigma_'+key], rtol=0.2)
+
+def test_optical_functions_tfs(track, tmpdir):
+    filename, particles = track
+    analysis = pymadx.PtcAnalysis.PtcAnalysis(None, filename)
+    tfs = analysis.CalculateOpticalFunctions(str(tmpdir.join('optics.npz')))
+    of = analysis.opticalFunctions
+    assert isinstance(tfs, pymadx.Data.Tfs)
+    assert len(tfs) == 3
+    assert tfs.sequence == ['obs0', 'obs1', 'obs2']
+    assert np.allclose(tfs.GetColumn('BETX'), of['beta_x'])
+    assert np.allclose(tfs.GetColumn('S'), [0, 1.5, 3.0])
+    assert np.allclose(tfs.GetColumn('DX'), of['disp_x']*1.3, rtol=1e-2)
+    loaded = pymadx.PtcAnalysis.LoadOpticalFunctions(str(tmpdir.join('optics.npz')))
+    for column in ['S', 'BETX', 'ALFY', 'EMITX', 'DPY', 'BETXERR']:
+        assert np.array_equal(loaded.GetColumn(column), tfs.GetColumn(column))
+    pymadx.Plot.Beta(tfs, machine=False, dispersion=True)
+
+def test_optical_functions_columns(track, tmpdir):
+    filename, particles = track
+    analysis = pymadx.PtcAnalysis.PtcAnalysis(None, filename)
+    analysis.CalculateOpticalFunctions(str(tmpdir.join('optics.npz')))
+    of = analysis.opticalFunctions
+    # the text file columns are the keys of the dictionary under their headers
+    output = str(tmpdir.join('optics.dat'))
+    pymadx.PtcAnalysis.WriteOpticalFunctions(of, output)
+    rows = list(csv.reader(open(output), delimiter='\t'))[1:]
+    columns = dict(zip(rows[0], zip(*rows[1:])))
+    for header, values in columns.items():
+        key = header.split('[')[0]
+        key = key if key in ('Segment', 'S') else key.lower()
+        assert np.allclose(np.array(values, dtype=float), of[key]), header
+    # and the reloaded Tfs has each dispersion under its own name
+    loaded = pymadx.PtcAnalysis.LoadOpticalFunctions(str(tmpdir.join('optics.npz')))
+    for column, key in [('DX', 'disp_x'), ('DPX', 'disp_xp'),
+                        ('DY', 'disp_y'), ('DPY', 'disp_yp')]:
+        assert np.allclose(loaded.GetColumn(column), of[key]*of['energy']), column
+
+def test_exponent():
+    assert pymadx.PtcAnalysis._Exponent(x=1, px=2, e=1) == (1, 2, 0, 0, 1, 0)
+    assert pymadx.PtcAnalysis._Exponent(yp=3) == pymadx.PtcAnalysis._Exponent(py=3)
+    with pytest.raises(ValueError) as excinfo:
+        pymadx.PtcAnalysis._Exponent(x=1, z=1)
+    assert "'z'" in str(excinfo.value)